@@ -1,7 +1,31 @@
-import sys
+import argparse
+import json
+import memory_profile
 import numpy as np
 import pandas
-import json
+
+# Builds the qnorm reference read by Predictor (--qnorm): for each activity column, 100 quantiles from 0 to maxpercentile
+# over all elements, promoters and non-promoters.
+#
+# By default all EnhancerList files are loaded and the quantiles are exact (np.percentile).
+# With --streaming the files are read in chunks into one mergeable quantile sketch per column and subset, so memory does not
+# grow with the number of elements. Every quantile is then within a relative error of --alpha of the exact value
+# (e.g. 0.005 -> 0.5%), as long as the nonzero values of a column span less than a factor of ((1+alpha)/(1-alpha))^max_bins
+# (about 1e17 for the defaults). Missing values are ignored in streaming mode.
+
+NORMALIZATION_COLUMNS = ['DHS.RPM', 'ATAC.RPM', 'H3K27ac.RPM']
+
+def parseargs():
+    parser = argparse.ArgumentParser(description='Build quantile normalization reference from EnhancerList files. Writes json to stdout',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('enhancers', nargs='+', help="EnhancerList.txt files. Several files are pooled into one reference")
+    parser.add_argument('--maxpercentile', type=float, default=99.5, help="Highest quantile in the reference")
+    parser.add_argument('--streaming', action="store_true", help="Read files in chunks into quantile sketches instead of loading them whole")
+    parser.add_argument('--alpha', type=float, default=0.005, help="Relative accuracy of the streaming quantiles")
+    parser.add_argument('--max_bins', type=int, default=4096, help="Maximum number of bins per sign in each streaming sketch")
+    parser.add_argument('--chunksize', type=int, default=500000, help="Rows read at a time in streaming mode")
+    memory_profile.add_argument(parser)
+    return parser.parse_args()
 
 
 def compute_normalization(values, maxpercentile):
@@ -12,26 +36,143 @@ def compute_normalization(values, maxpercentile):
     return np.percentile(values, np.linspace(0, maxpercentile, 100)).tolist()
 
 
-if __name__ == '__main__':
-    enhancers = pandas.read_table(sys.argv[1])
+class QuantileSketch(object):
+    # Log-bucketed quantile sketch (as in DDSketch). A nonzero value x is counted in bucket ceil(log_gamma(|x|)), whose midpoint
+    # 2 * gamma^k / (gamma + 1) is within relative error alpha of every value in the bucket. Zeros are counted exactly.
+    # Sketches with the same alpha merge by adding bucket counts, in any order
+    def __init__(self, alpha=0.005, max_bins=4096):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = np.log(self.gamma)
+        self.max_bins = max_bins
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.zeros += int((values == 0).sum())
+        self._add_to_store(self.positive, values[values > 0])
+        self._add_to_store(self.negative, -values[values < 0])
+
+    def _add_to_store(self, store, values):
+        keys, counts = np.unique(np.ceil(np.log(values) / self.log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            store[key] = store.get(key, 0) + count
+        self._collapse(store)
+
+    def _collapse(self, store):
+        #Bound memory by folding the buckets closest to zero into the smallest bucket kept
+        if len(store) <= self.max_bins:
+            return
+        keys = sorted(store)
+        n_drop = len(keys) - self.max_bins
+        store[keys[n_drop]] += sum(store.pop(key) for key in keys[:n_drop])
+
+    def merge(self, other):
+        if other.alpha != self.alpha:
+            raise ValueError("Cannot merge sketches with different accuracy ({} and {})".format(self.alpha, other.alpha))
+        for store, other_store in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for key, count in other_store.items():
+                store[key] = store.get(key, 0) + count
+            self._collapse(store)
+        self.zeros += other.zeros
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, q):
+        #Same interpolation between order statistics as np.percentile
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)
+        value_of_rank, cumulative = self._sorted_buckets()
+        rank = q / 100 * (self.count - 1)
+        lower = np.floor(rank)
+        frac = rank - lower
+        lower_value = value_of_rank[np.searchsorted(cumulative, lower, side='right')]
+        upper_value = value_of_rank[np.searchsorted(cumulative, np.ceil(rank), side='right')]
+        return np.clip(lower_value + frac * (upper_value - lower_value), self.min, self.max)
+
+    def _sorted_buckets(self):
+        #Representative value of each bucket in increasing order, and the cumulative counts
+        negative_keys = np.array(sorted(self.negative, reverse=True), dtype=np.int64)
+        positive_keys = np.array(sorted(self.positive), dtype=np.int64)
+        values = np.concatenate((-self.bucket_value(negative_keys), [0.0], self.bucket_value(positive_keys)))
+        counts = np.concatenate(([self.negative[k] for k in negative_keys.tolist()], [self.zeros], [self.positive[k] for k in positive_keys.tolist()]))
+        return values, np.cumsum(counts)
+
+    def bucket_value(self, keys):
+        return 2 * np.power(self.gamma, keys.astype(np.float64)) / (self.gamma + 1)
+
+
+def get_normalization_columns(filenames):
+    #Columns present in every file
+    columns = None
+    for filename in filenames:
+        header = pandas.read_csv(filename, sep="\t", nrows=0).columns
+        present = [col for col in NORMALIZATION_COLUMNS if col in header]
+        columns = present if columns is None else [col for col in columns if col in present]
+    return columns
+
+def build_normalization_exact(filenames, maxpercentile):
+    enhancers = pandas.concat([pandas.read_table(filename) for filename in filenames], ignore_index=True)
     enhancers_tss = enhancers.loc[enhancers['isPromoterElement'] == True]
     enhancers_nontss = enhancers.loc[enhancers['isPromoterElement'] == False]
 
     normalizations = {}
-    #normalizations['count'] = 15000
-    normalizations['maxpercentile'] = 99.5
-    normalizations['source'] = sys.argv[1]
+    for col in get_normalization_columns(filenames):
+        normalizations[col] = compute_normalization(enhancers[col].values, maxpercentile)
+        normalizations[col + '.PROMOTER'] = compute_normalization(enhancers_tss[col].values, maxpercentile)
+        normalizations[col + '.NON_PROMOTER'] = compute_normalization(enhancers_nontss[col].values, maxpercentile)
+    return normalizations
+
+def build_normalization_streaming(filenames, maxpercentile, alpha, max_bins, chunksize):
+    columns = get_normalization_columns(filenames)
+    keys = [col + suffix for col in columns for suffix in ['', '.PROMOTER', '.NON_PROMOTER']]
+    sketches = {key: QuantileSketch(alpha, max_bins) for key in keys}
+
+    for filename in filenames:
+        for chunk in pandas.read_csv(filename, sep="\t", usecols=columns + ['isPromoterElement'], chunksize=chunksize):
+            is_promoter = (chunk['isPromoterElement'] == True).values
+            is_nonpromoter = (chunk['isPromoterElement'] == False).values
+            for col in columns:
+                values = chunk[col].values
+                sketches[col].add(values)
+                sketches[col + '.PROMOTER'].add(values[is_promoter])
+                sketches[col + '.NON_PROMOTER'].add(values[is_nonpromoter])
 
-    for col in enhancers.columns:
-        #if 'RPM' in col or 'RPKM' in col:
-        if col in ['DHS.RPM', 'ATAC.RPM','H3K27ac.RPM']:
-            normalizations[col] = compute_normalization(enhancers[col].values,
-                                                        normalizations['maxpercentile'])
+    percentiles = np.linspace(0, maxpercentile, 100)
+    return {key: sketches[key].percentile(percentiles).tolist() for key in keys}
 
-            normalizations[col + '.PROMOTER'] = compute_normalization(enhancers_tss[col].values,
-                                                        normalizations['maxpercentile'])
 
-            normalizations[col + '.NON_PROMOTER'] = compute_normalization(enhancers_nontss[col].values,
-                                                        normalizations['maxpercentile'])
+def main():
+    args = parseargs()
+    memory_profile.start(__file__, args.memory_profile)
+
+    normalizations = {}
+    #normalizations['count'] = 15000
+    normalizations['maxpercentile'] = args.maxpercentile
+    normalizations['source'] = ",".join(args.enhancers)
+
+    with memory_profile.stage("build_normalization", "streaming" if args.streaming else "exact"):
+        if args.streaming:
+            normalizations['relative_accuracy'] = args.alpha
+            normalizations.update(build_normalization_streaming(args.enhancers, args.maxpercentile, args.alpha, args.max_bins, args.chunksize))
+        else:
+            normalizations.update(build_normalization_exact(args.enhancers, args.maxpercentile))
 
     print(json.dumps(normalizations, indent=4))
+
+if __name__ == '__main__':
+    main()
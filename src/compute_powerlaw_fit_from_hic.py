@@ -5,9 +5,11 @@ import scipy.sparse as ssp
 import argparse
 import glob
 import os
+import memory_profile
 from scipy.optimize import least_squares
 import matplotlib; matplotlib.use('Agg')
 import pylab
+from hic import HiC, find_hic_files
 
 #To do: 
 #1. Check if max/min window is off by 1 bin or is working properly
@@ -22,11 +24,15 @@ def parseargs(required_args=True):
                                      epilog=epilog,
                                      formatter_class=formatter)
     readable = argparse.FileType('r')
-    parser.add_argument('--bedDir', required=required_args, help="Directory containing bedgraphs. All files named *chr*.bg.gz will be loaded")
+    input_group = parser.add_mutually_exclusive_group(required=required_args)
+    input_group.add_argument('--bedDir', help="Directory containing bedgraphs. All files named *chr*.bg.gz will be loaded")
+    input_group.add_argument('--hicDir', help="Directory containing normalized hic matrices ({chr}/{chr}_{res}kb.RAWobserved and .KRnorm). Fit is computed from the mean contact at each diagonal offset rather than from per-gene bedgraphs")
     parser.add_argument('--outDir', help="Output directory")
-    parser.add_argument('--resolution', default=5000, help="Resolution of hic dataset (in bp)")
-    parser.add_argument('--minWindow', default=10000, help="Minimum distance from gene TSS to compute normalizations (bp)")
-    parser.add_argument('--maxWindow', default=1000000, help="Maximum distance from gene TSS to use to compute normalizations (bp)")
+    parser.add_argument('--resolution', type=int, default=5000, help="Resolution of hic dataset (in bp)")
+    parser.add_argument('--minWindow', type=int, default=10000, help="Minimum distance from gene TSS to compute normalizations (bp)")
+    parser.add_argument('--maxWindow', type=int, default=1000000, help="Maximum distance from gene TSS to use to compute normalizations (bp)")
+    parser.add_argument('--kr_cutoff', type=float, default=0.1, help="Used with --hicDir. Bins with kr normalization vector below this value are not used")
+    memory_profile.add_argument(parser)
 
     args = parser.parse_args()
     return(args)
@@ -77,6 +83,36 @@ def filegen(args):
         yield mat
 
 
+def mean_diagonal_profile(hic_data, max_offset):
+    #Genome-wide mean contact at each diagonal offset, one chromosome at a time.
+    #hic_data can be any matrix backend providing chromosomes() and diagonal_sums(chr, max_offset)
+    sums = np.zeros(max_offset + 1)
+    counts = np.zeros(max_offset + 1)
+    for chr in hic_data.chromosomes():
+        with memory_profile.stage("diagonal_sums", chr):
+            chr_sums, chr_counts = hic_data.diagonal_sums(chr, max_offset)
+        sums += chr_sums
+        counts += chr_counts
+
+    mean = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    return mean, counts
+
+
+def diagonal_profile(args):
+    #Lay the diagonal means out like the averaged bedgraphs (offset 0 in the center, normalized to sum to 1)
+    #so they can be passed directly to compute_powerlaw_fit
+    maxsize = 5000000 + 10 * args.resolution
+    max_offset = maxsize // args.resolution
+
+    hic_files = find_hic_files(args.hicDir, args.resolution)
+    hic_data = HiC(hic_files, window=maxsize, resolution=args.resolution, kr_cutoff=args.kr_cutoff)
+    mean, counts = mean_diagonal_profile(hic_data, max_offset)
+
+    profile = np.concatenate((mean[:0:-1], mean))
+    profile = profile / np.sum(profile)
+    return ssp.csr_matrix(profile), mean, counts
+
+
 def compute_powerlaw_fit(m, args, make_plot=True):
     mean_hic = m.A[0]
     distance_from_center = abs(np.arange(len(mean_hic)) - len(mean_hic) // 2) + 1
@@ -113,13 +149,21 @@ def compute_powerlaw_fit(m, args, make_plot=True):
 
 if __name__ == '__main__':
     args = parseargs()
-
-    #Average together bedgraphs
-    m, var = welford(filegen(args))
-
-    #Save summary files
-    np.savez(os.path.join(args.outDir, 'hic_bedgraph_summary.npz'), mean=m.A, var=var.A, resolution=args.resolution)
-    pandas.DataFrame({ 'mean' : m.A[0], 'var' : var.A[0] }).to_csv(os.path.join(args.outDir, 'hic_bedgraph_summary.txt'), index=False, header=True, sep='\t')
+    memory_profile.start(__file__, args.memory_profile)
+    os.makedirs(args.outDir, exist_ok=True)
+
+    if args.hicDir:
+        #Mean contact by diagonal offset, straight from the matrices
+        m, diag_mean, diag_counts = diagonal_profile(args)
+        pandas.DataFrame({ 'offset' : np.arange(len(diag_mean)) * args.resolution, 'mean' : diag_mean, 'nbins' : diag_counts }).to_csv(os.path.join(args.outDir, 'hic_diagonal_summary.txt'), index=False, header=True, sep='\t')
+    else:
+        #Average together bedgraphs
+        with memory_profile.stage("average_bedgraphs"):
+            m, var = welford(filegen(args))
+
+        #Save summary files
+        np.savez(os.path.join(args.outDir, 'hic_bedgraph_summary.npz'), mean=m.A, var=var.A, resolution=args.resolution)
+        pandas.DataFrame({ 'mean' : m.A[0], 'var' : var.A[0] }).to_csv(os.path.join(args.outDir, 'hic_bedgraph_summary.txt'), index=False, header=True, sep='\t')
 
     #compute normalization
     result = compute_powerlaw_fit(m, args)
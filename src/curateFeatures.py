@@ -2,7 +2,9 @@ import pandas as pd
 import numpy as np
 import argparse
 import os
+import memory_profile
 from peaks import *
+from scheduler import JobGraph
 import traceback
 from itertools import chain
 
@@ -36,6 +38,13 @@ def parseargs(required_args=True):
     parser.add_argument('--make_vplot', action="store_true", help = "Do not run vplot")
     parser.add_argument('--tss_file', default="/seq/lincRNA/Jesse/bin/scripts/TSSfiles/hg19.noY.TSS.bed", help="Bed file for TSS enrichment computation")
     parser.add_argument('--extension', default=1000, help="bp extension to use for v plot and tss enrichment")
+    parser.add_argument('--vplot_min_mapq', default=30, type=int, help="Minimum mapping quality of reads counted in the v plot")
+    parser.add_argument('--vplot_tn5_shift', choices=['ATAC', 'all', 'none'], default='ATAC', help="Files whose read ends are shifted +4/-5 bp to the Tn5 insertion center in the v plot")
+
+    parser.add_argument('--threads', default=1, type=int, help="Number of jobs (MACS2, candidate regions, v plot, read counting) to run at once. Files are processed concurrently")
+    parser.add_argument('--max_memory_gb', default=None, type=float, help="Do not start a job if the memory estimates of the running jobs would exceed this")
+    parser.add_argument('--job_memory_gb', default=4, type=float, help="Memory estimate for each MACS2 and candidate region job, used with --max_memory_gb")
+    memory_profile.add_argument(parser)
     
     args = parser.parse_args()
     return(args)
@@ -57,61 +66,84 @@ def processCellType(cellType, args):
 	d3 = {filename : "H3K27ac" for filename in params['feature_H3K27ac'].to_string(index=False).split(",") if filename != 'NaN'}
 	file_dict = dict(chain.from_iterable(d.items() for d in (d1, d2, d3)))
 
-	qc_list = []
+	#Each file is independent. The only ordering needed is peaks before candidate regions
+	jobs = JobGraph(max_cpus=args.threads, max_memory_gb=args.max_memory_gb)
 	for this_file, feature_type in file_dict.items():
-		qc_stats = pd.DataFrame({'cellType' : [cellType]})
-		qc_stats['feature'] = feature_type
-		qc_stats['default_accessibility_feature'] = params["default_accessibility_feature"].values[0]
-		qc_stats['file'] = this_file
-
-		#MACS
 		if feature_type != "H3K27ac":
 			macs_format = get_macs_format(feature_type) #assumes ATAC is paired end and DNase is not
 
 			peaks_file_prefix = os.path.basename(this_file.replace(".tagAlign.gz", ".macs2").replace(".bam", ".macs2"))
-			run_macs2_callpeak(this_file, args.outDir, peaks_file_prefix, macs_format, args.pval_cutoff, genome['sizes'], force=False)	
-			qc_stats['peak_file'] = os.path.join(args.outDir, peaks_file_prefix + '_peaks.narrowPeak')
-			qc_stats['num_peaks'] = compute_macs_stats(os.path.join(args.outDir, peaks_file_prefix + '_peaks.narrowPeak'))
+			peak_file = os.path.join(args.outDir, peaks_file_prefix + '_peaks.narrowPeak')
+			jobs.add(("macs2", this_file), call_peaks, this_file, args.outDir, peaks_file_prefix, macs_format, args.pval_cutoff, genome['sizes'], memory_gb=args.job_memory_gb)
 
 			#Make candidate regions
-			make_candidate_regions_from_summits(macs_peaks = qc_stats['peak_file'].values[0], 
-												accessibility_file = this_file, 
-												genome_sizes = genome['sizes'], 
-												regions_whitelist = args.regions_whitelist,
-												regions_blacklist = args.regions_blacklist,
-												n_enhancers = args.nStrongestPeaks, 
-												peak_extend = args.peakExtendFromSummit, 
-												outdir = args.outDir)
-			qc_stats['candidate_region_file'] = os.path.join(args.outDir, os.path.basename(qc_stats['peak_file'].values[0]) + ".candidateRegions.bed")
+			jobs.add(("candidate_regions", this_file), make_candidate_regions_from_summits,
+						deps = [("macs2", this_file)],
+						memory_gb = args.job_memory_gb,
+						macs_peaks = peak_file,
+						accessibility_file = this_file,
+						genome_sizes = genome['sizes'],
+						regions_whitelist = args.regions_whitelist,
+						regions_blacklist = args.regions_blacklist,
+						n_enhancers = args.nStrongestPeaks,
+						peak_extend = args.peakExtendFromSummit,
+						outdir = args.outDir)
 
 		#Vplot
 		if args.make_vplot:
-			try:
-				qc_stats['tss_vplot_score'] = make_v_plot(this_file, args.tss_file, os.path.join(args.outDir, cellType, this_file + ".v_plot"), args.extension)
-			except Exception as e:
-				print(e)
-				qc_stats['tss_vplot_score'] = np.nan
-
-		#Count Reads 
-		try:
-			qc_stats['read_count'] = count_total(this_file)
-		except Exception as e:
-			print(e)
-			qc_stats['read_count'] = np.nan
+			tn5_shift = args.vplot_tn5_shift == 'all' or (args.vplot_tn5_shift == 'ATAC' and feature_type == "ATAC")
+			jobs.add(("vplot", this_file), try_or_nan, make_v_plot, this_file, args.tss_file, os.path.join(args.outDir, cellType, this_file + ".v_plot"), args.extension,
+						min_mapq=args.vplot_min_mapq, tn5_shift=tn5_shift)
+
+		#Count Reads
+		jobs.add(("read_count", this_file), try_or_nan, count_total, this_file)
+
+	results = jobs.run()
 
+	#QC rows in the order of the parameters file, however the jobs finished
+	qc_list = []
+	for this_file, feature_type in file_dict.items():
+		qc_stats = pd.DataFrame({'cellType' : [cellType]})
+		qc_stats['feature'] = feature_type
+		qc_stats['default_accessibility_feature'] = params["default_accessibility_feature"].values[0]
+		qc_stats['file'] = this_file
+
+		if feature_type != "H3K27ac":
+			qc_stats['peak_file'] = results[("macs2", this_file)]
+			qc_stats['num_peaks'] = compute_macs_stats(qc_stats['peak_file'].values[0])
+			qc_stats['candidate_region_file'] = results[("candidate_regions", this_file)]
+
+		if args.make_vplot:
+			qc_stats['tss_vplot_score'] = results[("vplot", this_file)]
+
+		qc_stats['read_count'] = results[("read_count", this_file)]
 		qc_list.append(qc_stats)
 
 	all_qc_stats = pd.concat(qc_list)
 	all_qc_stats.to_csv(os.path.join(args.outDir, "feature.stats.txt"), sep="\t", index=False)
 	print(all_qc_stats)
-	
+
+def call_peaks(infile, outdir, outfile_prefix, MACS_format, pval_cutoff, genome_sizes):
+	run_macs2_callpeak(infile, outdir, outfile_prefix, MACS_format, pval_cutoff, genome_sizes, force=False)
+	return os.path.join(outdir, outfile_prefix + '_peaks.narrowPeak')
+
+def try_or_nan(func, *args, **kwargs):
+	#v plot and read count failures are recorded as NaN in the QC table rather than stopping the cell type
+	try:
+		return func(*args, **kwargs)
+	except Exception as e:
+		print(e)
+		return np.nan
+
 def write_params(args, file):
     with open(file, 'w') as outfile:
         for arg in vars(args):
             outfile.write("--" + arg + " " + str(getattr(args, arg)) + " ")
 
 def main(args):
-    processCellType(args.cellType, args)
+    memory_profile.start(__file__, args.memory_profile)
+    with memory_profile.stage("curate_features", args.cellType):
+        processCellType(args.cellType, args)
 
 if __name__ == '__main__':
     args = parseargs()
@@ -1,8 +1,11 @@
 from weakref import WeakValueDictionary
+import glob
+import os.path
 
 import numpy as np
 import scipy.sparse as ssp
 import pandas
+from memory_profile import stage
 
 class TempDict(dict):
     pass
@@ -22,40 +25,30 @@ class HiC(object):
     def chromosomes(self):
         return self._chromosomes
 
-    def row(self, chr, row):
+    def _get(self, chr):
         try:
             hic = self.cache[chr]
         except KeyError:
             hic = self.load(chr)
             self.__last = self.cache[chr] = hic
+        return hic
 
-        hicdata = hic['hic_mat']
-        norms = hic['hic_norm']
-
-        # find row in matrix
-        rowidx = row // self.resolution
+    def matrix(self, chr):
+        # Normalized matrix and normalization vector (None without KR norms) of a chromosome
+        hic = self._get(chr)
+        return hic['hic_mat'], hic['hic_norm']
 
-        # clip to range for which we have data
-        rowidx = max(0, min(rowidx, hicdata.shape[0] - 1))
-
-        #Set all entries that have nan normalization factor to nan 
-        data = hicdata[rowidx, :]
-        if norms is not None:
-            data[0, np.where(np.isnan(norms))] = np.nan
-
-        return data
+    def row(self, chr, row):
+        hicdata, norms = self.matrix(chr)
+        return get_row(hicdata, norms, row, self.resolution)
 
     def query(self, chr, row, cols):
-        try:
-            hicdata = self.cache[chr]
-        except KeyError:
-            hicdata = self.load(chr)
-            self.__last = self.cache[chr] = hicdata
+        hicdata = self._get(chr)['hic_mat']
 
         # find cols in matrix
         colsidx = cols // self.resolution
         valid_colsidx = np.clip(colsidx, 0, hicdata.shape[1] - 1)
-        rowdata = self.row(row)
+        rowdata = self.row(chr, row)
 
         # extract column values
         values = rowdata[:, valid_colsidx].todense().A.ravel()
@@ -65,6 +58,28 @@ class HiC(object):
 
         return values
 
+    def diagonal_sums(self, chr, max_offset):
+        # Sum of normalized contacts and number of usable bins at each diagonal offset (0 .. max_offset).
+        # Bins with a nan normalization factor are excluded from both.
+        hic = self._get(chr)
+        mat = hic['hic_mat'].tocoo()
+        norms = hic['hic_norm']
+
+        # matrix is symmetric, so only look at the upper triangle
+        upper = (mat.col >= mat.row) & ~np.isnan(mat.data)
+        offsets = (mat.col - mat.row)[upper]
+        data = mat.data[upper]
+        keep = offsets <= max_offset
+        sums = np.bincount(offsets[keep], weights=data[keep], minlength=max_offset + 1)
+
+        nbins = mat.shape[0]
+        valid = np.ones(nbins, dtype=bool) if norms is None else ~np.isnan(norms)
+        counts = np.zeros(max_offset + 1)
+        for k in range(min(max_offset + 1, nbins)):
+            counts[k] = np.count_nonzero(valid[:nbins - k] & valid[k:])
+
+        return sums, counts
+
     def __call__(self, *args, **kwargs):
         return self.query(*args, **kwargs)
 
@@ -77,24 +92,60 @@ class HiC(object):
             hic_filename, norm_filename = hic_filename
 
         print("loading", hic_filename)
-        sparse_matrix = hic_to_sparse(hic_filename,
-                                      self.window, self.resolution)
+        with stage("hic_to_sparse", chr):
+            sparse_matrix = hic_to_sparse(hic_filename,
+                                          self.window, self.resolution)
+        sparse_matrix_norm = sparse_matrix
+        norms = None
 
         if norm_filename is not None:
-            norms = np.loadtxt(norm_filename)
-            assert len(norms) >= sparse_matrix.shape[0]
-            if len(norms) > sparse_matrix.shape[0]:
-                norms = norms[:sparse_matrix.shape[0]] #JN: 4/23/18 - is this always guaranteed to be correct???
+            with stage("hic_normalize", chr):
+                norms = np.loadtxt(norm_filename)
+                assert len(norms) >= sparse_matrix.shape[0]
+                if len(norms) > sparse_matrix.shape[0]:
+                    norms = norms[:sparse_matrix.shape[0]] #JN: 4/23/18 - is this always guaranteed to be correct???
 
-            norms[norms < self.kr_cutoff] = np.nan
-            norm_mat = ssp.dia_matrix((1.0 / norms, [0]), (len(norms), len(norms)))
+                norms[norms < self.kr_cutoff] = np.nan
+                norm_mat = ssp.dia_matrix((1.0 / norms, [0]), (len(norms), len(norms)))
 
-            # normalize row and columns
-            sparse_matrix_norm = norm_mat * sparse_matrix * norm_mat
+                # normalize row and columns
+                sparse_matrix_norm = norm_mat * sparse_matrix * norm_mat
 
         return TempDict(hic_mat=sparse_matrix_norm, hic_norm=norms)
 
 
+def get_row(hicdata, norms, row, resolution):
+    # find row in matrix
+    rowidx = row // resolution
+
+    # clip to range for which we have data
+    rowidx = max(0, min(rowidx, hicdata.shape[0] - 1))
+
+    #Set all entries that have nan normalization factor to nan 
+    data = hicdata[rowidx, :]
+    if norms is not None:
+        data[0, np.where(np.isnan(norms))] = np.nan
+
+    return data
+
+
+def find_hic_files(hic_dir, resolution, chromosomes=None):
+    # Locate {chr}/{chr}_{res}kb.RAWobserved and matching KRnorm files (Rao et al. 2014 / juicebox_dump.py layout)
+    res = '{}kb'.format(resolution // 1000)
+    if chromosomes is None:
+        chromosomes = sorted(os.path.basename(d) for d in glob.glob(os.path.join(hic_dir, 'chr*')) if os.path.isdir(d))
+
+    hic_files = {}
+    for chr in chromosomes:
+        possible_files = glob.glob(os.path.join(hic_dir, chr, '{}_{}.RAWobserved'.format(chr, res)))
+        possible_norms = glob.glob(os.path.join(hic_dir, chr, '{}_{}.KRnorm'.format(chr, res)))
+
+        if possible_files:
+            hic_files[chr] = (possible_files[0], possible_norms[0] if possible_norms else None)
+
+    return hic_files
+
+
 def hic_to_sparse(filename, window, resolution):
     HiC = pandas.read_table(filename, names=["start", "end", "counts"],
                             header=None, engine='c', memory_map=True)
@@ -0,0 +1,193 @@
+import argparse
+import glob
+import gzip
+import memory_profile
+import os
+import numpy as np
+import pandas
+from intervaltree import Interval
+from proximity import HiCFetcher
+
+# Multi-resolution Hi-C bedgraphs. Contacts are kept at the Hi-C resolution near the TSS and averaged into progressively
+# coarser bins further away, where single bins are noisy anyway. Levels are given as distance:binsize breakpoints, e.g.
+#   100000:10000,500000:25000,1000000:50000
+# keeps 5 kb bins within 100 kb of the TSS bin, 10 kb bins to 500 kb, 25 kb bins to 1 Mb and 50 kb bins beyond (6x fewer
+# rows for a 5 Mb window). Coarse bins are aligned to multiples of their size and hold the mean contact of the fine bins
+# they cover, so they are plain bedgraphs with wider intervals: HiCFetcher looks up each enhancer in the bin that contains
+# it and weights bins by width when normalizing a row.
+#
+# make_bedgraph_from_HiC.py --levels writes these directly from the matrices. This script converts an existing directory
+# of single resolution bedgraphs and, with --report, compares the contacts HiCFetcher returns from both directories.
+
+def parse_levels(spec, resolution):
+    #"distance:binsize,..." -> [(distance, binsize), ...] sorted by distance
+    levels = []
+    for level in spec.split(","):
+        distance, binsize = [int(x) for x in level.split(":")]
+        levels.append((distance, binsize))
+    levels.sort()
+
+    previous_binsize = resolution
+    for distance, binsize in levels:
+        if binsize % resolution != 0 or binsize <= previous_binsize:
+            raise ValueError("Bin sizes in --levels must be increasing multiples of the resolution ({}): {}".format(resolution, spec))
+        previous_binsize = binsize
+    #The diagonal bin and its neighbors (see HiCFetcher.read_bedgraph) stay at full resolution
+    if levels and levels[0][0] <= resolution:
+        raise ValueError("The first distance in --levels must be larger than the resolution ({}): {}".format(resolution, spec))
+    return levels
+
+def format_levels(levels):
+    return ",".join("{}:{}".format(distance, binsize) for distance, binsize in levels)
+
+def aggregate_bedgraph(df, tss, resolution, levels):
+    #df: chr, start, end, value columns of consecutive bins at the Hi-C resolution, in order.
+    #Returns the same columns with bins further than each level's distance from the TSS bin averaged into that level's bins
+    if not levels or len(df) == 0:
+        return df
+    chr_col, start_col, end_col, val_col = df.columns[:4]
+    starts = df[start_col].values
+    distance = np.abs(starts // resolution - int(tss) // resolution) * resolution
+    binsize = np.full(len(df), resolution)
+    for level_distance, level_binsize in levels:
+        binsize[distance >= level_distance] = level_binsize
+
+    #A coarse bin is a run of consecutive fine bins with the same size, side of the TSS and aligned coarse bin
+    side = np.sign(starts // resolution - int(tss) // resolution)
+    key = np.column_stack((binsize, side, starts // binsize))
+    new_bin = np.concatenate(([True], (key[1:] != key[:-1]).any(axis=1)))
+    group = np.cumsum(new_bin) - 1
+
+    return pandas.DataFrame({chr_col: df[chr_col].values[new_bin],
+                             start_col: starts[new_bin],
+                             end_col: np.maximum.reduceat(df[end_col].values, np.flatnonzero(new_bin)),
+                             val_col: np.bincount(group, weights=df[val_col].values) / np.bincount(group)})
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(description='Convert single resolution Hi-C bedgraphs to multi-resolution bedgraphs and report their accuracy',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--bedgraph_dir', required=True, help="Directory of bedgraphs written by make_bedgraph_from_HiC.py without --levels")
+    parser.add_argument('--outdir', required=True, help="Directory to write multi-resolution bedgraphs to")
+    parser.add_argument('--levels', required=True, help="Comma delimited distance:binsize breakpoints. Bins at least distance (bp) from the TSS bin are averaged into bins of binsize (bp)")
+    parser.add_argument('--resolution', type=int, default=5000, help="Resolution of the input bedgraphs")
+    parser.add_argument('--overwrite', action="store_true", help="Rewrite bedgraphs that already exist in outdir")
+    parser.add_argument('--report', default=None, help="Write an accuracy report comparing the contacts in outdir to those in bedgraph_dir to this file")
+    parser.add_argument('--enhancers', default=None, help="EnhancerList.txt. The report compares contacts at these elements' midpoints instead of at every bin")
+    parser.add_argument('--window', type=int, default=5000000, help="Compare contacts within this distance of the TSS, as in predict.py")
+    parser.add_argument('--tss_hic_contribution', type=float, default=100, help="As in predict.py")
+    memory_profile.add_argument(parser)
+    return parser.parse_args()
+
+
+def get_bedgraph_tss(filename):
+    #{name}_{chr}_{tss}.bg.gz, see make_bedgraph_from_HiC.get_bedgraph_filename
+    return int(os.path.basename(filename).split('.')[-3].split('_')[-1])
+
+def convert_bedgraphs(bedgraph_dir, outdir, levels, resolution, overwrite=False):
+    os.makedirs(outdir, exist_ok=True)
+    filenames = sorted(glob.glob(os.path.join(bedgraph_dir, '*chr*.bg.gz')))
+    for filename in filenames:
+        outfile = os.path.join(outdir, os.path.basename(filename))
+        if os.path.exists(outfile) and not overwrite:
+            continue
+        df = pandas.read_table(filename, header=None)
+        aggregate_bedgraph(df, get_bedgraph_tss(filename), resolution, levels).to_csv(outfile, sep='\t', compression='gzip', header=False, index=False)
+    print("Wrote {} bedgraphs to {}".format(len(filenames), outdir))
+    return filenames
+
+
+def compare_contacts(bedgraph_dir, pyramid_dir, levels, resolution, window, tss_hic_contribution=100, enhancers=None):
+    #Contacts (as used by the ABC score: normalized and relative to the row maximum) from both directories for every gene,
+    #at element midpoints or at the centers of the baseline bins within window of the TSS. One row per gene and position, with the size of the
+    #multi-resolution bin it falls in. Genes without contacts in the window are left out
+    baseline = HiCFetcher(bedgraph_dir, resolution=resolution, tss_hic_contribution=tss_hic_contribution)
+    pyramid = HiCFetcher(pyramid_dir, resolution=resolution, tss_hic_contribution=tss_hic_contribution)
+    if enhancers is not None:
+        midpoints = {chr: np.sort(((group['start'] + group['end']) // 2).values) for chr, group in enhancers.groupby('chr')}
+
+    results = []
+    for filename in sorted(glob.glob(os.path.join(bedgraph_dir, '*chr*.bg.gz'))):
+        if not os.path.exists(os.path.join(pyramid_dir, os.path.basename(filename))):
+            continue
+        chr, tss = os.path.basename(filename).split('.')[-3].split('_')[-2], get_bedgraph_tss(filename)
+        if enhancers is None:
+            bins = pandas.read_table(filename, header=None, usecols=[1, 2])
+            positions = ((bins[1] + bins[2]) // 2).values
+            positions = positions[np.abs(positions - tss) < window]
+        else:
+            chr_midpoints = midpoints.get(chr, np.zeros(0, dtype=np.int64))
+            positions = chr_midpoints[np.abs(chr_midpoints - tss) < window]
+        if len(positions) == 0:
+            continue
+
+        #Both files are read and looked up as in HiCFetcher.query (without powerlaw scaling)
+        contacts = {}
+        for name, fetcher, directory in [('baseline', baseline, bedgraph_dir), ('pyramid', pyramid, pyramid_dir)]:
+            df = fetcher.read_bedgraph(Interval(tss, tss + 1, os.path.join(directory, os.path.basename(filename))))
+            if df is not None:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    contacts[name] = fetcher.lookup(df, positions) / df.val.max()
+        if len(contacts) < 2:
+            continue
+        results.append(pandas.DataFrame({'chr': chr, 'tss': tss, 'position': positions, 'distance': np.abs(positions - tss),
+                                         'baseline': contacts['baseline'], 'pyramid': contacts['pyramid']}))
+    results = pandas.concat(results, ignore_index=True).dropna(subset=['baseline', 'pyramid'])
+
+    #Same distance to the TSS bin as in aggregate_bedgraph
+    bin_distance = np.abs(results['position'] // resolution - results['tss'] // resolution) * resolution
+    distances = [0] + [distance for distance, binsize in levels]
+    binsizes = np.array([resolution] + [binsize for distance, binsize in levels])
+    results['binsize'] = binsizes[np.searchsorted(distances, bin_distance.values, side='right') - 1]
+    return results
+
+def summarize_accuracy(results):
+    def summarize(group):
+        error = group['pyramid'] - group['baseline']
+        relative = np.abs(error) / group['baseline'].where(group['baseline'] > 0)
+        return pandas.Series({'positions': len(group),
+                              'median_abs_relative_error': relative.median(),
+                              'p95_abs_relative_error': relative.quantile(.95),
+                              'max_abs_error': np.abs(error).max(),
+                              'pearson_r': np.corrcoef(group['baseline'], group['pyramid'])[0, 1] if len(group) > 1 else np.nan})
+
+    by_band = [summarize(group).rename(name) for name, group in results.groupby('binsize')]
+    return pandas.DataFrame(by_band + [summarize(results).rename('all')])
+
+def directory_size(directory):
+    filenames = glob.glob(os.path.join(directory, '*chr*.bg.gz'))
+    rows = 0
+    for filename in filenames:
+        with gzip.open(filename, 'rt') as f:
+            rows += sum(1 for line in f)
+    return sum(os.path.getsize(f) for f in filenames), rows
+
+def write_report(args, levels):
+    enhancers = pandas.read_table(args.enhancers, usecols=['chr', 'start', 'end']) if args.enhancers else None
+    results = compare_contacts(args.bedgraph_dir, args.outdir, levels, args.resolution, args.window, args.tss_hic_contribution, enhancers)
+    accuracy = summarize_accuracy(results)
+
+    base_bytes, base_rows = directory_size(args.bedgraph_dir)
+    pyramid_bytes, pyramid_rows = directory_size(args.outdir)
+    with open(args.report, 'w') as report:
+        report.write("# levels\t{}\n".format(format_levels(levels)))
+        report.write("# compared at\t{}\n".format("element midpoints in " + args.enhancers if args.enhancers else "bin centers"))
+        report.write("# rows\t{}\t{}\t{:.2f}x fewer\n".format(base_rows, pyramid_rows, base_rows / max(pyramid_rows, 1)))
+        report.write("# bytes\t{}\t{}\t{:.2f}x smaller\n".format(base_bytes, pyramid_bytes, base_bytes / max(pyramid_bytes, 1)))
+        report.write("# Errors are in contact relative to the row maximum (hic.distance / hic.rowmax in predictions), by bin size\n")
+        accuracy.to_csv(report, sep='\t', index_label='binsize', float_format="%.6g")
+    print("Wrote accuracy report to {}".format(args.report))
+
+
+def main():
+    args = parseargs()
+    memory_profile.start(__file__, args.memory_profile)
+    levels = parse_levels(args.levels, args.resolution)
+    with memory_profile.stage("convert_bedgraphs"):
+        convert_bedgraphs(args.bedgraph_dir, args.outdir, levels, args.resolution, args.overwrite)
+    if args.report:
+        with memory_profile.stage("accuracy_report"):
+            write_report(args, levels)
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@
 
 import argparse
 import subprocess
+import memory_profile
 
 ## Extracted from http://hicfiles.tc4ga.com/juicebox.properties
 # hic_files = dict( 
@@ -40,10 +41,13 @@ def parseargs():
     parser.add_argument('--juicebox', default="/seq/lincRNA/Software/juicer/GridEngine8/scripts-old/juicebox")
     parser.add_argument('--obskr', action="store_true", help="Only download the KR observed matrix (as opposed to the Raw matrix and the KR norm vector separately")
     parser.add_argument('--chromosomes', default="all", help="comma delimited list of chromosomes to download. ")
+    memory_profile.add_argument(parser)
 
     return parser.parse_args()
 
 def main(args):
+    #juicebox runs as a subprocess: its peak is in children_peak_rss_mb of the report
+    memory_profile.start(__file__, args.memory_profile)
 
     if args.chromosomes == "all":
         chromosomes = list(range(1,23)) + ['X']
@@ -1,11 +1,16 @@
 import argparse
 import glob
+import memory_profile
 import os.path
-from hic import HiC
+from hic import HiC, find_hic_files, get_row
 import pandas
 import numpy as np
 import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
 from neighborhoods import read_bed, process_gene_bed
+from shared_data import SharedArrays, share_csr_matrix, attach_csr_matrix
+from hic_pyramid import parse_levels, aggregate_bedgraph
 
 def parseargs():
     parser = argparse.ArgumentParser(description='Convert HiC matrices to bedgraphs for a set of genes')
@@ -21,31 +26,78 @@ def parseargs():
     parser.add_argument('--resolution', type=int, default=5000, help="HiC resolution to use")
     parser.add_argument('--kr_cutoff', type=float, default=0.1, help="Measured data from Hi-C matrix for rows/columns with kr normalization vector below this value are not used. Instead they are interpolated from neighboring bins")
     parser.add_argument('--window', type=int, default=5000000, help="maximum distance from each TSS to store (bp)")
+    parser.add_argument('--levels', default="", help="Write multi-resolution bedgraphs: comma delimited distance:binsize breakpoints, e.g. 100000:10000,500000:25000,1000000:50000. Bins at least distance (bp) from the TSS bin are averaged into bins of binsize (bp). See hic_pyramid.py")
 
     parser.add_argument('--overwrite', action="store_true", help="force overwriting files")
-
-    return parser.parse_args()
+    parser.add_argument('--processes', type=int, default=1, help="Write bedgraphs in this many worker processes. Each chromosome's matrix is loaded once and shared with the workers through shared memory")
+    memory_profile.add_argument(parser)
+
+    args = parser.parse_args()
+    args.levels = parse_levels(args.levels, args.resolution) if args.levels else []
+    return args
+
+
+def get_bedgraph_filename(outdir, gene):
+    return os.path.join(outdir, "{}_{}_{}.bg.gz".format(gene['name'] or "UNK", gene.chr, int(gene.tss)))
+
+def write_gene_bedgraph(hic_row, gene, filename, resolution, window, levels=()):
+    #Include all values within window of the tss. This will facilitate interpolating NaNs
+    values = [(gene.chr, idx * resolution,
+           (idx + 1) * resolution,
+           hic_row[0, idx]) for idx in range(hic_row.A.shape[1]) if abs(idx * resolution - int(gene.tss)) < window]
+
+    #interpolate the nan's. Sometimes there may be nan's at the beginning/end of the vector - set to 0
+    #note this is only interpreting the nan's: missing data due to low kr norm value. This is not interpolating 0's in HiC
+    df2 = pandas.DataFrame.from_records(values).interpolate().fillna(value=0)
+    df2 = aggregate_bedgraph(df2, gene.tss, resolution, levels)
+    df2.to_csv(filename,
+          sep='\t', compression='gzip',
+          header=False, index=False)
+
+    print("Completed {} on {}".format(gene['name'], gene.chr))
+
+def write_bedgraph_block(matrix_handle, shape, genes, outdir, resolution, window, levels=()):
+    #Worker: bedgraphs for genes of one chromosome, from the normalized matrix in shared memory
+    shared = SharedArrays.attach(matrix_handle)
+    try:
+        hicdata = attach_csr_matrix(shared, shape)
+        norms = shared['norms'] if 'norms' in shared.arrays else None
+        for idx, gene in genes.iterrows():
+            hic_row = get_row(hicdata, norms, gene.tss, resolution)
+            write_gene_bedgraph(hic_row, gene, get_bedgraph_filename(outdir, gene), resolution, window, levels)
+    finally:
+        shared.close()
+
+def write_bedgraphs_with_processes(hic_data, genes, args):
+    #One chromosome at a time: its normalized matrix is loaded once, published to shared memory,
+    #and blocks of its genes are written by the workers, which attach to it without copying
+    with ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+        for chr, chr_genes in genes.groupby('chr', sort=False):
+            with memory_profile.stage("write_bedgraphs", chr):
+                hicdata, norms = hic_data.matrix(chr)
+                shared, shape = share_csr_matrix(hicdata.tocsr(), extra={'norms': norms} if norms is not None else None)
+                try:
+                    bounds = np.round(np.linspace(0, len(chr_genes), min(len(chr_genes), 4 * args.processes) + 1)).astype(int)
+                    futures = [pool.submit(write_bedgraph_block, shared.handle, shape, chr_genes.iloc[lo:hi], args.outdir, args.resolution, args.window, args.levels)
+                               for lo, hi in zip(bounds[:-1], bounds[1:])]
+                    #All blocks finish before the matrix is unlinked, even if one fails
+                    wait(futures)
+                    for future in futures:
+                        future.result()
+                finally:
+                    shared.close()
 
 
 if __name__ == '__main__':
     args = parseargs()
-
-    def match_files(*subdirs):
-        return glob.glob(os.path.join(args.hic_dir, *subdirs))
+    memory_profile.start(__file__, args.memory_profile)
 
     #Read genes
     genes_bed = read_bed(args.genes) 
     genes = process_gene_bed(genes_bed, args.gene_name_annotations, args.primary_gene_identifier)
 
     #Get raw hic and normalization files
-    resolution = '{}kb'.format(args.resolution // 1000)
-    hic_files = {}
-    for chr in set(genes['chr']):
-        possible_files = match_files('{}'.format(chr), '{}_{}.RAWobserved'.format(chr, resolution))
-        possible_norms = match_files('{}'.format(chr), '{}_{}.KRnorm'.format(chr, resolution))
-
-        if possible_files:
-            hic_files['{}'.format(chr)] = (possible_files[0], possible_norms[0])
+    hic_files = find_hic_files(args.hic_dir, args.resolution, set(genes['chr']))
 
     # create data accessor
     hic_data = HiC(hic_files, window=args.window, resolution=args.resolution, kr_cutoff=args.kr_cutoff)
@@ -56,34 +108,32 @@ if __name__ == '__main__':
 
     #Make a bedgraph per gene
     skipped = []
-    for idx, gene in genes.iterrows():
-        if gene.chr not in hic_data.chromosomes():
-            print("No HiC data for {} on {}".format(gene['name'], gene.chr))
-            continue
-        filename = os.path.join(args.outdir,
-                        "{}_{}_{}.bg.gz".format(gene['name'] or "UNK", gene.chr, int(gene.tss)))
-
-        if not args.overwrite:
-            if os.path.exists(filename):
-                skipped.append(gene['name'])
-                print("Skipping {} on {} with tss {} since it already has hic data and --overwrite flag is not set".format(gene['name'], gene.chr, gene.tss))
+    to_write = []
+    queued = set()
+    with memory_profile.stage("write_bedgraphs"):
+        for idx, gene in genes.iterrows():
+            if gene.chr not in hic_data.chromosomes():
+                print("No HiC data for {} on {}".format(gene['name'], gene.chr))
+                continue
+            filename = get_bedgraph_filename(args.outdir, gene)
+
+            if not args.overwrite:
+                if os.path.exists(filename) or filename in queued:
+                    skipped.append(gene['name'])
+                    print("Skipping {} on {} with tss {} since it already has hic data and --overwrite flag is not set".format(gene['name'], gene.chr, gene.tss))
+                    continue
+
+            if args.processes > 1:
+                #Written later by the workers; a later gene with the same file is skipped as in a sequential run
+                to_write.append(idx)
+                queued.add(filename)
                 continue
 
-        hic_row = hic_data.row(gene.chr, gene.tss)
-
-        #Include all values within args.window of the tss. This will facilitate interpolating NaNs
-        values = [(gene.chr, idx * args.resolution,
-               (idx + 1) * args.resolution,
-               hic_row[0, idx]) for idx in range(hic_row.A.shape[1]) if abs(idx * args.resolution - int(gene.tss)) < args.window]
-
-        #interpolate the nan's. Sometimes there may be nan's at the beginning/end of the vector - set to 0
-        #note this is only interpreting the nan's: missing data due to low kr norm value. This is not interpolating 0's in HiC
-        df2 = pandas.DataFrame.from_records(values).interpolate().fillna(value=0)
-        df2.to_csv(filename,
-              sep='\t', compression='gzip',
-              header=False, index=False)
+            hic_row = hic_data.row(gene.chr, gene.tss)
+            write_gene_bedgraph(hic_row, gene, filename, args.resolution, args.window, args.levels)
 
-        print("Completed {} on {}".format(gene['name'], gene.chr))
+    if len(to_write) > 0:
+        write_bedgraphs_with_processes(hic_data, genes.loc[to_write], args)
 
     if len(skipped) > 0:
         print("Skipped {} genes because they already have HiC files".format(len(skipped)))
@@ -0,0 +1,218 @@
+import argparse
+import atexit
+import glob
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+import numpy as np
+import pandas as pd
+
+# Opt-in memory profiling for the pipeline scripts, used to size job memory requests and find allocation hot spots.
+#
+# Enabled with --memory_profile DIR on an entry point, or by setting ABC_MEMORY_PROFILE=DIR (scripts started by
+# run_pipeline.py inherit it). When enabled, each named stage (stage("hic_to_sparse", chr), ...) records:
+#   peak RSS during the stage (VmHWM, reset at the start of each stage where /proc/self/clear_refs allows it),
+#   peak and retained memory traced by tracemalloc, and the source lines holding the most new memory at its end.
+# Each process writes DIR/{script}.{pid}.memory.txt (one row per stage, plus the whole process) and
+# DIR/{script}.{pid}.allocations.txt at exit. Worker processes are not profiled; their peak is in the children_peak_rss_mb
+# of the process row. `python memory_profile.py DIR` writes DIR/memory_summary.txt with the largest peak per script and stage.
+#
+# When disabled, stage() returns a no-op context manager and nothing is traced. When enabled, allocation heavy python code
+# runs up to a few times slower, and each stage takes two snapshots of all traced blocks. RSS includes the memory
+# tracemalloc uses for its traces (profiler_mb), which the suggested memory request leaves out.
+# Stages are only recorded from the main thread; nested stages count towards the peak of the enclosing stage.
+
+PROFILE_ENV = "ABC_MEMORY_PROFILE"
+TOP_ALLOCATIONS = 10
+profiler = None
+
+def add_argument(parser):
+    parser.add_argument('--memory_profile', default=None, help="Directory to write a per stage peak memory and allocation report to. Defaults to $" + PROFILE_ENV + " if set")
+
+def start(script, directory=None):
+    # Start profiling this process if a directory is given or set in the environment
+    global profiler
+    directory = directory or os.environ.get(PROFILE_ENV)
+    if not directory or profiler is not None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    os.environ[PROFILE_ENV] = os.path.abspath(directory)
+    profiler = MemoryProfiler(os.path.splitext(os.path.basename(script))[0], directory)
+    atexit.register(profiler.write)
+
+def stage(name, detail=""):
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name, detail)
+
+
+def read_status_mb(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def current_rss_mb():
+    return read_status_mb("VmRSS")
+
+def peak_rss_mb():
+    peak = read_status_mb("VmHWM")
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak
+
+def reset_peak_rss():
+    # Resets VmHWM to the current RSS (linux >= 4.0). Returns False if not possible
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class MemoryProfiler(object):
+    def __init__(self, script, directory):
+        self.script = script
+        self.directory = directory
+        self.start_time = time.time()
+        self.rows = []
+        self.allocations = []
+        self.stack = []
+        tracemalloc.start()
+        #Allocations of the profiler itself are left out of the report
+        self.excluded = (tracemalloc.__file__, __file__, "<frozen importlib._bootstrap")
+        self.resets_peak_rss = reset_peak_rss()
+        #tracemalloc.reset_peak is new in Python 3.9, see reset_traced_peak
+        self.resets_traced_peak = hasattr(tracemalloc, 'reset_peak')
+
+    @contextmanager
+    def stage(self, name, detail):
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        #Peaks reached so far in the enclosing stage are kept before the counters are reset for this one
+        if self.stack:
+            self.update_peaks(self.stack[-1], tracemalloc.get_traced_memory()[1], peak_rss_mb())
+        current = {'lines': self.traced_lines(), 'traced_peak': 0, 'peak_rss': 0}
+        current['rss'] = current_rss_mb()
+        current['start'] = time.time()
+        self.reset_traced_peak(current)
+        if self.resets_peak_rss:
+            reset_peak_rss()
+        self.stack.append(current)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            seconds = time.time() - current['start']
+            traced, traced_peak = tracemalloc.get_traced_memory()
+            self.update_peaks(current, traced_peak, peak_rss_mb())
+            rss_end = current_rss_mb()
+            lines = self.traced_lines()
+            self.rows.append({'stage': name, 'detail': detail,
+                              'seconds': round(seconds, 2),
+                              'rss_start_mb': round(current['rss'], 1), 'rss_end_mb': round(rss_end, 1),
+                              'peak_rss_mb': round(current['peak_rss'], 1),
+                              'traced_peak_mb': round(current['traced_peak'] / 2**20, 1), 'traced_end_mb': round(traced / 2**20, 1),
+                              'profiler_mb': round(tracemalloc.get_tracemalloc_memory() / 2**20, 1)})
+            self.add_allocations(name, detail, current['lines'], lines)
+            if self.stack:
+                self.update_peaks(self.stack[-1], current['traced_peak'], current['peak_rss'])
+
+    def reset_traced_peak(self, current):
+        #Without tracemalloc.reset_peak the peak is reset by restarting tracing, which forgets earlier allocations.
+        #The new stage and the enclosing ones then count lines and traced memory from the restart
+        if self.resets_traced_peak:
+            tracemalloc.reset_peak()
+            return
+        tracemalloc.stop()
+        tracemalloc.start()
+        for entry in self.stack + [current]:
+            entry['lines'] = {}
+
+    def update_peaks(self, entry, traced_peak, peak_rss):
+        entry['traced_peak'] = max(entry['traced_peak'], traced_peak)
+        entry['peak_rss'] = max(entry['peak_rss'], peak_rss)
+
+    def traced_lines(self):
+        #Traced memory by source line: {(filename, lineno): (size, count)}. Only these totals are kept through a stage, not the snapshot
+        return {(stat.traceback[0].filename, stat.traceback[0].lineno): (stat.size, stat.count)
+                for stat in tracemalloc.take_snapshot().statistics('lineno')}
+
+    def add_allocations(self, name, detail, before, after):
+        #Source lines holding the most new memory at the end of the stage
+        grown = []
+        for line, (size, count) in after.items():
+            size_before, count_before = before.get(line, (0, 0))
+            if size > size_before and not line[0].startswith(self.excluded):
+                grown.append((size - size_before, count - count_before, line))
+        grown = sorted(grown, reverse=True)[:TOP_ALLOCATIONS]
+        for rank, (size, count, (filename, lineno)) in enumerate(grown):
+            self.allocations.append({'stage': name, 'detail': detail, 'rank': rank + 1, 'size_mb': round(size / 2**20, 3),
+                                     'count': count, 'location': "{}:{}".format(filename, lineno)})
+
+    def write(self):
+        traced = tracemalloc.get_traced_memory()[0]
+        rows = self.rows + [{'stage': 'process', 'detail': " ".join(sys.argv[1:]),
+                             'seconds': round(time.time() - self.start_time, 2), 'rss_start_mb': None, 'rss_end_mb': round(current_rss_mb(), 1),
+                             'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                             'traced_peak_mb': None, 'traced_end_mb': round(traced / 2**20, 1),
+                             'profiler_mb': round(tracemalloc.get_tracemalloc_memory() / 2**20, 1),
+                             'children_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}]
+
+        prefix = os.path.join(self.directory, "{}.{}".format(self.script, os.getpid()))
+        with open(prefix + ".memory.txt", "w") as f:
+            f.write("# Memory profile of {} (pid {}). peak_rss_mb is {}{}\n".format(
+                self.script, os.getpid(), "the peak during the stage" if self.resets_peak_rss else "the process peak at the end of the stage (VmHWM could not be reset)",
+                "" if self.resets_traced_peak else ". traced_end_mb and allocations only count memory allocated since the last stage started (tracemalloc.reset_peak needs Python 3.9)"))
+            pd.DataFrame(rows).to_csv(f, sep="\t", index=False, na_rep="")
+        pd.DataFrame(self.allocations, columns=['stage', 'detail', 'rank', 'size_mb', 'count', 'location']).to_csv(prefix + ".allocations.txt", sep="\t", index=False)
+        #stderr, as some scripts write their results to stdout
+        print("Wrote memory profile to {}.memory.txt".format(prefix), file=sys.stderr)
+
+
+def summarize(directory, headroom=1.25):
+    # Largest peak of each script and stage over all reports in directory, with a suggested memory request for the script
+    reports = []
+    for filename in glob.glob(os.path.join(directory, "*.memory.txt")):
+        report = pd.read_csv(filename, sep="\t", comment="#")
+        #{script}.{pid}.memory.txt, where the script name may contain dots (run.neighborhoods)
+        report.insert(0, 'script', os.path.basename(filename)[:-len(".memory.txt")].rsplit(".", 1)[0])
+        reports.append(report)
+    if len(reports) == 0:
+        return None
+
+    reports = pd.concat(reports, ignore_index=True)
+    #The traces kept by tracemalloc are part of the measured RSS but not of an unprofiled run
+    reports['unprofiled_peak_rss_mb'] = (reports['peak_rss_mb'] - reports['profiler_mb']).round(1)
+    summary = reports.groupby(['script', 'stage'], sort=False).agg(runs=('peak_rss_mb', 'size'), peak_rss_mb=('peak_rss_mb', 'max'),
+                                                                     unprofiled_peak_rss_mb=('unprofiled_peak_rss_mb', 'max'),
+                                                                     traced_peak_mb=('traced_peak_mb', 'max'), seconds=('seconds', 'max'),
+                                                                     children_peak_rss_mb=('children_peak_rss_mb', 'max')).reset_index()
+    #Memory request for a job running the script without profiling (worker processes not included)
+    is_process = summary['stage'] == 'process'
+    summary.loc[is_process, 'suggested_memory_gb'] = np.ceil(summary.loc[is_process, 'unprofiled_peak_rss_mb'] * headroom / 1024 * 10) / 10
+    outfile = os.path.join(directory, "memory_summary.txt")
+    summary.to_csv(outfile, sep="\t", index=False, na_rep="")
+    return outfile
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize memory profiles written with --memory_profile')
+    parser.add_argument('directory', help="Directory given to --memory_profile")
+    parser.add_argument('--headroom', type=float, default=1.25, help="Suggested memory request is the peak RSS times this")
+    args = parser.parse_args()
+    outfile = summarize(args.directory, args.headroom)
+    print("Wrote {}".format(outfile) if outfile else "No memory profiles found in {}".format(args.directory))
+
+if __name__ == '__main__':
+    main()
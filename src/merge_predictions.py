@@ -0,0 +1,151 @@
+import argparse
+import gzip
+import memory_profile
+import os
+import re
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from query_predictions import merge_indexed_predictions
+from predict import get_shard_outdir
+from tools import atomic_write
+
+# Combines the partial outputs of predict.py --shard i/N runs (in outdir/shards/i) into the outputs of a single run in outdir.
+# Shards are consecutive blocks of the gene list, so tables are concatenated in shard order with one header.
+# Every shard must have finished (outdir/shards/i/shard.complete) before anything is merged.
+#
+# On a cluster, submit one predict.py --shard i/N job per node and run this script once they are done.
+# --launch_local N runs the N shards as local processes first, which is a stand-in for the cluster:
+#   python merge_predictions.py --outdir $PREDDIR --launch_local 4 -- --cellType K562 --nbhd_directory ... --threshold .022
+
+TABLES = ['EnhancerPredictions.txt', 'GenePredictionStats.txt']
+HEADERLESS = ['FailedGenes.txt', 'Predictions_nopromoters.bedpe']
+ALL_PUTATIVE = 'EnhancerPredictionsAllPutative.txt.gz'
+INDEXED = ['EnhancerPredictions.txt.gz', ALL_PUTATIVE]
+
+def parseargs():
+    parser = argparse.ArgumentParser(description='Merge sharded predict.py outputs',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--outdir', required=True, help="predict.py output directory. May contain {cellType}")
+    parser.add_argument('--cellTypes', default="", help="Comma delimited list of cell types, when outdir contains {cellType}")
+    parser.add_argument('--shards', type=int, default=None, help="Expected number of shards. Defaults to the N recorded by the shards")
+    parser.add_argument('--launch_local', type=int, default=0, help="First run predict.py with this many shards as local processes. Arguments after -- are passed to predict.py")
+    parser.add_argument('--remove_shards', action="store_true", help="Remove outdir/shards after merging")
+    memory_profile.add_argument(parser)
+    args, predict_args = parser.parse_known_args()
+    if predict_args and predict_args[0] == "--":
+        predict_args = predict_args[1:]
+    if predict_args and not args.launch_local:
+        parser.error("unrecognized arguments: {}".format(" ".join(predict_args)))
+    return args, predict_args
+
+
+def launch_local_shards(args, predict_args):
+    count = args.launch_local
+    predict_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "predict.py")
+    command = [sys.executable, predict_script] + predict_args + ['--outdir', args.outdir]
+    if args.cellTypes:
+        command += ['--cellTypes', args.cellTypes]
+
+    #Logs go next to the shard outputs (of the first cell type)
+    first_outdir = args.outdir.format(cellType=args.cellTypes.split(",")[0]) if args.cellTypes else args.outdir
+
+    def run_shard(index):
+        log = os.path.join(get_shard_outdir(first_outdir, index), "predict.log")
+        os.makedirs(os.path.dirname(log), exist_ok=True)
+        with open(log, 'w') as logfile:
+            returncode = subprocess.call(command + ['--shard', "{}/{}".format(index, count)], stdout=logfile, stderr=subprocess.STDOUT)
+        print("Shard {}/{} finished with exit code {}. Log: {}".format(index, count, returncode, log))
+        return returncode
+
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        returncodes = list(pool.map(run_shard, range(count)))
+    if any(returncodes):
+        raise RuntimeError("predict.py failed for shards {}".format([i for i, code in enumerate(returncodes) if code]))
+
+
+def find_shards(outdir, expected=None):
+    #Shard directories in order. All shards 0..N-1 must be complete and agree on N
+    shards_dir = os.path.join(outdir, "shards")
+    counts = set()
+    complete = {}
+    for name in os.listdir(shards_dir) if os.path.isdir(shards_dir) else []:
+        marker = os.path.join(shards_dir, name, "shard.complete")
+        if os.path.exists(marker):
+            with open(marker) as f:
+                index, count = [int(x) for x in f.read().strip().split("/")]
+            complete[index] = os.path.join(shards_dir, name)
+            counts.add(count)
+
+    if len(counts) > 1:
+        raise ValueError("Shards in {} were run with different shard counts: {}".format(shards_dir, sorted(counts)))
+    count = expected if expected is not None else (counts.pop() if counts else 0)
+    missing = [i for i in range(count) if i not in complete]
+    if count == 0 or missing:
+        raise ValueError("Shards {} of {} in {} are missing or incomplete".format(missing or "all", count or "?", shards_dir))
+    return [get_shard_outdir(outdir, i) for i in range(count)]
+
+def merge_text(filenames, outfile, header, opener=open):
+    #Concatenate files, keeping the first header. Missing files (shards without predictions) are skipped
+    existing = [f for f in filenames if os.path.exists(f)]
+    if not existing:
+        return False
+    with atomic_write(outfile) as tmp:
+        with opener(tmp, 'wt') as out:
+            wrote_header = False
+            for filename in existing:
+                with opener(filename, 'rt') as f:
+                    if header:
+                        first = f.readline()
+                        if not wrote_header:
+                            out.write(first)
+                            wrote_header = True
+                    shutil.copyfileobj(f, out)
+    return True
+
+def merge_shards(outdir, shard_dirs):
+    print("Merging {} shards into {}".format(len(shard_dirs), outdir))
+    for name in TABLES:
+        merge_text([os.path.join(d, name) for d in shard_dirs], os.path.join(outdir, name), header=True)
+    for name in HEADERLESS:
+        merge_text([os.path.join(d, name) for d in shard_dirs], os.path.join(outdir, name), header=False)
+
+    for name in INDEXED:
+        shard_files = [os.path.join(d, name) for d in shard_dirs if os.path.exists(os.path.join(d, name))]
+        if shard_files and os.path.exists(shard_files[0] + ".tbi"):
+            merge_indexed_predictions(shard_files, os.path.join(outdir, name))
+        elif name == ALL_PUTATIVE:
+            merge_text(shard_files, os.path.join(outdir, name), header=True, opener=gzip.open)
+
+    write_merged_params(os.path.join(shard_dirs[0], "parameters.predict.txt"), os.path.join(outdir, "parameters.predict.txt"))
+
+def write_merged_params(shard_params, outfile):
+    #The parameters of shard 0 without --shard and --shard_by, which are the only ones that differ between shards
+    #(see predict.write_prediction_params for the format), so they describe the merged run
+    with open(shard_params) as f:
+        params = f.read()
+    params = re.sub(r"--shard(_by)? \S* ", "", params)
+    with atomic_write(outfile) as tmp:
+        with open(tmp, 'w') as out:
+            out.write(params)
+
+
+def main():
+    args, predict_args = parseargs()
+    memory_profile.start(__file__, args.memory_profile)
+    if args.launch_local:
+        launch_local_shards(args, predict_args)
+        if args.shards is None:
+            args.shards = args.launch_local
+
+    cell_types = args.cellTypes.split(",") if args.cellTypes else [None]
+    for cellType in cell_types:
+        outdir = args.outdir.format(cellType=cellType) if cellType else args.outdir
+        with memory_profile.stage("merge_shards", cellType or ""):
+            merge_shards(outdir, find_shards(outdir, args.shards))
+        if args.remove_shards:
+            shutil.rmtree(os.path.join(outdir, "shards"))
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,15 @@ import numpy as np
 import os
 import os.path
 from subprocess import check_call, check_output, PIPE, Popen, getoutput, CalledProcessError
-from intervaltree import IntervalTree
 from pyBigWig import open as open_bigwig
-# import pysam
+from concurrent.futures import ProcessPoolExecutor
+import pysam
 from tools import *
+from memory_profile import stage
 import linecache
+import gzip
+import queue
+import threading
 import traceback
 import time
 
@@ -23,8 +27,8 @@ def load_genes(file,
     bed = read_bed(file) 
     genes = process_gene_bed(bed, gene_id_names, primary_id)
 
-    genes[['chr', 'start', 'end', 'name', 'score', 'strand']].to_csv(os.path.join(outdir, "GeneList.bed"),
-                                                                    sep='\t', index=False, header=False)
+    write_table_if_changed(genes[['chr', 'start', 'end', 'name', 'score', 'strand']], os.path.join(outdir, "GeneList.bed"),
+                           sep='\t', index=False, header=False)
 
     if len(expression_table_list) > 0:
         # # Add expression information
@@ -64,6 +68,10 @@ def annotate_genes_with_features(genes, genome,
                features={},
                outdir=".",
                force=False,
+               threads=1,
+               count_jobs=1,
+               cache_dir=None,
+               compact=False,
                **kwargs):
 
     #file = genome['genes']
@@ -72,11 +80,7 @@ def annotate_genes_with_features(genes, genome,
     #tss1kb_file = file + '.TSS1kb.bed'
 
     #Make bed file with TSS +/- 500bp
-    tss1kb = genes.ix[:,['chr','start','end','name','score','strand']]
-    tss1kb['start'] = genes['tss'] - 500
-    tss1kb['end'] = genes['tss'] + 500
-    tss1kb_file = os.path.join(outdir, "GeneList.TSS1kb.bed")
-    tss1kb.to_csv(tss1kb_file, header=False, index=False, sep='\t')
+    tss1kb, tss1kb_file = write_tss1kb_bed(genes, outdir)
     
     # if not os.path.isfile(tss1kb_file):
     #     tss1kb = genes.ix[:,['chr','start','end','symbol','score','strand']]
@@ -86,8 +90,8 @@ def annotate_genes_with_features(genes, genome,
     # else:
     #     tss1kb = read_bed(tss1kb_file)
 
-    genes = count_features_for_bed(genes, bounds_bed, genome_sizes, features, outdir, "Genes", force=force)
-    tsscounts = count_features_for_bed(tss1kb, tss1kb_file, genome_sizes, features, outdir, "Genes.TSS1kb", force=force)
+    genes = count_features_for_bed(genes, bounds_bed, genome_sizes, features, outdir, "Genes", force=force, threads=threads, count_jobs=count_jobs, cache_dir=cache_dir, compact=compact)
+    tsscounts = count_features_for_bed(tss1kb, tss1kb_file, genome_sizes, features, outdir, "Genes.TSS1kb", force=force, threads=threads, count_jobs=count_jobs, cache_dir=cache_dir, compact=compact)
     tsscounts = tsscounts.drop(['chr','start','end','score','strand'], axis=1)
 
     # import pdb
@@ -99,6 +103,14 @@ def annotate_genes_with_features(genes, genome,
     merged['PromoterActivityQuantile'] = ((0.0001+merged['H3K27ac.RPKM.quantile.TSS1Kb'])*(0.0001+merged[access_col])).rank(method='average', na_option="top", ascending=True, pct=True)
     return merged
 
+def write_tss1kb_bed(genes, outdir):
+    tss1kb = genes.ix[:,['chr','start','end','name','score','strand']]
+    tss1kb['start'] = genes['tss'] - 500
+    tss1kb['end'] = genes['tss'] + 500
+    tss1kb_file = os.path.join(outdir, "GeneList.TSS1kb.bed")
+    write_table_if_changed(tss1kb, tss1kb_file, header=False, index=False, sep='\t')
+    return tss1kb, tss1kb_file
+
 def process_gene_bed(bed, name_cols, main_name):
 
     try:
@@ -148,12 +160,18 @@ def load_enhancers(outdir=".",
                    cellType="",
                    additional_gene_annot=None,
                    tss_slop_for_class_assignment = 500,
+                   threads=1,
+                   count_jobs=1,
+                   cache_dir=None,
+                   compact=False,
                    **kwargs):
 
     enhancers = read_bed(candidate_peaks)
     enhancers = enhancers.ix[~ (enhancers.chr.str.contains(re.compile('random|chrM|_|hap|Un')))]
+    if compact:
+        enhancers = compact_dtypes(enhancers)
 
-    enhancers = count_features_for_bed(enhancers, candidate_peaks, genome_sizes, features, outdir, "Enhancers", skip_rpkm_quantile, force)
+    enhancers = count_features_for_bed(enhancers, candidate_peaks, genome_sizes, features, outdir, "Enhancers", skip_rpkm_quantile, force, threads, count_jobs, cache_dir, compact)
 
     #compute custom features
     # if compute_custom_features:
@@ -177,212 +195,382 @@ def load_enhancers(outdir=".",
 #     pass
 
 def assign_enhancer_classes(enhancers, genes, tss_slop=500):
-    # build interval trees
-    tss_intervals = {}
-    gene_intervals = {}
-    for chr, chrdata in genes.groupby('chr'):
-        tss_intervals[chr] = IntervalTree.from_tuples(zip(chrdata.tss - tss_slop, chrdata.tss + tss_slop,
-                                                          [str(x) for x in chrdata.symbol]))
-        gene_intervals[chr] = IntervalTree.from_tuples(zip(chrdata.start, chrdata.end))
-
-    # if additional_tss is not None:
-    #     additional = pd.read_csv(additional_tss, sep="\t")
-    #     additional = additional.loc[additional['cellType'] == cellType, :] 
-
-    #     for idx, row in additional.iterrows():
-    #         tss_intervals[row['chr']].addi(row['tss'] - tss_slop, row['tss'] + tss_slop, row['tss_name'])
-
-    def get_class(enhancer):
-        start, end = sorted((enhancer.start, enhancer.end))
-        if tss_intervals[enhancer.chr][start:end]:
-            return "promoter"
-        if gene_intervals[enhancer.chr][start:end]:
-            return "genic"
-        return "intergenic"
-
-    def get_tss_symbol(enhancer):
-        #For candidate regions that overlap gene promoters, annotate enhancers data table with the name of the gene.
-        if enhancer["class"] == "promoter":
-            start, end = sorted((enhancer.start, enhancer.end))
-            overlaps = tss_intervals[enhancer.chr][start:end]
-            return ",".join(list(set([o[2] for o in overlaps])))
-        return ""
-
-    enhancers["class"] = enhancers.apply(get_class, axis=1)
+    #An element is a promoter if it overlaps a gene TSS +/- tss_slop, genic if it overlaps a gene body and intergenic otherwise.
+    #Overlaps are found per chromosome with sorted interval arrays and searchsorted
+    starts = np.minimum(enhancers.start.values, enhancers.end.values)
+    ends = np.maximum(enhancers.start.values, enhancers.end.values)
+    enhancer_chrs = enhancers['chr'].astype(str).values
+    gene_chrs = genes['chr'].astype(str).values
+
+    is_promoter = np.zeros(len(enhancers), dtype=bool)
+    is_genic = np.zeros(len(enhancers), dtype=bool)
+    symbol_pairs = []
+    for chr in np.unique(enhancer_chrs):
+        idx = np.flatnonzero((enhancer_chrs == chr) & (starts < ends))
+        chrdata = genes.loc[gene_chrs == chr]
+        if len(idx) == 0 or len(chrdata) == 0:
+            continue
+
+        #TSS windows all have the same width, so the windows overlapping [start, end) are a contiguous
+        #range of the windows sorted by their start
+        tss_order = np.argsort(chrdata.tss.values, kind='mergesort')
+        tss_starts = chrdata.tss.values[tss_order] - tss_slop
+        tss_symbols = chrdata.symbol.astype(str).values[tss_order]
+        lo = np.searchsorted(tss_starts, starts[idx] - 2 * tss_slop, side='right')
+        hi = np.searchsorted(tss_starts, ends[idx], side='left')
+        n_overlaps = np.maximum(hi - lo, 0)
+        is_promoter[idx] = n_overlaps > 0
+
+        #one (element, symbol) row per overlapping TSS
+        offsets = np.arange(n_overlaps.sum()) - np.repeat(np.cumsum(n_overlaps) - n_overlaps, n_overlaps)
+        symbol_pairs.append(pd.DataFrame({'idx' : np.repeat(idx, n_overlaps),
+                                          'symbol' : tss_symbols[np.repeat(lo, n_overlaps) + offsets]}))
+
+        is_genic[idx] = overlaps_any(starts[idx], ends[idx], chrdata.start.values, chrdata.end.values)
+
+    enhancers["class"] = np.where(is_promoter, "promoter", np.where(is_genic, "genic", "intergenic"))
     enhancers["isPromoterElement"] = enhancers["class"] == "promoter"
     enhancers["isGenicElement"] = enhancers["class"] == "genic"
     enhancers["isIntergenicElement"] = enhancers["class"] == "intergenic"
-    enhancers["enhancerSymbol"] = enhancers.apply(get_tss_symbol, axis=1)
+
+    #For candidate regions that overlap gene promoters, annotate enhancers data table with the name of the gene.
+    symbols = np.full(len(enhancers), "", dtype=object)
+    if len(symbol_pairs) > 0:
+        symbol_pairs = pd.concat(symbol_pairs).drop_duplicates()
+        joined = symbol_pairs.groupby('idx', sort=False)['symbol'].agg(",".join)
+        symbols[joined.index.values] = joined.values
+    enhancers["enhancerSymbol"] = symbols
     assert (enhancers.enhancerSymbol == "\n").sum() == 0
-    enhancers["name"] = enhancers.apply(lambda e: "{}|{}:{}-{}".format(e["class"], e.chr, e.start, e.end), axis=1)
+
+    enhancers["name"] = enhancers["class"] + "|" + enhancers.chr.astype(str) + ":" + enhancers.start.astype(str) + "-" + enhancers.end.astype(str)
     return(enhancers)
 
-def run_count_reads(target, output, bed_file, genome_sizes):
+def run_count_reads(target, output, bed_file, genome_sizes, threads=1):
+    run_count_reads_multi(target, [output], [bed_file], genome_sizes, threads)
+
+
+def run_count_reads_multi(target, outputs, bed_files, genome_sizes, threads=1):
+    #Count target against several region sets while reading it only once.
+    #The region sets are merged into one sorted index of unique regions, counted in a single sweep,
+    #and the counts are then written back out to one CountReads file per region set.
+    region_sets = [read_regions(bed_file) for bed_file in bed_files]
+    merged = pd.concat(region_sets).drop_duplicates().sort_values(['chr', 'start', 'end']).reset_index(drop=True)
+    merged['count'] = count_reads_in_regions(target, merged, genome_sizes, threads)
+
+    for regions, output in zip(region_sets, outputs):
+        write_count_reads(regions.merge(merged, how='left', on=['chr', 'start', 'end']), output, genome_sizes)
+
+
+def count_reads_in_regions(target, regions, genome_sizes, threads=1):
+    #Returns one count per row of regions (chr, start, end)
     if target.endswith(".bam"):
-        count_bam(target, bed_file, output, genome_sizes=genome_sizes)
+        return count_bam(target, regions, threads)
     elif target.endswith(".tagAlign.gz") or target.endswith(".tagAlign.bgz"):
-        count_tagalign(target, bed_file, output, genome_sizes)
+        return count_tagalign(target, regions, threads)
     elif isBigWigFile(target):
-        count_bigwig(target, bed_file, output)
+        return count_bigwig(target, regions)
     else:
         raise ValueError("File {} name was not in .bam, .tagAlign.gz, .bw".format(target))
 
 
-def count_bam(bamfile, bed_file, output, genome_sizes, use_java=False, use_fast_count=True):
-    completed = True
-    if not use_java:        
-        #Fast count:
-        #bamtobed uses a lot of memory. Instead reorder bed file to match ordering of bam file. Assumed .bam file is sorted in the chromosome order defined by its header.
-        #Then use bedtools coverage, then sort back to expected order
-        #Requires an faidx file with chr in the same order as the bam file.
-        if use_fast_count:
-            temp_output = output + ".temp_sort_order"
-            faidx_command = reuse(".samtools-0.1.19") + "awk 'FNR==NR {{x2[$1] = $0; next}} $1 in x2 {{print x2[$1]}}' {genome_sizes} <(samtools view -H {bamfile} | grep SQ | cut -f 2 | cut -c 4- )  > {temp_output}".format(**locals())
-            command = reuse(".bedtools-2.26.0") + "bedtools sort -faidx {temp_output} -i {bed_file} | bedtools coverage -g {temp_output} -counts -sorted -a stdin -b {bamfile} | awk '{{print $1 \"\\t\" $2 \"\\t\" $3 \"\\t\" $NF}}'  | bedtools sort -faidx {genome_sizes} -i stdin > {output}; rm {temp_output}".format(**locals())
-
-            #executable='/bin/bash' needed to parse < redirect in faidx_command
-            p = Popen(faidx_command, stdout=PIPE, stderr=PIPE, shell=True, executable='/bin/bash')
-            print("Running: " + faidx_command)
-            (stdoutdata, stderrdata) = p.communicate()
-            err = str(stderrdata, 'utf-8')
-
-            p = Popen(command, stdout=PIPE, stderr=PIPE, shell=True)
-            print("Running: " + command)
-            (stdoutdata, stderrdata) = p.communicate()
-            err = str(stderrdata, 'utf-8')
+def read_regions(bed_file):
+    #chr, start, end of a bed file in file order. Unlike read_bed, chromosomes outside the default list are kept as is
+    skip = 1 if ("track" in open(bed_file, "r").readline()) else 0
+    return pd.read_table(bed_file, header=None, usecols=[0, 1, 2], names=['chr', 'start', 'end'],
+                         skiprows=skip, comment='#', dtype={'chr': str})
+
+
+def write_count_reads(regions, output, genome_sizes):
+    #Write chr, start, end, count sorted in the chromosome order of genome_sizes (the order bedtools sort -faidx used to produce).
+    #Written to a temporary file and renamed, so a failed count never leaves a partial CountReads file behind
+    chrom_order = {chr: i for i, chr in enumerate(read_genome_sizes(genome_sizes)['chr'])}
+    regions = regions.assign(chrom_order=regions['chr'].map(chrom_order).fillna(len(chrom_order)))
+    regions = regions.sort_values(['chrom_order', 'start', 'end'])
+    with atomic_write(output) as tmp:
+        regions[['chr', 'start', 'end', 'count']].to_csv(tmp, sep='\t', header=False, index=False)
+
+
+def count_overlaps(region_starts, region_ends, read_starts, read_ends):
+    #Number of reads overlapping each region by at least 1bp (the rule used by bedtools coverage -counts).
+    #reads starting before the region end, minus those that also end before the region start
+    read_starts = np.sort(read_starts)
+    read_ends = np.sort(read_ends)
+    return np.searchsorted(read_starts, region_ends, side='left') - np.searchsorted(read_ends, region_starts, side='right')
+
+
+def count_by_chromosome(count_chromosome, target, regions, threads=1):
+    #Run count_chromosome(target, chr, starts, ends) for each chromosome in regions, in up to threads worker processes.
+    #count_chromosome must be a module level function returning one count per region. Worker errors are re-raised here.
+    counts = np.zeros(len(regions), dtype=np.int64)
+    chr_indices = regions.groupby('chr', sort=False).indices
+    starts = regions['start'].values
+    ends = regions['end'].values
+
+    if threads > 1:
+        with ProcessPoolExecutor(max_workers=threads) as pool:
+            futures = {chr: pool.submit(count_chromosome, target, chr, starts[idx], ends[idx]) for chr, idx in chr_indices.items()}
+            for chr, future in futures.items():
+                counts[chr_indices[chr]] = future.result()
+    else:
+        for chr, idx in chr_indices.items():
+            counts[idx] = count_chromosome(target, chr, starts[idx], ends[idx])
 
-            try:
-                data = pd.read_table(output, header=None).ix[:,3].values
-            except Exception as e:
-                print("Fast count method failed to count: " + str(bamfile) + "\n")
-                print(err)
-                print("Trying bamtobed method ...\n")
-                completed = False
-
-        # Replace Java with BEDTools: convert BAM to BED, filter to standard chromosomes, sort, then use the very fast bedtools coverage -sorted algorithm
-        # Note: This requires that bed_file is also sorted and in same chromosome order as genome_sizes (first do bedtools sort -i bed_file -faidx genome_sizes)
-        #         BEDTools will error out if files are not properly sorted
-        # Also requires that {genome_sizes} has a corresponding {genome_sizes}.bed file
-        if not use_fast_count or ("terminated"  in err) or ("Error" in err) or ("ERROR" in err) or not completed:
-            command = reuse(".bedtools-2.26.0") + "bedtools bamtobed -i {bamfile} | cut -f 1-3 | bedtools intersect -wa -a stdin -b {genome_sizes}.bed | bedtools sort -i stdin -faidx {genome_sizes} | bedtools coverage -g {genome_sizes} -counts -sorted -a {bed_file} -b stdin | awk '{{print $1 \"\\t\" $2 \"\\t\" $3 \"\\t\" $NF}}' > {output}".format(**locals())
-            p = Popen(command, stdout=PIPE, stderr=PIPE, shell=True)
-            print("Running: " + command)
-            (stdoutdata, stderrdata) = p.communicate()
+    return counts
 
-            try:
-                data = pd.read_table(output, header=None).ix[:,3].values
-            except Exception as e:
-                print(e)
-                print(stderrdata)
-                completed = False
-
-        # Check for successful finish -- BEDTools can run into memory problems
-        #import pdb; pdb.set_trace()
-        err = str(stderrdata, 'utf-8')
-        if ("terminated" not in err) and ("Error" not in err) and ("ERROR" not in err) and any(data):
-            print("BEDTools completed successfully. \n")
-            completed = True
-        else:
-            print("BEDTools failed to count file: " + str(bamfile) + "\n")
-            print(err)
-            print("Trying using Java method ...\n")
-            completed = False
-
-    # Slow JAVA counting
-    # if use_java or not completed:
-    #     print("Running Java method ...\n")
-    #     command = (reuse("Java-1.7") + \
-    #                 "java -Xmx8g -cp /seq/lincRNA/Jesse/bin/scripts/Nextgen_140308.jar broad.pda.seq.rap.CountReads "
-    #                 "TARGET={bamfile} OUTPUT={output}.tmp SCORE=count ANNOTATION_FILE={bed_file} MASK_FILE=null PAIRED_END=false "
-    #                 "VALIDATION_STRINGENCY=LENIENT SIZES={genome_sizes} MIN_MAPPING_QUALITY=0").format(**locals())
-    #     run_command(command)
-    #     # Convert output to bedgraph format (chr,start,end,score -- no header)
-    #     command2 = "cut -f 1-3,5 {output}.tmp | sed 's/\.0//' > {output}; rm {output}.tmp".format(**locals())
-    #     run_command(command2)
-
-
-
-def count_tagalign(tagalign, bed_file, output, genome_sizes):
-    # import pdb
-    # pdb.set_trace()
 
+def count_bam_chromosome(bamfile, chr, starts, ends, chunk_size=1000000):
+    #Count reads on one chromosome. Reads are collected in chunks so memory does not grow with chromosome depth
+    counts = np.zeros(len(starts), dtype=np.int64)
+    with pysam.AlignmentFile(bamfile, "rb") as bam:
+        if chr not in bam.references:
+            return counts
 
-    #JN 3/16/18, faster and more memory efficient. Dont subset original tag align file.
-    #JN 8/31/18: actually probably slower, but more memory efficient
-    # print("trying fast sorted method")
-    # fast_cmd = reuse(".bedtools-2.26.0") + "bedtools sort -faidx {genome_sizes} -i {tagalign}| bedtools coverage -counts -sorted -g {genome_sizes} -a {bed_file} -b stdin | awk '{{print $1 \"\\t\" $2 \"\\t\" $3 \"\\t\" $NF}}' > {output}".format(**locals())
+        read_starts, read_ends = [], []
+        for read in bam.fetch(chr, max(0, int(starts.min())), int(ends.max())):
+            if read.is_unmapped:
+                continue
+            read_starts.append(read.reference_start)
+            read_ends.append(read.reference_end)
+            if len(read_starts) == chunk_size:
+                counts += count_overlaps(starts, ends, np.array(read_starts), np.array(read_ends))
+                read_starts, read_ends = [], []
 
-    # p = Popen(fast_cmd, stdout=PIPE, stderr=PIPE, shell=True)
-    # print("Running: " + fast_cmd)
-    # (stdoutdata, stderrdata) = p.communicate()
-    # err = str(stderrdata, 'utf-8')
+        if read_starts:
+            counts += count_overlaps(starts, ends, np.array(read_starts), np.array(read_ends))
 
-    # if ("terminated" not in err) and ("Error" not in err) and ("ERROR" not in err):
-    #     print("Fast method ran successfully")
-    # else:
-    # print(err)
-    # print("Trying unsorted method")
-    command1 = reuse("Tabix") + "tabix -B {tagalign} {bed_file} | cut -f1-3".format(**locals())
-    command2 = reuse(".bedtools-2.26.0") + "bedtools coverage -counts -b stdin -a {bed_file} | awk '{{print $1 \"\\t\" $2 \"\\t\" $3 \"\\t\" $NF}}' ".format(**locals())
-    p1 = Popen(command1, stdout=PIPE, shell=True)
-    with open(output, "wb") as outfp:
-        p2 = check_call(command2, stdin=p1.stdout, stdout=outfp, shell=True)
-
-    if not p2 == 0:
-        print(p2.stderr)
-
-def count_bigwig(target, bed_file, output):
+    return counts
+
+
+def count_bam(bamfile, regions, threads=1):
+    #Count mapped reads overlapping each region using the BAM index. Chromosomes are counted in parallel.
+    #Raises on any failure rather than returning partial counts
+    with pysam.AlignmentFile(bamfile, "rb") as bam:
+        if not bam.has_index():
+            raise ValueError("BAM file {} is not indexed. Run samtools index first".format(bamfile))
+
+    return count_by_chromosome(count_bam_chromosome, bamfile, regions, threads)
+
+
+def count_tagalign_chromosome(tagalign, chr, starts, ends):
+    #Count reads on one chromosome of a tabix indexed tagAlign. Overlapping regions are grouped into blocks,
+    #reads are fetched once per block and counted against that block's regions only
+    counts = np.zeros(len(starts), dtype=np.int64)
+    with pysam.TabixFile(tagalign) as tbx:
+        if chr not in tbx.contigs:
+            return counts
+
+        order = np.argsort(starts, kind='mergesort')
+        sorted_starts = starts[order]
+        sorted_ends = ends[order]
+        block_ends = np.maximum.accumulate(sorted_ends)
+        new_block = np.concatenate(([True], sorted_starts[1:] > block_ends[:-1]))
+        bounds = np.append(np.flatnonzero(new_block), len(order))
+
+        for i, j in zip(bounds[:-1], bounds[1:]):
+            block_start = int(sorted_starts[i])
+            block_end = max(int(block_ends[j - 1]), block_start + 1)
+            reads = [line.split('\t', 3) for line in tbx.fetch(chr, block_start, block_end)]
+            if len(reads) == 0:
+                continue
+            read_starts = np.array([int(read[1]) for read in reads])
+            read_ends = np.array([int(read[2]) for read in reads])
+            counts[order[i:j]] = count_overlaps(sorted_starts[i:j], sorted_ends[i:j], read_starts, read_ends)
+
+    return counts
+
+
+def count_tagalign(tagalign, regions, threads=1):
+    #Count reads overlapping each region using the tabix index through pysam, one chromosome per worker.
+    #No tabix or bedtools binaries are needed
+    if not (os.path.exists(tagalign + ".tbi") or os.path.exists(tagalign + ".csi")):
+        raise ValueError("tagAlign file {} is not tabix indexed. Run tabix -p bed first".format(tagalign))
+
+    return count_by_chromosome(count_tagalign_chromosome, tagalign, regions, threads)
+
+
+def count_bigwig(target, regions):
+    #Total signal in each region: the mean over covered bases times the region length, as bw.stats(chr, start, end, "mean") * length.
+    #Regions are integrated against per-base values read in blocks (see BigWigSignal) rather than one stats call each
     bw = open_bigwig(target)
-    bed = read_bed(bed_file)
-    with open(output, "wb") as outfp:
-        for chr, start, end, *rest in bed.itertuples(index=False, name=None):
-            # if isinstance(name, np.float):
-            #     name = ""
-            try:
-                val = bw.stats(chr, int(start), int(max(end, start + 1)), "mean")[0] or 0
-            except RuntimeError:
-                print("Failed on", chr, start, end)
-                raise
-            val *= abs(end - start)  # convert to total coverage
-            output = ("\t".join([chr, str(start), str(end), str(val)]) + "\n").encode('ascii')
-            outfp.write(output)
+    chrom_sizes = bw.chroms()
+    counts = np.zeros(len(regions))
+    starts = regions['start'].values
+    ends = regions['end'].values
+
+    for chr, idx in regions.groupby('chr', sort=False).indices.items():
+        if chr not in chrom_sizes:
+            raise RuntimeError("Chromosome {} of regions is not in bigWig {}".format(chr, target))
+
+        signal = BigWigSignal(bw, chr)
+        region_starts = starts[idx]
+        region_ends = np.maximum(ends[idx], region_starts + 1)
+        total, covered = signal.integrate(region_starts, region_ends)
+        mean = np.divide(total, covered, out=np.zeros(len(idx)), where=covered > 0)
+        counts[idx] = mean * np.abs(ends[idx] - starts[idx])  # convert to total coverage
+
+    return counts
+
+
+class BigWigSignal(object):
+    #Signal of one bigWig chromosome over many regions. Regions are sorted and grouped into blocks spanning about
+    #block_size bp; the per-base values of each block are read with one bw.values call and the regions in it are
+    #integrated against cumulative sums. Memory is bounded by the block (or the largest region), not the chromosome,
+    #and stretches without regions are never read
+    def __init__(self, bw, chr, block_size=1000000):
+        self.bw = bw
+        self.chr = chr
+        self.length = bw.chroms(chr)
+        self.block_size = block_size
+
+    def integrate(self, starts, ends):
+        # total signal and number of covered bases in each [start, end)
+        starts = np.clip(np.asarray(starts, dtype=np.int64), 0, self.length)
+        ends = np.clip(np.asarray(ends, dtype=np.int64), starts, self.length)
+        total = np.zeros(len(starts))
+        covered = np.zeros(len(starts))
+
+        order = np.argsort(starts, kind='stable')
+        sorted_starts = starts[order]
+        i = 0
+        while i < len(order):
+            j = max(np.searchsorted(sorted_starts, sorted_starts[i] + self.block_size, side='left'), i + 1)
+            block = order[i:j]
+            block_start, block_end = sorted_starts[i], ends[block].max()
+            if block_end > block_start:
+                values = self.bw.values(self.chr, int(block_start), int(block_end), numpy=True)
+                is_covered = ~np.isnan(values)
+                cum_signal = np.concatenate(([0], np.cumsum(np.where(is_covered, values, 0), dtype=float)))
+                cum_covered = np.concatenate(([0], np.cumsum(is_covered)))
+                first, last = starts[block] - block_start, ends[block] - block_start
+                total[block] = cum_signal[last] - cum_signal[first]
+                covered[block] = cum_covered[last] - cum_covered[first]
+            i = j
+        return total, covered
 
 
 def isBigWigFile(filename):
     return(filename.endswith(".bw") or filename.endswith(".bigWig") or filename.endswith(".bigwig"))
 
-def count_features_for_bed(df, bed_file, genome_sizes, features, directory, filebase, skip_rpkm_quantile=False, force=False):
+def count_features_for_bed(df, bed_file, genome_sizes, features, directory, filebase, skip_rpkm_quantile=False, force=False, threads=1, count_jobs=1, cache_dir=None, compact=False):
+    #Count the feature files whose CountReads files are missing or out of date (concurrently, see count_features_for_region_sets),
+    #then add the counts to df one feature at a time in the order of features so the columns are the same as counting serially.
+    #After run.neighborhoods.py's single pass over all region sets this only loads the CountReads files
+    with stage("count_features", filebase):
+        count_features_for_region_sets({filebase: bed_file}, genome_sizes, features, directory, force, threads, count_jobs, cache_dir)
 
     for feature, feature_bam_list in features.items():
         start_time = time.time()
         if isinstance(feature_bam_list, str): 
             feature_bam_list = [feature_bam_list]
 
-        for feature_bam in feature_bam_list:
-            df = count_single_feature_for_bed(df, bed_file, genome_sizes, feature_bam, feature, directory, filebase, skip_rpkm_quantile, force)
+        with stage("merge_feature_counts", filebase + "." + feature):
+            for feature_bam in feature_bam_list:
+                df = count_single_feature_for_bed(df, bed_file, genome_sizes, feature_bam, feature, directory, filebase, skip_rpkm_quantile, False, threads, cache_dir, compact)
 
-        df = average_features(df, feature.replace('feature_',''), feature_bam_list, skip_rpkm_quantile)
+            df = average_features(df, feature.replace('feature_',''), feature_bam_list, skip_rpkm_quantile)
+            if compact:
+                df = compact_dtypes(df)
         elapsed_time = time.time() - start_time
         print("Feature " + feature + " completed in " + str(elapsed_time))
 
     return df
 
-def count_single_feature_for_bed(df, bed_file, genome_sizes, feature_bam, feature, directory, filebase, skip_rpkm_quantile, force):
+def count_features_for_region_sets(region_sets, genome_sizes, features, directory, force=False, threads=1, count_jobs=1, cache_dir=None):
+    #Count each feature file against all region sets in a single pass over the file.
+    #region_sets maps a filebase (eg "Genes", "Enhancers") to its bed file. The CountReads files are written to directory,
+    #where count_single_feature_for_bed picks them up.
+    #A CountReads file that is newer than its signal file and bed file (see needs_counting) is reused as is.
+    #With a cache directory (see get_cache_dir), counts are also cached (see CountReadsCache) by signal file, region set
+    #contents and counting mode, so the same file/regions pair is counted once per cache directory.
+    #One job per feature x replicate file; up to count_jobs jobs run at the same time in worker processes (each using up to threads processes)
+    counts_cache = CountReadsCache(cache_dir)
+    jobs = []
+    for feature, feature_bam_list in features.items():
+        if isinstance(feature_bam_list, str):
+            feature_bam_list = [feature_bam_list]
+
+        for feature_bam in feature_bam_list:
+            outputs, bed_files, keys = [], [], []
+            for filebase, bed_file in region_sets.items():
+                feature_outfile = get_count_reads_filename(directory, filebase, feature, feature_bam)
+                if feature_outfile in outputs:
+                    continue
+
+                if not needs_counting(feature_outfile, force, [feature_bam, bed_file]):
+                    print("Loading coverage from pre-calculated file for {}".format(feature_outfile))
+                    continue
+
+                key = counts_cache.key(feature_bam, bed_file, get_counting_mode(feature_bam))
+                if not force and counts_cache.get(key, feature_outfile):
+                    print("Loading coverage from cache for {}".format(feature_outfile))
+                    continue
+
+                outputs.append(feature_outfile)
+                bed_files.append(bed_file)
+                keys.append(key)
+
+            if len(outputs) > 0:
+                jobs.append((feature_bam, outputs, bed_files, keys))
+
+    #Jobs run in worker processes (the counting itself is mostly Python, so threads would be serialized by the GIL)
+    if count_jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=count_jobs) as pool:
+            futures = [pool.submit(count_feature_file, *job, genome_sizes, threads, cache_dir) for job in jobs]
+            # result() re-raises the first failure, in job order
+            for future in futures:
+                future.result()
+    else:
+        for job in jobs:
+            count_feature_file(*job, genome_sizes, threads, cache_dir)
+
+def count_feature_file(feature_bam, outputs, bed_files, keys, genome_sizes, threads=1, cache_dir=None):
+    #One count_features_for_region_sets job: count feature_bam against bed_files, write outputs and add them to the cache
+    start_time = time.time()
+    print("Counting coverage of {} in {}".format(feature_bam, ", ".join(outputs)))
+    run_count_reads_multi(feature_bam, outputs, bed_files, genome_sizes, threads)
+    counts_cache = CountReadsCache(cache_dir)
+    for key, output in zip(keys, outputs):
+        counts_cache.put(key, output)
+    print("Counted {} in {}".format(feature_bam, str(time.time() - start_time)))
+
+#Part of the CountReads cache key. Bump when the counting rules change so cached counts are not reused
+COUNT_READS_VERSION = 1
+
+def get_counting_mode(target):
+    if target.endswith(".bam"):
+        file_format = "bam"
+    elif target.endswith(".tagAlign.gz") or target.endswith(".tagAlign.bgz"):
+        file_format = "tagAlign"
+    elif isBigWigFile(target):
+        file_format = "bigWig"
+    else:
+        raise ValueError("File {} name was not in .bam, .tagAlign.gz, .bw".format(target))
+    return "{}.v{}".format(file_format, COUNT_READS_VERSION)
+
+def get_count_reads_filename(directory, filebase, feature, feature_bam):
+    feature_name = feature + "." + os.path.basename(feature_bam)
+    return os.path.join(directory, "{}.{}.CountReads.bed".format(filebase, feature_name))
+
+def needs_counting(feature_outfile, force=False, inputs=()):
+    #Count unless feature_outfile exists, is not empty and is newer than inputs (the signal file and bed file it was counted from)
+    return force or not is_up_to_date(feature_outfile, inputs)
+
+def count_single_feature_for_bed(df, bed_file, genome_sizes, feature_bam, feature, directory, filebase, skip_rpkm_quantile, force, threads=1, cache_dir=None, compact=False):
     orig_shape = df.shape[0]
     feature_name = feature + "." + os.path.basename(feature_bam)
-    feature_outfile = os.path.join(directory, "{}.{}.CountReads.bed".format(filebase, feature_name))
+    feature_outfile = get_count_reads_filename(directory, filebase, feature, feature_bam)
 
-    if force or (not os.path.exists(feature_outfile)) or (os.path.getsize(feature_outfile) == 0):
+    if needs_counting(feature_outfile, force, [feature_bam, bed_file]):
         print("Regenerating", feature_outfile)
         print("Counting coverage for {}".format(filebase + "." + feature_name))
-        run_count_reads(feature_bam, feature_outfile, bed_file, genome_sizes)
+        run_count_reads(feature_bam, feature_outfile, bed_file, genome_sizes, threads)
     else:
         print("Loading coverage from pre-calculated file for {}".format(filebase + "." + feature_name))
 
     domain_counts = read_bed(feature_outfile)
     score_column = domain_counts.columns[-1]
 
-    total_counts = count_total(feature_bam)
+    total_counts = count_total(feature_bam, cache_dir)
 
     domain_counts = domain_counts[['chr', 'start', 'end', score_column]]
     featurecount = feature_name + ".readCount"
@@ -401,6 +589,10 @@ def count_single_feature_for_bed(df, bed_file, genome_sizes, feature_bam, featur
         df[feature_name + ".RPKM"] = 1e3 * df[feature_name + ".RPM"] / (df.end - df.start).astype(float)
         df[feature_name + ".RPKM.quantile"] = df[feature_name + ".RPKM"].rank() / float(len(df))
 
+    if compact:
+        #The new columns are computed in float64, then stored as float32/int32
+        df = compact_dtypes(df)
+
     return df[~ df.duplicated()]
 
 def average_features(df, feature, feature_bam_list, skip_rpkm_quantile):
@@ -449,27 +641,71 @@ def read_bedgraph(filename):
 def count_bam_mapped(bam_file):
     # Counts number of reads in a BAM file WITHOUT iterating.  Requires that the BAM is indexed
     chromosomes = ['chr' + str(x) for x in range(1,23)] + ['chrX'] + ['chrY']
-    command = (reuse(".samtools-0.1.19") + "samtools idxstats " + bam_file)
-    data = check_output(command, shell=True)
-    lines = data.decode("ascii").split("\n")
-    vals = list(int(l.split("\t")[2]) for l in lines[:-1] if l.split("\t")[0] in chromosomes)
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        vals = list(stat.mapped for stat in bam.get_index_statistics() if stat.contig in chromosomes)
     if not sum(vals) > 0:
         raise ValueError("Error counting BAM file: count <= 0")
     return sum(vals)
 
-def count_tagalign_total(tagalign):
-    #result = int(check_output("zcat " + tagalign + " | wc -l", shell=True))
-    result = int(check_output("zcat {} | grep -E 'chr[1-9]|chr1[0-9]|chr2[0-2]|chrX|chrY' | wc -l".format(tagalign), shell=True))
+def count_tagalign_total(tagalign, chunk_size=1 << 24):
+    #Number of lines matching chr[1-9]|chr1[0-9]|chr2[0-2]|chrX|chrY (the filter previously applied with zcat | grep -E | wc -l).
+    #A reader thread decompresses the file (zlib releases the GIL) while the calling thread counts lines.
+    #Lines are counted with bytes.count and only the rare non-matching lines (chrM, chrUn...) are found with a regex
+    matching = re.compile(rb'chr[1-9XY]')
+    non_matching = re.compile(rb'^(?![^\n]*chr[1-9XY])[^\n]*\n', re.M)
+    chunks = queue.Queue(maxsize=4)
+
+    def read_chunks():
+        try:
+            with gzip.open(tagalign, 'rb') as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    chunks.put(chunk)
+                    if not chunk:
+                        break
+        except Exception as e:
+            chunks.put(e)
+
+    reader = threading.Thread(target=read_chunks, daemon=True)
+    reader.start()
+
+    result = 0
+    leftover = b''
+    while True:
+        chunk = chunks.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if not chunk:
+            break
+        chunk = leftover + chunk
+        cut = chunk.rfind(b'\n') + 1
+        lines, leftover = chunk[:cut], chunk[cut:]
+        result += lines.count(b'\n') - len(non_matching.findall(lines))
+
+    #last line without a trailing newline
+    if matching.search(leftover):
+        result += 1
+    reader.join()
+
     assert (result > 0)
     return result
 
 def count_bigwig_total(bw_file):
+    #Sum over chromosomes of chromosome length * mean signal over covered bases, from the bigWig's summary data
     bw = open_bigwig(bw_file)
-    result = sum(l * bw.stats(ch, 0, l, "mean")[0] for ch, l in bw.chroms().items())
+    result = sum(l * (bw.stats(ch, 0, l, "mean")[0] or 0) for ch, l in bw.chroms().items())
     assert (abs(result) > 0)  ## BigWig could have negative values, e.g. the negative-strand GroCAP bigwigs
     return result
 
-def count_total(infile):
+def count_total(infile, cache_dir=None):
+    #Library size of infile, computed once per process. With a cache directory, totals are also cached across runs.
+    #Both are keyed by the file's path, size and modification time (see TotalsCache)
+    totals_cache = TotalsCache(cache_dir)
+    try:
+        return totals_cache[infile]
+    except KeyError:
+        pass
+
     if infile.endswith(".tagAlign.gz") or infile.endswith(".tagAlign.bgz"):
         total_counts = count_tagalign_total(infile)
     elif infile.endswith(".bam"):
@@ -479,6 +715,7 @@ def count_total(infile):
     else:
         raise RuntimeError("Did not recognize file format of: " + infile)
 
+    totals_cache[infile] = total_counts
     return total_counts
 
 def make_features_from_param_df(df, supp=None):
@@ -2,6 +2,8 @@ import pandas as pd
 import numpy as np
 import os
 import os.path
+import pysam
+from concurrent.futures import ProcessPoolExecutor
 from tools import *
 from neighborhoods import *
 
@@ -42,72 +44,203 @@ def run_macs2_callpeak(infile, outdir, outfile_prefix, MACS_format, pval_cutoff,
 	else:
 		print('{}_peaks.narrowPeak already exists. Not recreating'.format(outfile_prefix))
 
-def make_v_plot(bamfile, bedfile, out, extension):
+def make_v_plot(bamfile, bedfile, out, extension, threads=1, min_mapq=30, tn5_shift=False):
+	#Aggregate profile of fragment ends around the TSSs in bedfile, written to out (one count per position, upstream to downstream).
+	#Reads below min_mapq are skipped; with tn5_shift, ends are moved to the center of the Tn5 insertion (see get_fragment_ends).
+	#TSS enrichment is the maximum of the 20bp moving average relative to the mean of the outer flank
 	print("Making v plot for file {}...".format(bamfile))
-	command = reuse("Python-2.7") + "python /seq/lincRNA/Jesse/bin/scripts/pyMakeVplot_JN.py -a {} -b {} -c 4 -o {} -e {} -p ends -v -u".format(bamfile, bedfile, out, extension)
-	print("Running: {}".format(command))
+	extension = int(extension)
+	profile = compute_v_plot(bamfile, bedfile, extension, threads, min_mapq=min_mapq, tn5_shift=tn5_shift)
 
-	p = Popen(command, stdout=PIPE, stderr=PIPE, shell=True)
-	(stdoutdata, stderrdata) = p.communicate()
+	if os.path.dirname(out):
+		os.makedirs(os.path.dirname(out), exist_ok=True)
+	with atomic_write(out) as tmp:
+		np.savetxt(tmp, profile, fmt="%d")
 
-	err = str(stderrdata, 'utf-8')
-	print(err)
+	window = 20
+	avg = np.convolve(profile, np.ones(window), 'same')/window/np.mean(profile[1:201]) #20bp moving average
+	tss_enrichment = np.amax(avg)
 
-	if "Error" not in err:
-		data = pd.read_table(out, header=None)
+	print("Done computing v plot. TSS enrichment = {}".format(tss_enrichment))
+	return(tss_enrichment)
 
-		window = 20
-		avg = np.convolve(data.ix[:,0], np.ones(window), 'same')/window/np.mean(data.ix[1:200,0]) #20bp moving average
-		#tss_enrichment = avg[1000]
-		tss_enrichment = np.amax(avg)
+def compute_v_plot(bamfile, bedfile, extension, threads=1, max_fragment=2000, min_mapq=30, tn5_shift=False):
+	#Sum over TSSs of fragment end counts at each offset in [-extension, extension], oriented by the TSS strand.
+	#Chromosomes are processed in up to threads worker processes
+	tss = read_tss_centers(bedfile)
+	profile = np.zeros(2 * extension + 1, dtype=np.int64)
+	by_chr = tss.groupby('chr', sort=False)
 
-		print("Done computing v plot. TSS enrichment = {}".format(tss_enrichment))
+	if threads > 1:
+		with ProcessPoolExecutor(max_workers=threads) as pool:
+			futures = [pool.submit(v_plot_chromosome, bamfile, chr, group['center'].values, group['minus'].values, extension, max_fragment, min_mapq, tn5_shift) for chr, group in by_chr]
+			for future in futures:
+				profile += future.result()
 	else:
-		tss_enrichment = np.nan
-		print("Making vplot failed. Error is: ".format(err))
+		for chr, group in by_chr:
+			profile += v_plot_chromosome(bamfile, chr, group['center'].values, group['minus'].values, extension, max_fragment, min_mapq, tn5_shift)
 
-	return(tss_enrichment)
+	return profile
+
+def read_tss_centers(bedfile):
+	#Midpoint and strand of each region. Strand is taken from the 6th column (bed6) or the 4th column (chr, start, end, strand)
+	tss = pd.read_table(bedfile, header=None, comment='#', dtype={0: str})
+	strand_col = next((col for col in [5, 3] if col in tss.columns and tss[col].isin(['+', '-', '.']).all()), None)
+	if strand_col is None:
+		raise ValueError("Could not find a strand column in {}".format(bedfile))
+	return pd.DataFrame({'chr': tss[0].values,
+						 'center': (tss[1] + (tss[2] - tss[1]) // 2).values,
+						 'minus': (tss[strand_col] == '-').values})
+
+#Tn5 inserts with a 9bp duplication: the insertion center is 4bp right of a + strand read's 5' end and 5bp left of a - strand one
+TN5_PLUS_SHIFT = 4
+TN5_MINUS_SHIFT = -5
+
+def get_fragment_ends(bam, chr, start, end, min_mapq=0, tn5_shift=False):
+	#Fragment end positions of reads fetched from [start, end).
+	#Proper pairs contribute both ends of the fragment once, from the leftmost mate (which must pass min_mapq); unpaired reads contribute their 5' end.
+	#With tn5_shift, left (+ strand) ends are shifted by +4 and right (- strand) ends by -5, as for ATAC-seq.
+	#Reads starting before start are left to the previous fetch, so no read is counted twice
+	plus_shift, minus_shift = (TN5_PLUS_SHIFT, TN5_MINUS_SHIFT) if tn5_shift else (0, 0)
+	positions = []
+	for read in bam.fetch(chr, start, end):
+		if read.is_unmapped or read.is_secondary or read.is_supplementary or read.is_qcfail or read.reference_start < start:
+			continue
+		if read.mapping_quality < min_mapq:
+			continue
+		if read.is_paired:
+			if read.is_proper_pair and read.template_length > 0:
+				positions.append(read.reference_start + plus_shift)
+				positions.append(read.reference_start + read.template_length - 1 + minus_shift)
+		elif read.is_reverse:
+			positions.append(read.reference_end - 1 + minus_shift)
+		else:
+			positions.append(read.reference_start + plus_shift)
+	return positions
+
+def v_plot_chromosome(bamfile, chr, centers, minus, extension, max_fragment, min_mapq=30, tn5_shift=False):
+	profile = np.zeros(2 * extension + 1, dtype=np.int64)
+	with pysam.AlignmentFile(bamfile, "rb") as bam:
+		if chr not in bam.references:
+			return profile
 
-def make_candidate_regions_from_summits(macs_peaks, accessibility_file, genome_sizes, regions_whitelist, regions_blacklist, n_enhancers, peak_extend, outdir):
+		#Overlapping windows are fetched together so each read is seen once. Windows are widened on the left
+		#so that the leftmost mate of a fragment ending inside the window is fetched too, and on the right so that
+		#reverse reads shifted into the window are fetched
+		order = np.argsort(centers, kind='mergesort')
+		centers = centers[order]
+		minus = minus[order]
+		fetch_starts = np.maximum(centers - extension - max_fragment, 0)
+		fetch_ends = centers + extension + 1 - TN5_MINUS_SHIFT
+		new_block = np.concatenate(([True], fetch_starts[1:] > fetch_ends[:-1]))
+		bounds = np.append(np.flatnonzero(new_block), len(centers))
+
+		for i, j in zip(bounds[:-1], bounds[1:]):
+			ends = np.sort(np.array(get_fragment_ends(bam, chr, int(fetch_starts[i]), int(fetch_ends[j - 1]), min_mapq, tn5_shift), dtype=np.int64))
+			if len(ends) == 0:
+				continue
+			lo = np.searchsorted(ends, centers[i:j] - extension, side='left')
+			hi = np.searchsorted(ends, centers[i:j] + extension, side='right')
+			for center, is_minus, a, b in zip(centers[i:j], minus[i:j], lo, hi):
+				offsets = ends[a:b] - center + extension
+				if is_minus:
+					offsets = 2 * extension - offsets
+				profile += np.bincount(offsets, minlength=2 * extension + 1)
+
+	return profile
+
+def make_candidate_regions_from_summits(macs_peaks, accessibility_file, genome_sizes, regions_whitelist, regions_blacklist, n_enhancers, peak_extend, outdir, threads=1):
     ## Generate enhancer regions from MACS summits
     # 1. Count reads in DHS peaks
     # 2. Take top N regions, get summits, extend summits, merge
+    # The interval arithmetic is done in memory and reproduces the bedtools sort/merge/intersect/slop pipeline previously run here
 
     outfile = os.path.join(outdir, os.path.basename(macs_peaks) + ".candidateRegions.bed")
     raw_counts_outfile = os.path.join(outdir, os.path.basename(macs_peaks) + os.path.basename(accessibility_file) + ".Counts.bed")
 
-    if regions_whitelist:
-    	whitelist_command = "| (bedtools intersect -a {regions_whitelist} -b {genome_sizes}.bed -wa | bedtools slop -i stdin -b {peak_extend} -g {genome_sizes} | cut -f 1-3 && cat) |"
-    else:
-    	whitelist_command = ""
+    n_enhancers = int(n_enhancers)
+    peak_extend = int(peak_extend)
+    sizes = read_genome_sizes(genome_sizes)
+    chrom_sizes = dict(zip(sizes['chr'].astype(str), sizes['length']))
+
+    #1. Count DHS/ATAC reads in candidate regions
+    run_count_reads(accessibility_file, raw_counts_outfile, macs_peaks, genome_sizes, threads)
+    counts = pd.read_table(raw_counts_outfile, header=None, names=['chr', 'start', 'end', 'count'], dtype={'chr': str})
 
+    #2. Take top N merged regions by count. Ties are broken on the whole line in reverse, as sort -nr did
+    merged = merge_intervals(counts, chrom_sizes, max_column='count')
+    merged['line'] = merged['chr'] + '\t' + merged['start'].astype(str) + '\t' + merged['end'].astype(str) + '\t' + merged['count'].astype(str)
+    top = merged.sort_values(['count', 'line'], ascending=False, kind='mergesort').head(n_enhancers)
+
+    #3. Summits of the peaks in these regions, extended and merged
+    peaks = pd.read_table(macs_peaks, header=None, usecols=[0, 1, 2, 9], names=['chr', 'start', 'end', 'summit'], dtype={'chr': str})
+    peaks = peaks[overlaps_regions(peaks, top)]
+    summits = pd.DataFrame({'chr': peaks['chr'].values, 'start': peaks['start'].values + peaks['summit'].values})
+    summits['end'] = summits['start']
+    candidates = merge_intervals(slop_intervals(summits, chrom_sizes, peak_extend), chrom_sizes)
+
+    #4. Remove blacklisted regions, add whitelisted regions
     if regions_blacklist:
-    	blacklist_command = "bedtools intersect -v -wa -a stdin -b {regions_blacklist} | "
-    else:
-    	blacklist_command = ""
+        blacklist = read_regions(regions_blacklist)
+        candidates = candidates[~overlaps_regions(candidates, blacklist)]
 
-    #1. Count DHS/ATAC reads in candidate regions
-    run_count_reads(accessibility_file, raw_counts_outfile, macs_peaks, genome_sizes)
-
-    #2. Take top N regions, get summits, extend summits, merge, remove blacklist, add whitelist, sort and merge
-    #use -sorted in intersect command? Not worth it, both files are small
-    command = reuse(".bedtools-2.26.0") + \
-        "bedtools sort -i {raw_counts_outfile} -faidx {genome_sizes} | bedtools merge -i stdin -c 4 -o max | sort -nr -k 4 | head -n {n_enhancers} |" + \
-        "bedtools intersect -b stdin -a {macs_peaks} -wa |" + \
-        "awk '{{print $1 \"\\t\" $2 + $10 \"\\t\" $2 + $10}}' |" + \
-        "bedtools slop -i stdin -b {peak_extend} -g {genome_sizes} |" + \
-        "bedtools sort -i stdin -faidx {genome_sizes} |" + \
-        "bedtools merge -i stdin | " + \
-        blacklist_command + \
-        "cut -f 1-3 " + whitelist_command + \
-        "bedtools sort -i stdin -faidx {genome_sizes} | bedtools merge -i stdin > {outfile}"
-
-    command = command.format(**locals())
-    print("Running: " + command)
-    out = getoutput(command)
-    print(out)
-
-    return out
+    if regions_whitelist:
+        whitelist = read_regions(regions_whitelist)
+        whitelist = whitelist[overlaps_regions(whitelist, read_regions(genome_sizes + ".bed"))]
+        candidates = merge_intervals(pd.concat([candidates, slop_intervals(whitelist, chrom_sizes, peak_extend)]), chrom_sizes)
+
+    with atomic_write(outfile) as tmp:
+        candidates[['chr', 'start', 'end']].to_csv(tmp, sep='\t', header=False, index=False)
+    print("Wrote {} candidate regions to {}".format(len(candidates), outfile))
+
+    return outfile
+
+def sort_intervals(regions, chrom_sizes):
+    #bedtools sort -faidx: chromosomes in genome sizes order, then by start
+    chrom_order = {chr: i for i, chr in enumerate(chrom_sizes)}
+    order = regions['chr'].map(chrom_order).fillna(len(chrom_order))
+    regions = regions.assign(chrom_order=order.values).sort_values(['chrom_order', 'start', 'end'], kind='mergesort')
+    return regions.drop(columns='chrom_order').reset_index(drop=True)
+
+def merge_intervals(regions, chrom_sizes, max_column=None):
+    #bedtools sort | bedtools merge: overlapping and book-ended intervals on a chromosome are merged. Optionally keeps the max of a column (-c col -o max)
+    regions = sort_intervals(regions, chrom_sizes)
+    if len(regions) == 0:
+        return regions[['chr', 'start', 'end'] + ([max_column] if max_column else [])]
+
+    chrs = regions['chr'].values
+    starts = regions['start'].values
+    reach = regions.groupby('chr', sort=False)['end'].cummax().values
+    new_block = np.r_[True, (chrs[1:] != chrs[:-1]) | (starts[1:] > reach[:-1])]
+    block = np.cumsum(new_block)
+
+    aggregations = {'chr': 'first', 'start': 'first', 'end': 'max'}
+    if max_column:
+        aggregations[max_column] = 'max'
+    return regions.groupby(block, sort=False).agg(aggregations).reset_index(drop=True)
+
+def slop_intervals(regions, chrom_sizes, extend):
+    #bedtools slop -b extend, clamped to the chromosome. Chromosomes missing from the genome sizes file are dropped
+    known = regions['chr'].isin(chrom_sizes).values
+    if not known.all():
+        print("Dropping {} regions on chromosomes not in the genome sizes file".format((~known).sum()))
+    regions = regions[known]
+    lengths = regions['chr'].map(chrom_sizes).values
+    return pd.DataFrame({'chr': regions['chr'].values,
+                         'start': np.maximum(regions['start'].values - extend, 0),
+                         'end': np.minimum(regions['end'].values + extend, lengths)})
+
+def overlaps_regions(regions, others):
+    #Whether each region overlaps any of others on the same chromosome by at least 1bp (bedtools intersect -u)
+    hits = np.zeros(len(regions), dtype=bool)
+    starts = regions['start'].values
+    ends = regions['end'].values
+    others_by_chr = others.groupby('chr')
+    for chr, idx in regions.groupby('chr').indices.items():
+        if chr in others_by_chr.groups:
+            these = others_by_chr.get_group(chr)
+            hits[idx] = overlaps_any(starts[idx], ends[idx], these['start'].values, these['end'].values)
+    return hits
 
 def get_macs_format(feature_type):
 	if feature_type == "ATAC":
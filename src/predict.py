@@ -1,16 +1,21 @@
 import argparse
 import progressbar as pb
-from predictor import Predictor
+import memory_profile
+from predictor import Predictor, make_hic_fetcher
+from query_predictions import write_indexed_predictions
+from shared_data import SharedRanges
 from tools import *
 import pandas as pd
 import numpy as np
-import sys, traceback, os, os.path
+import sys, traceback, os, os.path, copy
+import queue, threading, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 # To Do:
 # 2. Read HiC resolution from hic.listing file
 # 3. Review qnorm (how to qnorm ATAC)
 
-def get_model_argument_parser():
+def get_model_argument_parser(outdir_required=True):
     class formatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawTextHelpFormatter):
         pass
 
@@ -27,8 +32,14 @@ def get_model_argument_parser():
 
     #Basic parameters
     parser.add_argument('--cellType', required=False, help="Name of cell type")
-    parser.add_argument('--nbhd_directory', help="Directory with neighborhoods files")
-    parser.add_argument('--outdir', required=True, help="output directory")
+    parser.add_argument('--cellTypes', default="", help="Comma delimited list of cell types to predict in one run. Each cell type's genes are predicted in its own order, and the cell types take turns so that a Hi-C row they share at the same point of their gene lists is read once. nbhd_directory and outdir must contain {cellType}")
+    parser.add_argument('--nbhd_directory', help="Directory with neighborhoods files. May contain {cellType}")
+    parser.add_argument('--neighborhoods_format', choices=['txt', 'parquet'], default='txt', help="Read EnhancerList and GeneList from the .txt files or from the parquet datasets written by run.neighborhoods.py --write_parquet. Both give the same predictions")
+    parser.add_argument('--outdir', required=outdir_required, help="output directory. May contain {cellType}")
+    parser.add_argument('--processes', type=int, default=1, help="Predict blocks of genes in this many worker processes, which attach to the elements in shared memory instead of loading their own copy. Hi-C is not shared: each worker reads the bedgraphs of its own genes. --prefetch and --write_queue are not used by workers")
+    parser.add_argument('--prefetch', type=int, default=0, help="Read the Hi-C rows of this many upcoming genes on background threads while the current gene is scored")
+    parser.add_argument('--write_queue', type=int, default=0, help="Write gene files and collect outputs on a background thread, with at most this many scored genes waiting. 0 writes inline")
+    parser.add_argument('--hic_cache_size', type=int, default=1, help="Number of processed Hi-C bedgraphs to keep in memory per Hi-C directory")
     parser.add_argument('--params_file', help="Parameters file")
     parser.add_argument('--genes', type=readable, required=False, help="Table of genes for which predictions should be made. Overrides GeneList.txt in neighborhoods directory")
     parser.add_argument('--HiC_directory_listing', default="", help="File mapping cell names to hic directories")
@@ -57,10 +68,17 @@ def get_model_argument_parser():
     parser.add_argument('--skip_gene_files', action="store_true", help="Do not make individual gene files")
     parser.add_argument('--skinny_gene_files', action="store_true", help="Use subset of columns for genes files")
     parser.add_argument('--make_all_putative', action="store_true", help="Make big file with concatenation of all genes file")
+    parser.add_argument('--compact_dtypes', action="store_true", help="Keep enhancers with int32 coordinates and categorical strings, and per-gene predictions also with float32 values, to reduce memory (e.g. with --make_all_putative). Scores are computed from the float64 values and thresholded before they are compacted")
+    parser.add_argument('--write_indexed', action="store_true", help="Also write EnhancerPredictions.txt.gz (and the all putative file) position sorted, bgzip compressed and tabix indexed on elements and on TargetGeneTSS, for use with query_predictions.py")
 
     #Other
     parser.add_argument('--tss_slop', type=int, default=500, help="Distance from tss to search for self-promoters")
     parser.add_argument('--include_chrY', '-y', action='store_true', help="Include Y chromosome")
+    parser.add_argument('--chromosomes', default="", help="Comma delimited list of chromosomes to make predictions for. Only these chromosomes are loaded from the enhancer and gene lists (note: qnorm is then computed on these chromosomes only)")
+    parser.add_argument('--shard', default="", help="i/N: only predict the i-th (0-based) of N parts of the gene list. Partial outputs are written to outdir/shards/i (gene files to outdir/genes) and are combined with merge_predictions.py")
+    parser.add_argument('--shard_by', choices=['genes', 'chromosome'], default='genes', help="Split the gene list into shards with balanced gene counts, or at chromosome boundaries (the gene list must then be grouped by chromosome)")
+    parser.add_argument('--minimal_enhancer_columns', action="store_true", help="Only load the EnhancerList columns used for scoring. Gene files and EnhancerPredictions.txt then only contain these columns and the computed scores")
+    memory_profile.add_argument(parser)
 
     return parser
 
@@ -76,9 +94,9 @@ def parse_cell_type_args(args, cellType):
     file_params = file_params.loc[file_params["cell_type"] == cellType, ]
     args.DHS_column = file_params['default_accessibility_feature'].values[0] + ".RPM"
 
-    args.enhancers = os.path.join(args.nbhd_directory, "EnhancerList.txt")   
+    args.enhancers = get_neighborhoods_file(args.nbhd_directory, "EnhancerList", args.neighborhoods_format)
     if args.genes is None:
-        args.genes = os.path.join(args.nbhd_directory, "GeneList.txt")
+        args.genes = get_neighborhoods_file(args.nbhd_directory, "GeneList", args.neighborhoods_format)
      
     #HiC Params
     hic_cell_type = file_params['hic_cell_type'].values[0]
@@ -87,109 +105,417 @@ def parse_cell_type_args(args, cellType):
     
     return args
 
-def main():
-    parser = get_predict_argument_parser()
-    args = parser.parse_args()
-    args = parse_cell_type_args(args, args.cellType)
-
-    if not os.path.exists(args.outdir):
-        os.makedirs(args.outdir)
-
-    preddir = os.path.join(args.outdir, "genes")
-    if not os.path.exists(preddir):
-        os.makedirs(preddir)
+def get_neighborhoods_file(nbhd_directory, name, neighborhoods_format="txt"):
+    #parquet: the columnar copies written by run.neighborhoods.py --write_parquet
+    filename = os.path.join(nbhd_directory, name + "." + neighborhoods_format)
+    if not os.path.exists(filename):
+        raise ValueError("{} not found{}".format(filename, ". Run run.neighborhoods.py with --write_parquet" if neighborhoods_format == "parquet" else ""))
+    return filename
+
+def get_enhancer_columns(args):
+    if not args.minimal_enhancer_columns:
+        return None
+    return ['chr', 'start', 'end', 'name', 'class', 'isPromoterElement', args.DHS_column, 'H3K27ac.RPM']
+
+def parse_shard(shard):
+    try:
+        index, count = [int(x) for x in shard.split("/")]
+    except ValueError:
+        raise ValueError("--shard must be given as i/N, got {}".format(shard))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("--shard {} is out of range: need 0 <= i < N".format(shard))
+    return index, count
+
+def get_shard_outdir(outdir, index):
+    return os.path.join(outdir, "shards", str(index))
+
+def get_shard_bounds(genes, count, shard_by):
+    #Shards are contiguous blocks of the gene list, so concatenating shard outputs in order gives the order of a single run.
+    #Returns the N + 1 row boundaries
+    target = np.linspace(0, len(genes), count + 1)
+    if shard_by == 'genes':
+        return np.round(target).astype(int)
+
+    chrs = genes['chr'].values
+    starts = np.concatenate(([0], np.flatnonzero(chrs[1:] != chrs[:-1]) + 1))
+    if len(set(chrs[starts])) < len(starts):
+        raise ValueError("--shard_by chromosome needs the gene list grouped by chromosome. Use --shard_by genes")
+    #Cut at the chromosome boundary closest to each balanced cut point
+    boundaries = np.append(starts, len(genes))
+    cuts = boundaries[np.abs(boundaries[None, :] - target[:, None]).argmin(axis=1)]
+    cuts[0], cuts[-1] = 0, len(genes)
+    return np.maximum.accumulate(cuts)
+
+def select_shard(genes, shard, shard_by):
+    index, count = parse_shard(shard)
+    bounds = get_shard_bounds(genes, count, shard_by)
+    print("Shard {}: genes {} to {} of {}".format(shard, bounds[index], bounds[index + 1], len(genes)))
+    return genes.iloc[bounds[index]:bounds[index + 1]]
+
+class CellTypeRun(object):
+    # Data and accumulated outputs of one cell type
+    def __init__(self, args, hic_fetchers):
+        self.args = args
+        #Tables go to the shard directory when sharding, gene files always go to outdir/genes
+        self.outdir = get_shard_outdir(args.outdir, parse_shard(args.shard)[0]) if args.shard else args.outdir
+        os.makedirs(self.outdir, exist_ok=True)
+        if args.shard and os.path.exists(os.path.join(self.outdir, "shard.complete")):
+            os.remove(os.path.join(self.outdir, "shard.complete"))
+        self.preddir = os.path.join(args.outdir, "genes")
+        os.makedirs(self.preddir, exist_ok=True)
+
+        write_prediction_params(args, os.path.join(self.outdir, "parameters.predict.txt"))
+
+        load_chromosomes = args.chromosomes.split(",") if args.chromosomes else None
+
+        print("reading genes")
+        self.genes = read_genes(args.genes, chromosomes=load_chromosomes)
+        if args.shard:
+            #Enhancers are still all loaded so that qnorm is the same as in a single run
+            self.genes = select_shard(self.genes, args.shard, args.shard_by)
+
+        print("reading enhancers")
+        self.enhancers = read_enhancers(args.enhancers, columns=get_enhancer_columns(args), chromosomes=load_chromosomes)
+
+        print("building predictor")
+        if args.HiCdir not in hic_fetchers:
+            hic_fetchers[args.HiCdir] = make_hic_fetcher(vars(args), cache_size=args.hic_cache_size)
+        self.predictor = Predictor(self.enhancers, hic_fetcher=hic_fetchers[args.HiCdir], **vars(args))
+
+        print("applying qnorm")
+        self.predictor.add_normalized_data_to_enhancers(self.enhancers)
+        if args.compact_dtypes:
+            #Element names become a categorical shared by every per-gene slice. Values stay float64: they are scored
+            self.enhancers.ranges = compact_dtypes(self.enhancers.ranges, categorical=['name'], floats=False)
+
+        self.chromosomes = self.predictor.chromosomes()
+        print("data loaded for chromosomes: {}".format(" ".join(sorted(self.chromosomes))))
+
+        args.score_column = "ABC.Score"
+
+        #Genes left to predict at each (chr, tss), and scored elements shared by the genes at a TSS
+        self.genes_per_tss = self.genes.groupby(['chr', 'tss']).size().to_dict()
+        self.scored = {}
+
+        self.all_positive_list = []
+        self.all_putative_list = []
+        self.gene_stats = []
+        self.failed_genes = []
+
+def get_cell_type_args(args, cellType):
+    cell_args = copy.copy(args)
+    cell_args.cellType = cellType
+    if args.genes is not None and not isinstance(args.genes, str):
+        #--genes is an open file. Each cell type reads it separately
+        cell_args.genes = args.genes.name
+    cell_args.nbhd_directory = args.nbhd_directory.format(cellType=cellType)
+    if args.outdir:
+        cell_args.outdir = args.outdir.format(cellType=cellType)
+    return parse_cell_type_args(cell_args, cellType)
+
+def iterate_genes(runs):
+    #(run, gene) pairs, each run's genes in its own gene list order. With several cell types the runs take turns: the
+    #leading run's next genes at one TSS are followed by the genes at that TSS next in line in the other runs, so that
+    #the Hi-C row loaded for the first is reused from the fetcher cache by the others. With the same gene list in every
+    #cell type, all cell types' predictions for a TSS are made one after another
+    if len(runs) == 1:
+        for idx, gene in runs[0].genes.iterrows():
+            yield runs[0], gene
+        return
+
+    keys = [list(zip(run.genes['chr'].values, run.genes['tss'].values)) for run in runs]
+    positions = [0] * len(runs)
+    lead = 0
+    while any(position < len(run_keys) for position, run_keys in zip(positions, keys)):
+        if positions[lead] < len(keys[lead]):
+            key = keys[lead][positions[lead]]
+            for i in [lead] + [i for i in range(len(runs)) if i != lead]:
+                while positions[i] < len(keys[i]) and keys[i][positions[i]] == key:
+                    yield runs[i], runs[i].genes.iloc[positions[i]]
+                    positions[i] += 1
+        lead = (lead + 1) % len(runs)
+
+def get_scored_enhancers(run, gene):
+    #Scores depend on a gene only through its chromosome and TSS. Genes sharing a TSS (isoforms, alternative names) reuse
+    #the elements scored for the first of them, relabelled with their own name and expression. The scored table is kept
+    #until the last gene with that TSS has been predicted
+    args = run.args
+    key = (gene.chr, gene.tss)
+    try:
+        if key in run.scored:
+            nearby_enhancers = run.scored[key].copy()
+            run.predictor.annotate_target_gene(nearby_enhancers, gene)
+            return nearby_enhancers
+
+        nearby_enhancers = run.enhancers.within_range(gene.chr, gene.tss - args.window, gene.tss + args.window)
+        #predictor.add_normalized_data_to_enhancers(gene, nearby_enhancers, domains, loops=None, tss_slop=args.tss_slop)
+        #predictor.add_normalized_data_to_enhancers(gene, nearby_enhancers, tss_slop=args.tss_slop)
+        run.predictor.predict_from_normalized_to_enhancers(nearby_enhancers, gene, args.window, tss_slop=args.tss_slop)
+        if run.genes_per_tss[key] > 1:
+            run.scored[key] = nearby_enhancers.copy()
+        return nearby_enhancers
+    finally:
+        run.genes_per_tss[key] -= 1
+        if run.genes_per_tss[key] == 0:
+            run.scored.pop(key, None)
+
+class BackgroundWriter(object):
+    # Runs output tasks on one thread, in the order they are submitted, so output order is the same as without it.
+    # The queue is bounded: scoring blocks when it gets max_pending genes ahead of writing. With max_pending=0 tasks run inline
+    def __init__(self, max_pending=0):
+        self.max_pending = max_pending
+        self.error = None
+        if max_pending > 0:
+            self.queue = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def submit(self, func, *args):
+        if self.max_pending == 0:
+            func(*args)
+            return
+        if self.error is not None:
+            raise self.error
+        self.queue.put((func, args))
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            func, args = task
+            try:
+                func(*args)
+            except BaseException as e:
+                if self.error is None:
+                    self.error = e
+
+    def close(self):
+        if self.max_pending > 0:
+            self.queue.put(None)
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+
+class SharedCellTypeRun(object):
+    # What a worker process needs to predict genes of one cell type: the elements, attached from shared memory, and a predictor.
+    # The predictor uses the worker's own HiCFetcher (one per Hi-C directory), which reads the bedgraphs of the worker's genes.
+    # qnorm was applied by the parent before the elements were published
+    def __init__(self, args, enhancers_handle, hic_fetchers):
+        self.args = args
+        self.enhancers = SharedRanges.attach(enhancers_handle)
+        self.preddir = os.path.join(args.outdir, "genes")
+        if args.HiCdir not in hic_fetchers:
+            hic_fetchers[args.HiCdir] = make_hic_fetcher(vars(args), cache_size=args.hic_cache_size)
+        self.predictor = Predictor(None, hic_fetcher=hic_fetchers[args.HiCdir], **dict(vars(args), qnorm=''))
+        self.chromosomes = self.predictor.chromosomes()
+
+worker_runs = []
+
+def init_prediction_worker(run_specs):
+    hic_fetchers = {}
+    for args, enhancers_handle in run_specs:
+        worker_runs.append(SharedCellTypeRun(args, enhancers_handle, hic_fetchers))
+
+def predict_gene_block(run_index, genes):
+    #Predict consecutive genes of one cell type in a worker. Returns the outputs to add to the parent's CellTypeRun
+    run = worker_runs[run_index]
+    run.genes_per_tss = genes.groupby(['chr', 'tss']).size().to_dict()
+    run.scored = {}
+    run.all_positive_list, run.all_putative_list, run.gene_stats, run.failed_genes = [], [], [], []
+
+    writer = BackgroundWriter(0)
+    for idx, gene in genes.iterrows():
+        predict_gene(run, gene, writer)
+    return run.all_positive_list, run.all_putative_list, run.gene_stats, run.failed_genes
+
+def predict_with_processes(runs, processes):
+    #Each cell type's elements are published once to shared memory and the parent's copy is replaced by the shared one,
+    #so the memory used by the elements does not grow with the number of workers (Hi-C bedgraphs are read by the workers, each
+    #for its own genes). Blocks of consecutive genes are predicted in parallel and their
+    #outputs added in gene order
+    for run in runs:
+        run.enhancers = SharedRanges.create(run.enhancers.ranges)
+    run_specs = [(run.args, run.enhancers.handle) for run in runs]
+
+    blocks = []
+    for i, run in enumerate(runs):
+        bounds = np.round(np.linspace(0, len(run.genes), min(len(run.genes), 4 * processes) + 1)).astype(int)
+        blocks += [(i, run.genes.iloc[lo:hi]) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+    try:
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_prediction_worker, initargs=(run_specs,)) as pool:
+            results = pool.map(predict_gene_block, [i for i, block in blocks], [block for i, block in blocks])
+            for n_done, ((i, block), result) in enumerate(zip(blocks, results)):
+                positives, putative, stats, failed = result
+                runs[i].all_positive_list += positives
+                runs[i].all_putative_list += putative
+                runs[i].gene_stats += stats
+                runs[i].failed_genes += failed
+                print("Predicted {} of {} gene blocks".format(n_done + 1, len(blocks)))
+    finally:
+        for run in runs:
+            run.enhancers.close()
+
+def prefetch_gene(run, gene):
+    #Start reading the Hi-C row predict_gene will need, unless the gene is skipped or reuses scores of its TSS
+    if (gene.chr == 'chrY' and not run.args.include_chrY) or gene.chr not in run.chromosomes or (gene.chr, gene.tss) in run.scored:
+        return
+    run.predictor.hic_fetcher.prefetch(gene.chr, gene.tss)
+
+def predict_gene(run, gene, writer):
+    #Scores the gene, then hands the scored elements to writer for the gene file and the aggregate outputs
+    args = run.args
+
+    if gene.chr == 'chrY' and not args.include_chrY:
+        return
+    if gene.chr not in run.chromosomes:
+        print("\nNo data for {}".format(gene.chr))
+        return
+    print("\nPredicting {} with {} {} TSS".format(gene["name"], gene["chr"], gene["tss"]))
+
+    try:
+        nearby_enhancers = get_scored_enhancers(run, gene)
+    except:
+        #Failures are recorded by the writer too, so FailedGenes.txt keeps gene order
+        writer.submit(record_failed_gene, run, gene, traceback.format_exc())
+        return
+    writer.submit(write_gene_outputs, run, gene, nearby_enhancers)
+
+def write_gene_outputs(run, gene, nearby_enhancers):
+    args = run.args
+    predictor = run.predictor
+
+    try:
+        scores = nearby_enhancers[args.score_column]
+        if args.compact_dtypes:
+            #Scores are computed in float64 and thresholded at full precision; only the stored copy is compacted
+            nearby_enhancers = compact_dtypes(nearby_enhancers, categorical=['TargetGene'])
+
+        col_names=['chr','start','end','TargetGene','TargetGeneTSS','class','Score.Fraction','Score','distance','hic.distance','hic.distance.adj','estimatedCP','estimatedCP.adj','normalized_dhs','normalized_h3k27ac','TargetGeneExpression','TargetGeneTSSActivityQuantile']
+        if not args.skip_gene_files:
+            if not args.skinny_gene_files:
+                write_scores(run.preddir, gene, nearby_enhancers)
+            else:
+                write_scores(run.preddir, gene, nearby_enhancers[col_names])
+
+        if args.make_all_putative:
+            run.all_putative_list.append(nearby_enhancers[col_names])
+
+        gene_is_expressed_proxy = check_gene_for_runnability(gene, args.expression_cutoff, args.promoter_activity_quantile_cutoff)
+        if args.run_all_genes or gene_is_expressed_proxy:
+            positives = nearby_enhancers.ix[(scores >= args.threshold).values,:]
+            print("{} enhancers predicted for {}".format(positives.shape[0], gene["name"]))
+            run.all_positive_list.append(positives)
+
+        #Add gene to gene summary file
+        if nearby_enhancers.shape[0] > 0:
+            stats = predictor.get_gene_prediction_stats(args, nearby_enhancers)
+            stats['prediction_file'] = get_score_filename(gene)
+            stats['gene_is_expressed_proxy'] = gene_is_expressed_proxy
+            run.gene_stats.append(stats)
+
+        #THINK about whether this is the right thing to do
+        # if any(nearby_enhancers[args.score_column].isnull().tolist()):
+        #     failed_genes.append(gene["chr"] + "\t" + gene["name"])
+
+    except:
+        record_failed_gene(run, gene, traceback.format_exc())
+
+def record_failed_gene(run, gene, error):
+    run.failed_genes.append(gene["chr"] + "\t" + gene["name"])
+    print("Failed on " + gene["name"] + " ... skipping. Traceback:")
+    sys.stdout.write(error)
+
+def write_outputs(run):
+    args = run.args
 
-    write_prediction_params(args, os.path.join(args.outdir, "parameters.predict.txt"))
-    
-    print("reading genes")
-    genes = read_genes(args.genes)
+    #Initialize Prediction files
+    pred_file = os.path.join(run.outdir, "EnhancerPredictions.txt")
+    all_pred_file = os.path.join(run.outdir, "EnhancerPredictionsAllPutative.txt.gz")
 
-    print("reading enhancers")
-    enhancers = read_enhancers(args.enhancers)
+    #A shard may have no predictions; its tables are then not written and merge_predictions.py treats them as empty
+    if args.score_column is not None and run.all_positive_list:
+        with memory_profile.stage("concat_predictions", args.cellType):
+            all_positive = concat_compact(run.all_positive_list) if args.compact_dtypes else pd.concat(run.all_positive_list)
+        all_positive.to_csv(pred_file, sep="\t", index=False, header=True, float_format="%.4f")
+        write_connections_bedpe_format(all_positive.loc[all_positive["class"] != "promoter"], outfile=os.path.join(run.outdir, "Predictions_nopromoters.bedpe"), score_column=args.score_column)
+        if args.write_indexed:
+            write_indexed_predictions(all_positive, os.path.join(run.outdir, "EnhancerPredictions.txt.gz"))
 
-    print("building predictor")
-    predictor = Predictor(enhancers, **vars(args))
+    if run.gene_stats:
+        gene_stats = pd.concat(run.gene_stats, axis=1).T
+        gene_stats.to_csv(os.path.join(run.outdir, "GenePredictionStats.txt"), sep="\t", index=False)
 
-    print("applying qnorm")
-    predictor.add_normalized_data_to_enhancers(enhancers)
+    with open(os.path.join(run.outdir, "FailedGenes.txt"), 'w') as failed_file:
+        for gene in run.failed_genes:
+            failed_file.write(gene + "\n")
 
-    chromosomes = predictor.chromosomes()
-    print("data loaded for chromosomes: {}".format(" ".join(sorted(chromosomes))))
+    if args.make_all_putative and run.all_putative_list:
+        with memory_profile.stage("concat_all_putative", args.cellType):
+            all_putative = concat_compact(run.all_putative_list) if args.compact_dtypes else pd.concat(run.all_putative_list)
+        if args.write_indexed:
+            #Still gzip readable, but position sorted and bgzip compressed
+            write_indexed_predictions(all_putative, all_pred_file)
+        else:
+            all_putative.to_csv(all_pred_file, sep="\t", index=False, header=True, compression="gzip", float_format="%.4f", na_rep="NaN", chunksize=100000)
 
-    #Initialize Prediction files
-    pred_file = os.path.join(args.outdir, "EnhancerPredictions.txt")
-    all_pred_file = os.path.join(args.outdir, "EnhancerPredictionsAllPutative.txt.gz")
-    pred_bed = os.path.join(args.outdir, "EnhancerPredictions.bed")
+    if args.shard:
+        #Written last: merge_predictions.py only merges complete shards
+        with open(os.path.join(run.outdir, "shard.complete"), 'w') as done_file:
+            done_file.write(args.shard + "\n")
 
-    args.score_column = "ABC.Score"
+def main():
+    parser = get_predict_argument_parser()
+    args = parser.parse_args()
+    memory_profile.start(__file__, args.memory_profile)
+
+    cell_types = args.cellTypes.split(",") if args.cellTypes else [args.cellType]
+    if len(cell_types) > 1 and ("{cellType}" not in args.outdir or "{cellType}" not in args.nbhd_directory):
+        raise ValueError("--nbhd_directory and --outdir must contain {cellType} when predicting several cell types")
+
+    #Cell types with the same Hi-C directory share one fetcher
+    hic_fetchers = {}
+    runs = []
+    for cellType in cell_types:
+        with memory_profile.stage("load_cell_type", cellType):
+            runs.append(CellTypeRun(get_cell_type_args(args, cellType), hic_fetchers))
+
+    if args.processes > 1:
+        with memory_profile.stage("predict_genes"):
+            predict_with_processes(runs, args.processes)
+        write_all_outputs(runs)
+        return
+
+    #Hi-C rows for the next --prefetch genes are read while the current gene is scored,
+    #and gene files are written in the background while the next genes are scored
+    genes = list(iterate_genes(runs))
+    if args.prefetch:
+        for fetcher in hic_fetchers.values():
+            fetcher.start_prefetch(args.prefetch, 2 * args.prefetch)
+        for run, gene in genes[:args.prefetch]:
+            prefetch_gene(run, gene)
+    writer = BackgroundWriter(args.write_queue)
 
-    all_positive_list = []
-    all_putative_list = []
-    gene_stats = []
-    failed_genes = []
     pbar = pb.ProgressBar(max_value=len(genes), redirect_stdout=True)
-    for idx, gene in pbar(genes.iterrows()):
-        if gene.chr == 'chrY' and not args.include_chrY:
-            continue
-        if gene.chr not in chromosomes:
-            print("\nNo data for {}".format(gene.chr))
-            continue
-        print("\nPredicting {} with {} {} TSS".format(gene["name"], gene["chr"], gene["tss"]))
-
-        try:
-            nearby_enhancers = enhancers.within_range(gene.chr, gene.tss - args.window, gene.tss + args.window)
-            #predictor.add_normalized_data_to_enhancers(gene, nearby_enhancers, domains, loops=None, tss_slop=args.tss_slop)
-            #predictor.add_normalized_data_to_enhancers(gene, nearby_enhancers, tss_slop=args.tss_slop)
-            predictor.predict_from_normalized_to_enhancers(nearby_enhancers, gene, args.window, tss_slop=args.tss_slop)
-            
-            col_names=['chr','start','end','TargetGene','TargetGeneTSS','class','Score.Fraction','Score','distance','hic.distance','hic.distance.adj','estimatedCP','estimatedCP.adj','normalized_dhs','normalized_h3k27ac','TargetGeneExpression','TargetGeneTSSActivityQuantile']
-            if not args.skip_gene_files:
-                if not args.skinny_gene_files:
-                    write_scores(preddir, gene, nearby_enhancers)
-                else:
-                    write_scores(preddir, gene, nearby_enhancers[col_names])
-
-            if args.make_all_putative:
-                all_putative_list.append(nearby_enhancers[col_names])
-            
-            gene_is_expressed_proxy = check_gene_for_runnability(gene, args.expression_cutoff, args.promoter_activity_quantile_cutoff)
-            if args.run_all_genes or gene_is_expressed_proxy:
-                positives = nearby_enhancers.ix[nearby_enhancers[args.score_column] >= args.threshold,:]
-                print("{} enhancers predicted for {}".format(positives.shape[0], gene["name"]))
-                all_positive_list.append(positives)
-
-            #Add gene to gene summary file
-            if nearby_enhancers.shape[0] > 0:
-                stats = predictor.get_gene_prediction_stats(args, nearby_enhancers)
-                stats['prediction_file'] = get_score_filename(gene)
-                stats['gene_is_expressed_proxy'] = gene_is_expressed_proxy
-                gene_stats.append(stats)
-
-            #THINK about whether this is the right thing to do
-            # if any(nearby_enhancers[args.score_column].isnull().tolist()):
-            #     failed_genes.append(gene["chr"] + "\t" + gene["name"])
-
-        except:
-            failed_genes.append(gene["chr"] + "\t" + gene["name"])
-            print("Failed on " + gene["name"] + " ... skipping. Traceback:")
-            traceback.print_exc(file=sys.stdout)
-            continue
-
-    if args.score_column is not None:
-        all_positive = pd.concat(all_positive_list)
-        all_positive.to_csv(pred_file, sep="\t", index=False, header=True, float_format="%.4f")
-        write_connections_bedpe_format(all_positive.loc[all_positive["class"] != "promoter"], outfile=os.path.join(args.outdir, "Predictions_nopromoters.bedpe"), score_column=args.score_column)
-
-    gene_stats = pd.concat(gene_stats, axis=1).T
-    gene_stats.to_csv(os.path.join(args.outdir, "GenePredictionStats.txt"), sep="\t", index=False)
-
-    with open(os.path.join(args.outdir, "FailedGenes.txt"), 'w') as failed_file:
-        for gene in failed_genes:
-            failed_file.write(gene + "\n")
-
-    if args.make_all_putative:
-        all_putative = pd.concat(all_putative_list)
-        all_putative.to_csv(all_pred_file, sep="\t", index=False, header=True, compression="gzip", float_format="%.4f", na_rep="NaN", chunksize=100000)
+    try:
+        with memory_profile.stage("predict_genes"):
+            for i, (run, gene) in enumerate(pbar(genes)):
+                if args.prefetch and i + args.prefetch < len(genes):
+                    prefetch_gene(*genes[i + args.prefetch])
+                predict_gene(run, gene, writer)
+            writer.close()
+    finally:
+        for fetcher in hic_fetchers.values():
+            fetcher.stop_prefetch()
+
+    write_all_outputs(runs)
+
+def write_all_outputs(runs):
+    for run in runs:
+        with memory_profile.stage("write_outputs", run.args.cellType):
+            write_outputs(run)
 
 def write_prediction_params(args, file):
     with open(file, 'w') as outfile:
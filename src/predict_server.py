@@ -0,0 +1,164 @@
+import json
+import time
+import memory_profile
+import traceback
+import pandas as pd
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from predict import get_model_argument_parser, get_cell_type_args, get_enhancer_columns
+from predictor import Predictor, make_hic_fetcher
+from tools import read_genes, read_enhancers, check_gene_for_runnability, compact_dtypes
+
+# Long running prediction service. Enhancers, genes, qnorm normalizers and the Hi-C file index of each cell type are loaded once,
+# then predictions for individual genes or regions are computed on request with the same code path as predict.py.
+#
+# Endpoints (JSON in and out, localhost only by default):
+#   GET  /health          -> loaded cell types
+#   POST /predict/genes   {"genes": ["MYC", ...], "cellType": optional, "threshold": optional, "all_putative": false, "columns": optional}
+#   POST /predict/region  {"chr": "chr8", "start": 127000000, "end": 128000000, ...same optional fields}
+# "columns" is a list of column names or "all". Requests are handled one at a time.
+
+DEFAULT_COLUMNS = ['chr', 'start', 'end', 'name', 'class', 'TargetGene', 'TargetGeneTSS', 'distance', 'hic.distance.adj', 'activity_base', 'ABC.Score.Numerator', 'ABC.Score']
+
+def parseargs():
+    parser = get_model_argument_parser(outdir_required=False)
+    parser.description = 'Serve enhancer-gene predictions from data loaded once'
+    parser.add_argument('--host', default="127.0.0.1", help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8765, help="Port to listen on")
+    return parser.parse_args()
+
+
+class LoadedCellType(object):
+    def __init__(self, args, hic_fetchers):
+        self.args = args
+        load_chromosomes = args.chromosomes.split(",") if args.chromosomes else None
+
+        print("{}: reading genes".format(args.cellType))
+        self.genes = read_genes(args.genes, chromosomes=load_chromosomes).reset_index(drop=True)
+        self.gene_rows = self.genes.groupby('name').indices
+
+        print("{}: reading enhancers".format(args.cellType))
+        self.enhancers = read_enhancers(args.enhancers, columns=get_enhancer_columns(args), chromosomes=load_chromosomes)
+
+        if args.HiCdir not in hic_fetchers:
+            hic_fetchers[args.HiCdir] = make_hic_fetcher(vars(args), cache_size=args.hic_cache_size)
+        self.predictor = Predictor(self.enhancers, hic_fetcher=hic_fetchers[args.HiCdir], **vars(args))
+        self.predictor.add_normalized_data_to_enhancers(self.enhancers)
+        if args.compact_dtypes:
+            self.enhancers.ranges = compact_dtypes(self.enhancers.ranges, categorical=['name'], floats=False)
+        self.chromosomes = set(self.predictor.chromosomes())
+
+    def predict_gene(self, gene, request, region=None):
+        args = self.args
+        result = {'name': gene['name'], 'chr': gene['chr'], 'tss': int(gene['tss'])}
+        if gene['chr'] not in self.chromosomes:
+            result['error'] = "No Hi-C data for {}".format(gene['chr'])
+            return result
+
+        nearby_enhancers = self.enhancers.within_range(gene.chr, gene.tss - args.window, gene.tss + args.window)
+        self.predictor.predict_from_normalized_to_enhancers(nearby_enhancers, gene, args.window, tss_slop=args.tss_slop)
+
+        gene_is_expressed_proxy = bool(check_gene_for_runnability(gene, args.expression_cutoff, args.promoter_activity_quantile_cutoff))
+        result['gene_is_expressed_proxy'] = gene_is_expressed_proxy
+        result['nEnhancersConsidered'] = nearby_enhancers.shape[0]
+
+        if region is not None:
+            chr, start, end = region
+            nearby_enhancers = nearby_enhancers.loc[(nearby_enhancers['start'] < end) & (nearby_enhancers['end'] > start)]
+
+        if not request.get('all_putative', False):
+            threshold = float(request.get('threshold', args.threshold))
+            if args.run_all_genes or gene_is_expressed_proxy:
+                nearby_enhancers = nearby_enhancers.loc[nearby_enhancers['ABC.Score'] >= threshold]
+            else:
+                nearby_enhancers = nearby_enhancers.iloc[0:0]
+
+        columns = request.get('columns', DEFAULT_COLUMNS)
+        if columns != "all":
+            nearby_enhancers = nearby_enhancers[[col for col in columns if col in nearby_enhancers.columns]]
+        #to_json writes NaN as null
+        result['predictions'] = json.loads(nearby_enhancers.to_json(orient='records'))
+        return result
+
+    def predict_genes(self, request):
+        results, missing = [], []
+        for name in request['genes']:
+            if name not in self.gene_rows:
+                missing.append(name)
+                continue
+            for row in self.gene_rows[name]:
+                results.append(self.predict_gene(self.genes.iloc[row], request))
+        return {'genes': results, 'missing': missing}
+
+    def predict_region(self, request):
+        #All genes whose prediction window reaches the region, restricted to elements overlapping the region
+        chr, start, end = str(request['chr']), int(request['start']), int(request['end'])
+        window = self.args.window
+        genes = self.genes.loc[(self.genes['chr'] == chr) & (self.genes['tss'] - window < end) & (self.genes['tss'] + window > start)]
+        return {'genes': [self.predict_gene(gene, request, region=(chr, start, end)) for idx, gene in genes.iterrows()]}
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/health":
+            self.respond(200, {'cellTypes': list(self.server.cell_types)})
+        else:
+            self.respond(404, {'error': "Unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        start = time.time()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            data = self.get_cell_type(request)
+            if self.path == "/predict/genes":
+                response = data.predict_genes(request)
+            elif self.path == "/predict/region":
+                response = data.predict_region(request)
+            else:
+                self.respond(404, {'error': "Unknown path {}".format(self.path)})
+                return
+        except (KeyError, ValueError, TypeError) as e:
+            self.respond(400, {'error': "{}: {}".format(type(e).__name__, e)})
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.respond(500, {'error': "{}: {}".format(type(e).__name__, e)})
+            return
+
+        response['elapsed_ms'] = round(1000 * (time.time() - start), 2)
+        self.respond(200, response)
+
+    def get_cell_type(self, request):
+        cell_types = self.server.cell_types
+        if 'cellType' in request:
+            if request['cellType'] not in cell_types:
+                raise KeyError("cell type {} is not loaded".format(request['cellType']))
+            return cell_types[request['cellType']]
+        if len(cell_types) > 1:
+            raise ValueError("cellType is required when several cell types are loaded")
+        return next(iter(cell_types.values()))
+
+    def respond(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def main():
+    args = parseargs()
+    memory_profile.start(__file__, args.memory_profile)
+    cell_types = args.cellTypes.split(",") if args.cellTypes else [args.cellType]
+
+    hic_fetchers = {}
+    server = HTTPServer((args.host, args.port), PredictionHandler)
+    server.cell_types = {}
+    for cellType in cell_types:
+        with memory_profile.stage("load_cell_type", cellType):
+            server.cell_types[cellType] = LoadedCellType(get_cell_type_args(args, cellType), hic_fetchers)
+    print("Serving predictions for {} on http://{}:{}".format(", ".join(cell_types), args.host, args.port))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
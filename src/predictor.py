@@ -7,16 +7,14 @@ import sys
 
 
 class Predictor(object):
-    def __init__(self, loaded_enhancers, **args):
+    def __init__(self, loaded_enhancers, hic_fetcher=None, **args):
 
         self.cellType = args['cellType']
 
-        #HiC
-        self.hic_fetcher = HiCFetcher(args['HiCdir'], 
-                                        args['hic_gamma'],  
-                                        args['hic_gamma_reference'],
-                                        scale_with_powerlaw=args['scale_hic_using_powerlaw'],
-                                        tss_hic_contribution=args['tss_hic_contribution'])
+        #HiC. A fetcher can be shared between predictors of cell types using the same Hi-C directory
+        if hic_fetcher is None:
+            hic_fetcher = make_hic_fetcher(args)
+        self.hic_fetcher = hic_fetcher
 
         #Power Law
         if args['scale_hic_using_powerlaw']:
@@ -66,20 +64,7 @@ class Predictor(object):
         enhancers['isSelfPromoter'] = np.logical_and.reduce((enhancers.isPromoterElement == True, enhancers.start - tss_slop < gene.tss, enhancers.end + tss_slop > gene.tss))
         # enhancers['isSelfGenic'] = np.logical_or(np.logical_and(enhancers.start > gene.start,enhancers.start < gene.end),
         #                                                 np.logical_and(enhancers.end > gene.start, enhancers.end < gene.end))
-        enhancers['TargetGene'] = gene['name']
-        enhancers['TargetGeneTSS'] = gene['tss']
-        if 'is_ue' in gene:
-            enhancers['TargetGeneIsUbiquitouslyExpressed'] = gene['is_ue']
-
-        if 'Expression' in gene.index:
-            enhancers['TargetGeneExpression'] = gene['Expression'] 
-        else: 
-            enhancers['TargetGeneExpression'] = np.nan 
-
-        if 'PromoterActivityQuantile' in gene.index:
-            enhancers['TargetGenePromoterActivityQuantile'] = gene['PromoterActivityQuantile'] 
-        else: 
-            enhancers['TargetGenePromoterActivityQuantile'] = np.nan
+        self.annotate_target_gene(enhancers, gene)
 
         is_self_tss = enhancers['isSelfPromoter'].values
         if sum(is_self_tss) == 0:
@@ -114,6 +99,23 @@ class Predictor(object):
         enhancers = compute_score(enhancers, [enhancers['activity_base'], enhancers['estimatedCP.adj']], "powerlaw")
         #enhancers = compute_score(enhancers, [enhancers['activity_base_noqnorm'], enhancers['hic.distance.adj']], "ABC.noqnorm")
 
+    def annotate_target_gene(self, enhancers, gene):
+        #The only columns that depend on the gene beyond its chromosome and TSS
+        enhancers['TargetGene'] = gene['name']
+        enhancers['TargetGeneTSS'] = gene['tss']
+        if 'is_ue' in gene:
+            enhancers['TargetGeneIsUbiquitouslyExpressed'] = gene['is_ue']
+
+        if 'Expression' in gene.index:
+            enhancers['TargetGeneExpression'] = gene['Expression'] 
+        else: 
+            enhancers['TargetGeneExpression'] = np.nan 
+
+        if 'PromoterActivityQuantile' in gene.index:
+            enhancers['TargetGenePromoterActivityQuantile'] = gene['PromoterActivityQuantile'] 
+        else: 
+            enhancers['TargetGenePromoterActivityQuantile'] = np.nan
+
     def __call__(self, *args, **kwargs):
         return self.predict(*args, **kwargs)
 
@@ -153,6 +155,14 @@ class Predictor(object):
         enhancers.ranges.loc[~is_promoter, 'normalized_h3k27ac'] = self.H3K27ac_normalizer_nonpromoter(enhancers.ranges.loc[~is_promoter][self.H3K27ac_column])
 
 
+def make_hic_fetcher(args, cache_size=1):
+    return HiCFetcher(args['HiCdir'],
+                      args['hic_gamma'],
+                      args['hic_gamma_reference'],
+                      scale_with_powerlaw=args['scale_hic_using_powerlaw'],
+                      tss_hic_contribution=args['tss_hic_contribution'],
+                      cache_size=cache_size)
+
 def compute_score(enhancers, product_terms, prefix):
 
     scores = np.column_stack(product_terms).prod(axis = 1)
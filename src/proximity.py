@@ -5,6 +5,8 @@ import os.path
 from intervaltree import IntervalTree
 import pdb
 import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 class HiCFetcher(object):
     def __init__(self, dir, 
@@ -12,7 +14,8 @@ class HiCFetcher(object):
                  hic_gamma_reference=1,
                  scale_with_powerlaw=False, 
                  resolution=5000,
-                 tss_hic_contribution=100):
+                 tss_hic_contribution=100,
+                 cache_size=1):
         self.dir = dir
         self.hic_gamma = hic_gamma
         self.hic_gamma_reference = hic_gamma_reference
@@ -22,6 +25,16 @@ class HiCFetcher(object):
         self.adjust_diag = True
         self.tss_hic_contribution = tss_hic_contribution
 
+        # Recently loaded bedgraphs (after diagonal adjustment and normalization), so that a fetcher shared
+        # between several cell types reads each gene's Hi-C row once
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        # Bedgraphs being read ahead of use by start_prefetch/prefetch, as futures by filename
+        self.prefetch_pool = None
+        self.pending = OrderedDict()
+        self.max_pending = 0
+
         # Fetch Hi-C data bedgraphs
         filenames = glob.glob(os.path.join(dir, '*chr*.bg.gz'))
         chroms = [f.split('.')[-3].split('_')[-2] for f in filenames]
@@ -37,13 +50,10 @@ class HiCFetcher(object):
     def chromosomes(self):
         return self._chromosomes
 
-    def query(self, chr, row, cols, enhancers, debug=False):
+    def find_interval(self, chr, row, debug=False):
         intervals = list(self.file_intervals[chr][(row - self.resolution):(row + self.resolution)])
         if len(intervals) == 0:
-            #raise RuntimeError("Could not find HiC data for {}:{}".format(chr, row))
-            # return [0] * len(cols), 100
-            print("Could not find HiC data for {}:{}".format(chr, row))
-            return np.full([len(cols), ], np.nan), np.nan, False, np.nan, np.nan
+            return None
 
         if debug:
             print(intervals)
@@ -53,33 +63,21 @@ class HiCFetcher(object):
         for i in intervals:
             if abs(row - (i.begin + i.end) / 2) < abs(row - (best_interval.begin + best_interval.end)):
                 best_interval = i
+        return best_interval
 
-        # load bedgraph    
-        try:
-            df = pandas.read_table(best_interval.data, compression='gzip', header=None)
-            df.columns = ['chr', 'start', 'end', 'val']
-        except:
-            print("Count not load: " + best_interval.data)
+    def query(self, chr, row, cols, enhancers, debug=False):
+        best_interval = self.find_interval(chr, row, debug)
+        if best_interval is None:
+            #raise RuntimeError("Could not find HiC data for {}:{}".format(chr, row))
+            # return [0] * len(cols), 100
+            print("Could not find HiC data for {}:{}".format(chr, row))
             return np.full([len(cols), ], np.nan), np.nan, False, np.nan, np.nan
-        
-        #Adjust entry on the diagonal of the Hi-C matrix.
-        if self.adjust_diag:
-            diag_start = int(np.floor(best_interval[0] / self.resolution)*self.resolution)
-            diag_end = int(np.ceil(best_interval[1] / self.resolution)*self.resolution)
-            diag_idx = np.logical_and(df.start == diag_start, df.end == diag_end)
-            assert(sum(diag_idx) <= 1)
 
-            #Replace diagonal bin with max of neighboring bins multiplied by tss-scaling factor
-            df.loc[diag_idx, 'val'] = df.loc[[diag_idx.idxmax() - 1, diag_idx.idxmax() + 1], 'val'].max() * self.tss_hic_contribution / 100
+        df = self.load_row(best_interval)
+        if df is None:
+            return np.full([len(cols), ], np.nan), np.nan, False, np.nan, np.nan
 
-        #Normalize to sum to 1
-        df.val /= df.val.sum()
-        
-        # find entries, handling missing data
-        col_indices = np.searchsorted(df.start, cols, side='right') - 1
-        valid = ((df.start[col_indices] <= cols) & (df.end[col_indices] > cols)).values
-        values = np.zeros(len(cols))
-        values[valid] = df.val[col_indices[valid]]
+        values = self.lookup(df, cols)
         rowmax = max(df.val)
 
         # Scale with respect to reference powerlaw 
@@ -96,6 +94,77 @@ class HiCFetcher(object):
 
         return values_scaled, rowmax_scaled, True, values, rowmax
 
+    def lookup(self, df, cols):
+        # find entries, handling missing data. Bins may have different widths (see hic_pyramid.py)
+        col_indices = np.searchsorted(df.start, cols, side='right') - 1
+        valid = ((df.start[col_indices] <= cols) & (df.end[col_indices] > cols)).values
+        values = np.zeros(len(cols))
+        values[valid] = df.val[col_indices[valid]]
+        return values
+
+    def start_prefetch(self, threads, max_pending):
+        # Read bedgraphs on a thread pool ahead of use. Reads are independent of the cache, which is only used from the calling thread
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = max_pending
+
+    def stop_prefetch(self):
+        if self.prefetch_pool is not None:
+            self.prefetch_pool.shutdown(wait=True, cancel_futures=True)
+        self.prefetch_pool = None
+        self.pending.clear()
+
+    def prefetch(self, chr, row):
+        # Start reading the bedgraph query(chr, row, ...) will use, unless it is cached or already being read
+        if self.prefetch_pool is None or chr not in self.file_intervals:
+            return
+        interval = self.find_interval(chr, row)
+        if interval is None or interval.data in self.cache or interval.data in self.pending:
+            return
+        self.pending[interval.data] = self.prefetch_pool.submit(self.read_bedgraph, interval)
+        # Reads for genes that ended up not being queried are dropped, oldest first
+        while len(self.pending) > self.max_pending:
+            self.pending.popitem(last=False)[1].cancel()
+
+    def load_row(self, interval):
+        if interval.data in self.cache:
+            self.cache.move_to_end(interval.data)
+            return self.cache[interval.data]
+
+        if interval.data in self.pending:
+            df = self.pending.pop(interval.data).result()
+        else:
+            df = self.read_bedgraph(interval)
+        if self.cache_size > 0:
+            self.cache[interval.data] = df
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return df
+
+    def read_bedgraph(self, best_interval):
+        # load bedgraph    
+        try:
+            df = pandas.read_table(best_interval.data, compression='gzip', header=None)
+            df.columns = ['chr', 'start', 'end', 'val']
+        except:
+            print("Count not load: " + best_interval.data)
+            return None
+        
+        #Adjust entry on the diagonal of the Hi-C matrix.
+        if self.adjust_diag:
+            diag_start = int(np.floor(best_interval[0] / self.resolution)*self.resolution)
+            diag_end = int(np.ceil(best_interval[1] / self.resolution)*self.resolution)
+            diag_idx = np.logical_and(df.start == diag_start, df.end == diag_end)
+            assert(sum(diag_idx) <= 1)
+
+            #Replace diagonal bin with max of neighboring bins multiplied by tss-scaling factor
+            df.loc[diag_idx, 'val'] = df.loc[[diag_idx.idxmax() - 1, diag_idx.idxmax() + 1], 'val'].max() * self.tss_hic_contribution / 100
+
+        #Normalize to sum to 1. Bins of multi-resolution bedgraphs (see hic_pyramid.py) hold the mean of the bins they cover,
+        #so each counts (end - start) / resolution times. For single resolution bedgraphs this is the plain sum
+        df.val /= (df.val * ((df.end - df.start) / self.resolution)).sum()
+
+        return df
+
     def __call__(self, *args, **kwargs):
         return self.query(*args, **kwargs)
 
@@ -0,0 +1,178 @@
+import argparse
+import gzip
+import io
+import memory_profile
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pysam
+
+# Position indexed prediction files and queries against them.
+# predict.py --write_indexed writes each prediction table twice, as bgzip compressed, tabix indexed text:
+#   {prefix}.txt.gz        sorted and indexed on the element coordinates (chr, start, end)
+#   {prefix}.byTSS.txt.gz  sorted and indexed on the target gene TSS (chr, TargetGeneTSS)
+# Both keep the header line, and can be read whole with zcat or pandas as before.
+# Queries only decompress the blocks that overlap the query regions.
+
+def parseargs():
+    class formatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawTextHelpFormatter):
+        pass
+
+    parser = argparse.ArgumentParser(description='Return predictions overlapping a set of regions from an indexed prediction file',
+                                     formatter_class=formatter)
+    parser.add_argument('--predictions', required=True, help="Indexed prediction file written by predict.py --write_indexed, e.g. EnhancerPredictionsAllPutative.txt.gz")
+    parser.add_argument('--regions', default="", help="Bed file of query regions (chr, start, end, optional name)")
+    parser.add_argument('--region', action='append', default=[], help="Query region as chr:start-end (0-based, end exclusive). May be repeated")
+    parser.add_argument('--tss', action="store_true", help="Match regions against the target gene TSS instead of the element. Uses {prefix}.byTSS.txt.gz")
+    parser.add_argument('--out', default="", help="Output file. Defaults to stdout")
+    memory_profile.add_argument(parser)
+    return parser.parse_args()
+
+
+def get_tss_indexed_filename(filename):
+    return filename[:-len(".txt.gz")] + ".byTSS.txt.gz"
+
+def write_indexed_predictions(predictions, filename, float_format="%.4f"):
+    #Write predictions to filename (.txt.gz) sorted by element, and to the .byTSS.txt.gz file sorted by target gene TSS, both tabix indexed
+    columns = list(predictions.columns)
+    write_indexed_table(predictions.sort_values(['chr', 'start', 'end'], kind='mergesort'), filename,
+                        columns.index('chr'), columns.index('start'), columns.index('end'), zerobased=True, float_format=float_format)
+
+    #tabix intervals are 1-based when not zerobased, so a TSS is indexed as the single base [TSS, TSS]
+    tss_col = columns.index('TargetGeneTSS')
+    write_indexed_table(predictions.sort_values(['chr', 'TargetGeneTSS', 'start'], kind='mergesort'), get_tss_indexed_filename(filename),
+                        columns.index('chr'), tss_col, tss_col, zerobased=False, float_format=float_format)
+
+def merge_indexed_predictions(filenames, filename, float_format="%.4f"):
+    #Combine indexed prediction files of consecutive parts of the gene list (predict.py --shard) into one.
+    #Each file is sorted stably, so re-sorting their concatenation gives the order of a single file written from all genes
+    header = read_header(filenames[0])
+    by_element = pd.concat([pd.read_csv(f, sep="\t", dtype={'chr': str}) for f in filenames], ignore_index=True)
+    write_indexed_table(by_element.sort_values(['chr', 'start', 'end'], kind='mergesort'), filename,
+                        header.index('chr'), header.index('start'), header.index('end'), zerobased=True, float_format=float_format)
+    del by_element
+
+    tss_col = header.index('TargetGeneTSS')
+    by_tss = pd.concat([pd.read_csv(get_tss_indexed_filename(f), sep="\t", dtype={'chr': str}) for f in filenames], ignore_index=True)
+    write_indexed_table(by_tss.sort_values(['chr', 'TargetGeneTSS', 'start'], kind='mergesort'), get_tss_indexed_filename(filename),
+                        header.index('chr'), tss_col, tss_col, zerobased=False, float_format=float_format)
+
+def write_indexed_table(table, filename, seq_col, start_col, end_col, zerobased, float_format):
+    assert filename.endswith(".gz")
+    tmp = filename[:-len(".gz")] + ".{}.tmp".format(os.getpid())
+    try:
+        table.to_csv(tmp, sep="\t", index=False, header=True, float_format=float_format, na_rep="NaN")
+        pysam.tabix_index(tmp, seq_col=seq_col, start_col=start_col, end_col=end_col, zerobased=zerobased, line_skip=1, force=True)
+        os.replace(tmp + ".gz.tbi", filename + ".tbi")
+        os.replace(tmp + ".gz", filename)
+    finally:
+        for f in [tmp, tmp + ".gz", tmp + ".gz.tbi"]:
+            if os.path.exists(f):
+                os.remove(f)
+
+
+def read_header(filename):
+    with gzip.open(filename, 'rt') as f:
+        return f.readline().rstrip("\n").split("\t")
+
+def merge_query_blocks(starts, ends):
+    #Overlapping or book-ended queries (sorted by start) are fetched together. Returns index bounds and coordinates of each block
+    block_ends = np.maximum.accumulate(ends)
+    new_block = np.concatenate(([True], starts[1:] > block_ends[:-1]))
+    bounds = np.append(np.flatnonzero(new_block), len(starts))
+    return [(i, j, int(starts[i]), int(block_ends[j - 1])) for i, j in zip(bounds[:-1], bounds[1:])]
+
+def query_predictions(filename, regions, tss=False):
+    #Predictions overlapping each region (chr, start, end[, name]; 0-based, end exclusive) as one data frame,
+    #with the query prepended as query_chr, query_start, query_end[, query_name]. A prediction matching several regions is repeated.
+    #With tss=True a prediction matches if its TargetGeneTSS lies in the region
+    if tss:
+        filename = get_tss_indexed_filename(filename)
+    header = read_header(filename)
+    regions = regions.reset_index(drop=True)
+    results = []
+
+    with pysam.TabixFile(filename) as tbx:
+        contigs = set(tbx.contigs)
+        for chr, idx in regions.groupby('chr', sort=False).indices.items():
+            if chr not in contigs:
+                continue
+            idx = idx[np.argsort(regions['start'].values[idx], kind='mergesort')]
+            starts = regions['start'].values[idx]
+            ends = regions['end'].values[idx]
+
+            #Fetch each block of queries once. Rows of a block are sorted by start (or TSS), so the rows matching
+            #a query are found by binary search within its block
+            lines, query_blocks = [], np.zeros(len(idx), dtype=np.int64)
+            block_bounds = []
+            for i, j, block_start, block_end in merge_query_blocks(starts, ends):
+                if tss:
+                    fetched = list(tbx.fetch(chr, max(block_start - 1, 0), max(block_end - 1, 1)))
+                else:
+                    fetched = list(tbx.fetch(chr, block_start, max(block_end, block_start + 1)))
+                query_blocks[i:j] = len(block_bounds)
+                block_bounds.append((len(lines), len(lines) + len(fetched)))
+                lines += fetched
+            if len(lines) == 0:
+                continue
+
+            table = pd.read_csv(io.StringIO("\n".join(lines)), sep="\t", header=None, names=header, dtype={'chr': str})
+            query_rows, table_rows = match_queries(table, np.array(block_bounds)[query_blocks], starts, ends, tss)
+            matched = regions.iloc[idx[query_rows]].add_prefix('query_').reset_index(drop=True)
+            results.append(pd.concat([matched, table.iloc[table_rows].reset_index(drop=True)], axis=1))
+
+    if len(results) == 0:
+        return pd.DataFrame(columns=query_columns(regions) + header)
+    return pd.concat(results, ignore_index=True)
+
+def query_columns(regions):
+    return ['query_' + col for col in regions.columns]
+
+def match_queries(table, bounds, starts, ends, tss):
+    #(query, table row) pairs for each query [start, end) and the rows [bounds[:, 0], bounds[:, 1]) fetched for its block
+    lo = np.zeros(len(starts), dtype=np.int64)
+    hi = np.zeros(len(starts), dtype=np.int64)
+    if tss:
+        positions = table['TargetGeneTSS'].values
+        for q, (a, b) in enumerate(bounds):
+            lo[q] = a + np.searchsorted(positions[a:b], starts[q], side='left')
+            hi[q] = a + np.searchsorted(positions[a:b], ends[q], side='left')
+    else:
+        table_starts = table['start'].values
+        max_length = int((table['end'].values - table_starts).max())
+        for q, (a, b) in enumerate(bounds):
+            lo[q] = a + np.searchsorted(table_starts[a:b], starts[q] - max_length, side='left')
+            hi[q] = a + np.searchsorted(table_starts[a:b], ends[q], side='left')
+
+    counts = hi - lo
+    query_rows = np.repeat(np.arange(len(starts)), counts)
+    table_rows = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    if not tss:
+        keep = table['end'].values[table_rows] > starts[query_rows]
+        query_rows, table_rows = query_rows[keep], table_rows[keep]
+    return query_rows, table_rows
+
+def read_query_regions(args):
+    regions = []
+    if args.regions:
+        bed = pd.read_csv(args.regions, sep="\t", header=None, comment='#', dtype={0: str})
+        bed = bed.iloc[:, :min(4, bed.shape[1])]
+        bed.columns = ['chr', 'start', 'end', 'name'][:bed.shape[1]]
+        regions.append(bed)
+    for region in args.region:
+        chr, coords = region.rsplit(":", 1)
+        start, end = coords.replace(",", "").split("-")
+        regions.append(pd.DataFrame({'chr': [chr], 'start': [int(start)], 'end': [int(end)]}))
+    if len(regions) == 0:
+        raise ValueError("Give query regions with --regions or --region")
+    return pd.concat(regions, ignore_index=True)
+
+def main():
+    args = parseargs()
+    memory_profile.start(__file__, args.memory_profile)
+    result = query_predictions(args.predictions, read_query_regions(args), tss=args.tss)
+    result.to_csv(args.out if args.out else sys.stdout, sep="\t", index=False, header=True, na_rep="NaN")
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 import argparse
 import os
+import shutil
+import memory_profile
 from neighborhoods import *
 from subprocess import getoutput
 
@@ -28,6 +30,13 @@ def parseargs(required_args=True):
 
     parser.add_argument('--tss_slop_for_class_assignment', default=500, type=int, help="Consider an element a promoter if it is within this many bp of a tss")
     parser.add_argument('--skip_rpkm_quantile', action="store_true", help="Do not compute RPKM and quantiles in EnhancerList")
+    parser.add_argument('--threads', default=1, type=int, help="Number of worker processes used to count reads (one chromosome per worker)")
+    parser.add_argument('--count_jobs', default=1, type=int, help="Number of feature files (features x replicates) to count at the same time, in worker processes. Each job uses up to --threads processes")
+    parser.add_argument('--cache_dir', default=None, help="Directory for cached read counts and library sizes, can be shared between runs and users. Defaults to $ABC_CACHE_DIR; nothing is cached when neither is set")
+    parser.add_argument('--force', action="store_true", help="Recount reads even if counts are cached")
+    parser.add_argument('--compact_dtypes', action="store_true", help="Hold tables with int32 coordinates, float32 signals and categorical strings to reduce memory. Values written to EnhancerList/GeneList agree with the default mode to float32 precision")
+    parser.add_argument('--write_parquet', action="store_true", help="Also write EnhancerList and GeneList as parquet datasets partitioned by chromosome (requires pyarrow), read by predict.py --neighborhoods_format parquet. Without this option, parquet datasets from earlier runs are removed")
+    memory_profile.add_argument(parser)
 
     # replace textio wrapper returned by argparse with actual filename
     args = parser.parse_args()
@@ -41,38 +50,70 @@ def processCellType(cellType, args):
     params = parse_params_file(cellType, args)
 
     params["outdir"] = args.outdir
+    params["threads"] = args.threads
+    params["count_jobs"] = args.count_jobs
+    params["cache_dir"] = args.cache_dir
+    params["compact"] = args.compact_dtypes
     os.makedirs(params["outdir"], exist_ok=True)
 
     genome_params = pd.read_csv(args.genome, sep="\t").set_index("name").T.to_dict()
     genome = genome_params[params['genome_build']]
 
     #Setup Genes
-    genes = load_genes(file = genome['genes'], 
-                        ue_file = genome['ue_genes'], 
-                        outdir = params["outdir"], 
-                        expression_table_list = params["expression_table"], 
-                        gene_id_names = args.gene_name_annotations, 
-                        primary_id = args.primary_gene_identifier)
-    genes = annotate_genes_with_features(genes = genes, 
-                                            genome = genome, 
-                                            **params)
+    with stage("load_genes", cellType):
+        genes = load_genes(file = genome['genes'], 
+                            ue_file = genome['ue_genes'], 
+                            outdir = params["outdir"], 
+                            expression_table_list = params["expression_table"], 
+                            gene_id_names = args.gene_name_annotations, 
+                            primary_id = args.primary_gene_identifier)
+
+    #Count each feature file once against genes, gene promoters and candidate regions.
+    #annotate_genes_with_features and load_enhancers then load the counts from the CountReads files, which are newer than
+    #their inputs (the gene beds are only rewritten when their contents change, see write_table_if_changed)
+    tss1kb, tss1kb_file = write_tss1kb_bed(genes, params["outdir"])
+    region_sets = {"Genes" : os.path.join(params["outdir"], "GeneList.bed"),
+                    "Genes.TSS1kb" : tss1kb_file,
+                    "Enhancers" : args.candidate_enhancer_regions}
+    with stage("count_features", cellType):
+        count_features_for_region_sets(region_sets, genome['sizes'], params["features"], params["outdir"], 
+                                        force=args.force, threads=params["threads"], count_jobs=params["count_jobs"], cache_dir=params["cache_dir"])
+
+    with stage("annotate_genes", cellType):
+        genes = annotate_genes_with_features(genes = genes, 
+                                                genome = genome, 
+                                                **params)
     genes.to_csv(os.path.join(params["outdir"], "GeneList.txt"),
                  sep='\t', index=False, header=True, float_format="%.6f")
+    write_parquet_copy(os.path.join(params["outdir"], "GeneList"), args.write_parquet)
 
     #Setup Candidate Enhancers
-    enhancers = load_enhancers(genes=genes, 
-                                genome_sizes=genome['sizes'], 
-                                candidate_peaks=args.candidate_enhancer_regions, 
-                                skip_rpkm_quantile=args.skip_rpkm_quantile, 
-                                cellType=cellType, 
-                                tss_slop_for_class_assignment=args.tss_slop_for_class_assignment,
-                                **params)
+    with stage("load_enhancers", cellType):
+        enhancers = load_enhancers(genes=genes, 
+                                    genome_sizes=genome['sizes'], 
+                                    candidate_peaks=args.candidate_enhancer_regions, 
+                                    skip_rpkm_quantile=args.skip_rpkm_quantile, 
+                                    cellType=cellType, 
+                                    tss_slop_for_class_assignment=args.tss_slop_for_class_assignment,
+                                    **params)
     enhancers.to_csv(os.path.join(params['outdir'], "EnhancerList.txt"),
                 sep='\t', index=False, header=True, float_format="%.6f")
+    write_parquet_copy(os.path.join(params["outdir"], "EnhancerList"), args.write_parquet)
     enhancers[['chr', 'start', 'end', 'name']].to_csv(os.path.join(params['outdir'], "EnhancerList.bed"),
                 sep='\t', index=False, header=False)
 
+def write_parquet_copy(prefix, write):
+    #The parquet copy is made from the .txt just written, so both hold the same (rounded) values.
+    #A copy left from an earlier run would no longer match the .txt, so it is removed when not rewritten
+    parquet = prefix + ".parquet"
+    if write:
+        write_table_by_chromosome(load_table(prefix + ".txt"), parquet)
+    elif os.path.exists(parquet):
+        print("Removing {}, which is out of date".format(parquet))
+        shutil.rmtree(parquet)
+
 def main(args):
+    memory_profile.start(__file__, args.memory_profile)
     processCellType(args.cellType, args)
 
 if __name__ == '__main__':
@@ -0,0 +1,293 @@
+import argparse
+import ast
+import hashlib
+import json
+import memory_profile
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import warnings
+import pandas as pd
+from tools import atomic_write, file_identity, file_digest
+from scheduler import JobGraph
+
+# Runs the ABC pipeline (curateFeatures -> run.neighborhoods -> predict for each cell type, plus optional Hi-C processing)
+# as a dependency graph of stages. Each stage declares its input files, command line and outputs.
+# A stage is skipped when its outputs exist and the hash of its inputs and command line matches the previous successful run.
+# Independent stages (e.g. different cell types) run in parallel.
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def parseargs():
+    class formatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawTextHelpFormatter):
+        pass
+
+    parser = argparse.ArgumentParser(description='Run the ABC pipeline for one or more cell types, skipping stages whose inputs are unchanged',
+                                     formatter_class=formatter)
+    parser.add_argument('--params_file', required=True, help="File listing feature files for each cell type")
+    parser.add_argument('--genome', required=True, help="File listing genome annotations for each species/build")
+    parser.add_argument('--outdir', required=True, help="Output directory. Each cell type gets {outdir}/{cellType}/Peaks, Neighborhoods and Predictions")
+    parser.add_argument('--cellTypes', default="", help="Comma delimited list of cell types to run. Defaults to all cell types in params_file")
+    parser.add_argument('--threshold', type=float, required=True, help="Threshold on ABC Score passed to predict.py")
+
+    parser.add_argument('--candidate_enhancer_regions', default="", help="Bed file of candidate regions used for all cell types. If not given, curateFeatures.py is run and the candidate regions of the first default accessibility file are used")
+    parser.add_argument('--HiC_directory_listing', default="", help="File mapping hic cell types to bedgraph directories, passed to predict.py")
+    parser.add_argument('--hic_raw_dir', default="", help="Directory of juicebox_dump.py output. If given, bedgraphs and the powerlaw fit are made from it and used for cell types with hic_cell_type equal to --hic_cell_type")
+    parser.add_argument('--hic_cell_type', default="", help="hic_cell_type the matrices in --hic_raw_dir belong to")
+    parser.add_argument('--hic_resolution', type=int, default=5000, help="Resolution of the matrices in --hic_raw_dir")
+
+    parser.add_argument('--curate_args', default="", help="Extra arguments for curateFeatures.py")
+    parser.add_argument('--neighborhoods_args', default="", help="Extra arguments for run.neighborhoods.py")
+    parser.add_argument('--predict_args', default="", help="Extra arguments for predict.py")
+
+    parser.add_argument('--threads', type=int, default=1, help="Number of stages to run at once")
+    parser.add_argument('--force', action="store_true", help="Run all stages even if their inputs are unchanged")
+    parser.add_argument('--memory_profile', default=None, help="Directory for memory reports. Every stage that runs writes one (see memory_profile.py), and memory_summary.txt in it gives the peak and a suggested memory request for each script")
+    return parser.parse_args()
+
+
+class Stage(object):
+    def __init__(self, name, script, arguments, inputs, outputs, deps=()):
+        self.name = name
+        self.command = [sys.executable, os.path.join(SRC_DIR, script)] + [str(arg) for arg in arguments]
+        #The script and the modules it imports are inputs too, so a stage reruns when its code changes
+        self.inputs = list(inputs) + get_local_modules(self.command[1])
+        self.outputs = outputs
+        self.deps = deps
+
+
+def get_local_modules(script):
+    #script and the modules in SRC_DIR it imports, directly or through other modules in SRC_DIR (including imports inside functions)
+    modules = set()
+    todo = [script]
+    while todo:
+        path = todo.pop()
+        if path in modules:
+            continue
+        modules.add(path)
+        with open(path) as f, warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = os.path.join(SRC_DIR, name.split(".")[0] + ".py")
+                if os.path.exists(module):
+                    todo.append(module)
+    return sorted(modules)
+
+
+class InputHasher(object):
+    # sha1 of file contents, memoized by file identity (path, size, mtime) across runs so unchanged inputs are only read once.
+    # Directories hash the relative paths and contents of all files below them
+    def __init__(self, state_dir):
+        self.filename = os.path.join(state_dir, "digests.json")
+        self.lock = threading.Lock()
+        self.digests = {}
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self.digests = json.load(f)
+
+    def digest(self, path):
+        if os.path.isdir(path):
+            digest = hashlib.sha1()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    filename = os.path.join(root, name)
+                    digest.update(os.path.relpath(filename, path).encode())
+                    digest.update(self.digest(filename).encode())
+            return digest.hexdigest()
+
+        identity = file_identity(path)
+        with self.lock:
+            if identity in self.digests:
+                return self.digests[identity]
+        digest = file_digest(path)
+        with self.lock:
+            self.digests[identity] = digest
+        return digest
+
+    def save(self):
+        with self.lock:
+            with atomic_write(self.filename) as tmp:
+                with open(tmp, 'w') as f:
+                    json.dump(self.digests, f)
+
+
+class Pipeline(object):
+    def __init__(self, outdir, threads=1, force=False):
+        self.outdir = outdir
+        self.state_dir = os.path.join(outdir, ".pipeline")
+        os.makedirs(os.path.join(self.state_dir, "logs"), exist_ok=True)
+        self.hasher = InputHasher(self.state_dir)
+        self.threads = threads
+        self.force = force
+        self.stages = []
+        self.status = {}
+
+    def add(self, stage):
+        self.stages.append(stage)
+        return stage.name
+
+    def fingerprint(self, stage):
+        #Inputs are hashed when the stage is about to run, so outputs of upstream stages are hashed after they are written
+        missing = [path for path in stage.inputs if not os.path.exists(path)]
+        if missing:
+            raise ValueError("Stage {} is missing inputs: {}".format(stage.name, ", ".join(missing)))
+        state = {'command': stage.command[1:],
+                 'inputs': {os.path.abspath(path): self.hasher.digest(path) for path in sorted(set(stage.inputs))}}
+        return hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+    def run_stage(self, stage):
+        state_file = os.path.join(self.state_dir, stage.name + ".json")
+        fingerprint = self.fingerprint(stage)
+        if not self.force and os.path.exists(state_file) and all(os.path.exists(path) for path in stage.outputs):
+            with open(state_file) as f:
+                if json.load(f)['fingerprint'] == fingerprint:
+                    print("Skipping {}: inputs unchanged".format(stage.name))
+                    self.status[stage.name] = "skipped"
+                    return
+
+        log_file = os.path.join(self.state_dir, "logs", stage.name + ".log")
+        print("Running {}: {}".format(stage.name, " ".join(shlex.quote(arg) for arg in stage.command)))
+        with open(log_file, 'w') as log:
+            result = subprocess.run(stage.command, stdout=log, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            self.status[stage.name] = "failed"
+            raise RuntimeError("Stage {} failed with exit code {}. See {}".format(stage.name, result.returncode, log_file))
+        missing = [path for path in stage.outputs if not os.path.exists(path)]
+        if missing:
+            self.status[stage.name] = "failed"
+            raise RuntimeError("Stage {} did not write {}. See {}".format(stage.name, ", ".join(missing), log_file))
+
+        with atomic_write(state_file) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump({'fingerprint': fingerprint, 'command': stage.command[1:]}, f)
+        self.status[stage.name] = "ran"
+
+    def run(self):
+        jobs = JobGraph(max_cpus=self.threads)
+        for stage in self.stages:
+            jobs.add(stage.name, self.run_stage, stage, deps=stage.deps)
+        try:
+            jobs.run()
+        finally:
+            self.hasher.save()
+            self.write_report(jobs.timings)
+
+    def write_report(self, timings):
+        report = pd.DataFrame({'stage': [stage.name for stage in self.stages]})
+        report['status'] = [self.status.get(stage.name, "not run") for stage in self.stages]
+        report['seconds'] = [round(timings.get(stage.name, 0), 1) for stage in self.stages]
+        report.to_csv(os.path.join(self.outdir, "pipeline_report.txt"), sep='\t', index=False)
+        print(report.to_string(index=False))
+
+
+def split_files(value):
+    #Comma delimited file list from the params file. Empty cells are NaN
+    if pd.isnull(value) or value in ("", "NA"):
+        return []
+    return str(value).split(",")
+
+def existing_files(arguments):
+    #Arguments in extra argument strings that name files are treated as stage inputs
+    return [arg for arg in arguments if os.path.isfile(arg)]
+
+def build_pipeline(args):
+    params = pd.read_csv(args.params_file, sep='\t')
+    genomes = pd.read_csv(args.genome, sep='\t').set_index('name')
+    cell_types = args.cellTypes.split(",") if args.cellTypes else params['cell_type'].tolist()
+    pipeline = Pipeline(args.outdir, args.threads, args.force)
+
+    curate_args = shlex.split(args.curate_args)
+    neighborhoods_args = shlex.split(args.neighborhoods_args)
+    predict_args = shlex.split(args.predict_args)
+
+    #Optional Hi-C processing. Bedgraphs are made for the genes of the first cell type's genome
+    hic_stage = None
+    hic_listing = args.HiC_directory_listing
+    if args.hic_raw_dir:
+        hic_dir = os.path.join(args.outdir, "HiC")
+        bedgraph_dir = os.path.join(hic_dir, "bedgraph")
+        first_genome = genomes.loc[params.loc[params['cell_type'] == cell_types[0], 'genome'].values[0]]
+        hic_stage = pipeline.add(Stage("hic_bedgraph", "make_bedgraph_from_HiC.py",
+                                       ['--outdir', bedgraph_dir, '--hic_dir', args.hic_raw_dir, '--genes', first_genome['genes'], '--resolution', args.hic_resolution],
+                                       inputs=[args.hic_raw_dir, first_genome['genes']],
+                                       outputs=[bedgraph_dir]))
+        pipeline.add(Stage("hic_powerlaw", "compute_powerlaw_fit_from_hic.py",
+                           ['--hicDir', args.hic_raw_dir, '--outDir', os.path.join(hic_dir, "powerlaw"), '--resolution', args.hic_resolution],
+                           inputs=[args.hic_raw_dir],
+                           outputs=[os.path.join(hic_dir, "powerlaw", "hic.powerlaw.txt")]))
+
+        os.makedirs(hic_dir, exist_ok=True)
+        hic_listing = os.path.join(hic_dir, "HiC.listing.txt")
+        listing = pd.DataFrame({'cell_type': [args.hic_cell_type], 'directory': [bedgraph_dir]})
+        if args.HiC_directory_listing:
+            listing = pd.concat([listing, pd.read_csv(args.HiC_directory_listing, sep='\t')]).drop_duplicates('cell_type')
+        listing.to_csv(hic_listing, sep='\t', index=False)
+
+    if not hic_listing:
+        raise ValueError("Either --HiC_directory_listing or --hic_raw_dir is needed")
+    hic_dirs = pd.read_csv(hic_listing, sep='\t').set_index('cell_type')['directory'].to_dict()
+
+    for cellType in cell_types:
+        cell_params = params.loc[params['cell_type'] == cellType].iloc[0]
+        genome = genomes.loc[cell_params['genome']]
+        feature_files = [f for col in ['feature_DHS', 'feature_ATAC', 'feature_H3K27ac'] for f in split_files(cell_params[col])]
+        genome_files = [args.params_file, args.genome, genome['sizes'], genome['genes']] + split_files(genome.get('ue_genes'))
+
+        peak_dir = os.path.join(args.outdir, cellType, "Peaks")
+        nbhd_dir = os.path.join(args.outdir, cellType, "Neighborhoods")
+        pred_dir = os.path.join(args.outdir, cellType, "Predictions")
+
+        deps = []
+        candidate_regions = args.candidate_enhancer_regions
+        if not candidate_regions:
+            accessibility_file = split_files(cell_params['feature_' + cell_params['default_accessibility_feature']])[0]
+            peaks_file_prefix = os.path.basename(accessibility_file.replace(".tagAlign.gz", ".macs2").replace(".bam", ".macs2"))
+            candidate_regions = os.path.join(peak_dir, peaks_file_prefix + "_peaks.narrowPeak.candidateRegions.bed")
+            deps.append(pipeline.add(Stage(cellType + ".curate", "curateFeatures.py",
+                                           ['--cellType', cellType, '--params_file', args.params_file, '--genome', args.genome, '--outDir', peak_dir] + curate_args,
+                                           inputs=genome_files + [genome['sizes'] + ".bed"] + feature_files + existing_files(curate_args),
+                                           outputs=[candidate_regions, os.path.join(peak_dir, "feature.stats.txt")])))
+
+        deps = [pipeline.add(Stage(cellType + ".neighborhoods", "run.neighborhoods.py",
+                                   ['--cellType', cellType, '--params_file', args.params_file, '--genome', args.genome, '--outdir', nbhd_dir,
+                                    '--candidate_enhancer_regions', candidate_regions] + neighborhoods_args,
+                                   inputs=genome_files + feature_files + split_files(cell_params.get('RNA_tpm_file')) + [candidate_regions] + existing_files(neighborhoods_args),
+                                   outputs=[os.path.join(nbhd_dir, "EnhancerList.txt"), os.path.join(nbhd_dir, "GeneList.txt")],
+                                   deps=deps))]
+
+        hic_dir = hic_dirs.get(cell_params['hic_cell_type'])
+        if hic_stage and cell_params['hic_cell_type'] == args.hic_cell_type:
+            deps.append(hic_stage)
+        pipeline.add(Stage(cellType + ".predict", "predict.py",
+                           ['--cellType', cellType, '--params_file', args.params_file, '--nbhd_directory', nbhd_dir, '--outdir', pred_dir,
+                            '--HiC_directory_listing', hic_listing, '--threshold', args.threshold] + predict_args,
+                           inputs=[args.params_file, hic_listing, os.path.join(nbhd_dir, "EnhancerList.txt"), os.path.join(nbhd_dir, "GeneList.txt")] + ([hic_dir] if hic_dir else []) + existing_files(predict_args),
+                           outputs=[os.path.join(pred_dir, "EnhancerPredictions.txt")],
+                           deps=deps))
+
+    return pipeline
+
+def main():
+    args = parseargs()
+    os.makedirs(args.outdir, exist_ok=True)
+    #Stages inherit the report directory through the environment
+    memory_profile.start(__file__, args.memory_profile)
+    try:
+        build_pipeline(args).run()
+    finally:
+        if args.memory_profile:
+            print("Wrote {}".format(memory_profile.summarize(args.memory_profile)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Minimal dependency-aware job runner.
+# Jobs are python callables (most of the work in this pipeline is in subprocesses, pysam or numpy, so threads are enough).
+# A job starts once its dependencies have finished and its cpu and memory estimates fit in what is left of the limits.
+# A job larger than the limits is still run, but only on its own.
+
+class DependencyFailed(Exception):
+    pass
+
+
+class Job(object):
+    def __init__(self, name, func, args, kwargs, deps, cpus, memory_gb):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.deps = deps
+        self.cpus = cpus
+        self.memory_gb = memory_gb
+
+
+class JobGraph(object):
+    def __init__(self, max_cpus=1, max_memory_gb=None):
+        self.max_cpus = max(1, int(max_cpus))
+        self.max_memory_gb = max_memory_gb
+        self.jobs = []
+        self.names = set()
+        self.results = {}
+        self.errors = {}
+        self.timings = {}
+
+    def add(self, name, func, *args, deps=(), cpus=1, memory_gb=0, **kwargs):
+        #Dependencies have to be added first, which keeps the graph acyclic
+        if name in self.names:
+            raise ValueError("Job {} already added".format(name))
+        missing = [dep for dep in deps if dep not in self.names]
+        if missing:
+            raise ValueError("Job {} depends on unknown jobs: {}".format(name, ", ".join(map(str, missing))))
+        self.jobs.append(Job(name, func, args, kwargs, tuple(deps), cpus, memory_gb))
+        self.names.add(name)
+        return name
+
+    def run(self):
+        #Run all jobs. Returns {name: result}; raises the first failure (in the order jobs were added) once everything runnable has finished
+        pending = list(self.jobs)
+        running = {}
+        free_cpus = self.max_cpus
+        free_memory = self.max_memory_gb
+
+        with ThreadPoolExecutor(max_workers=max(1, len(self.jobs))) as pool:
+            while pending or running:
+                for job in list(pending):
+                    failed = [dep for dep in job.deps if dep in self.errors]
+                    if failed:
+                        self.errors[job.name] = DependencyFailed("{} not run because {} failed".format(job.name, ", ".join(map(str, failed))))
+                        pending.remove(job)
+                        continue
+                    if not all(dep in self.results for dep in job.deps):
+                        continue
+                    if running and (job.cpus > free_cpus or (free_memory is not None and job.memory_gb > free_memory)):
+                        continue
+
+                    print("Starting job: {}".format(job.name))
+                    running[pool.submit(self._run_job, job)] = job
+                    pending.remove(job)
+                    free_cpus -= job.cpus
+                    if free_memory is not None:
+                        free_memory -= job.memory_gb
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    free_cpus += job.cpus
+                    if free_memory is not None:
+                        free_memory += job.memory_gb
+                    try:
+                        self.results[job.name] = future.result()
+                    except Exception as e:
+                        print("Job {} failed: {}".format(job.name, e))
+                        self.errors[job.name] = e
+
+        for job in self.jobs:
+            if job.name in self.errors:
+                raise self.errors[job.name]
+        return self.results
+
+    def _run_job(self, job):
+        start = time.time()
+        try:
+            return job.func(*job.args, **job.kwargs)
+        finally:
+            self.timings[job.name] = time.time() - start
+            print("Finished job: {} ({:.1f}s)".format(job.name, self.timings[job.name]))
@@ -0,0 +1,188 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as ssp
+from multiprocessing import shared_memory
+
+# Read-only data shared between worker processes without copies.
+# The parent publishes numpy arrays into one shared memory block (SharedArrays.create) and passes the small, picklable
+# handle to workers, which attach to the block (SharedArrays.attach) and get numpy views of it. Memory use then grows
+# with the size of the data rather than with the number of workers.
+#
+# SharedTable stores a DataFrame column by column (strings as categorical codes or fixed width bytes) and rebuilds
+# row subsets on request. SharedRanges adds a sorted-array interval index with the within_range interface of
+# GenomicRangesIntervalTree.
+
+ALIGNMENT = 64
+
+class SharedArrays(object):
+    def __init__(self, shm, layout, owner):
+        self.shm = shm
+        self.layout = layout
+        self.owner = owner
+        self.arrays = {}
+        for key, dtype, shape, offset in layout:
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            if not owner:
+                array.flags.writeable = False
+            self.arrays[key] = array
+
+    @classmethod
+    def create(cls, arrays):
+        layout = []
+        size = 0
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            layout.append((key, array.dtype.str, array.shape, size))
+            size += -(-max(array.nbytes, 1) // ALIGNMENT) * ALIGNMENT
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        shared = cls(shm, layout, owner=True)
+        for key, array in arrays.items():
+            shared.arrays[key][...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, handle):
+        name, layout = handle
+        try:
+            # The creating process owns the block and unlinks it (python >= 3.13)
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Workers started by multiprocessing share the parent's resource tracker, so registering again is harmless
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, layout, owner=False)
+
+    @property
+    def handle(self):
+        return (self.shm.name, self.layout)
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def close(self):
+        self.arrays = {}
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedTable(object):
+    # A DataFrame in shared memory. Numeric and boolean columns are stored as they are, categoricals and low cardinality
+    # strings as codes (the categories are in the handle), other strings as utf-8 fixed width bytes
+    def __init__(self, arrays, columns):
+        self.arrays = arrays
+        self.columns = columns
+
+    @classmethod
+    def create(cls, table):
+        arrays, columns = {}, []
+        for i, col in enumerate(table.columns):
+            key = "col{}".format(i)
+            values = table[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                arrays[key] = values.cat.codes.values
+                columns.append((col, key, 'category', list(values.cat.categories)))
+            elif values.dtype.kind in 'biufcM':
+                arrays[key] = values.values
+                columns.append((col, key, 'array', None))
+            elif values.nunique() < len(values) / 2:
+                codes, categories = pd.factorize(values)
+                arrays[key] = codes.astype(np.int32)
+                columns.append((col, key, 'category', list(categories)))
+            else:
+                arrays[key] = values.astype(str).str.encode('utf-8').values.astype(bytes)
+                columns.append((col, key, 'bytes', None))
+        return cls(SharedArrays.create(arrays), columns)
+
+    @classmethod
+    def attach(cls, handle):
+        arrays_handle, columns = handle
+        return cls(SharedArrays.attach(arrays_handle), columns)
+
+    @property
+    def handle(self):
+        return (self.arrays.handle, self.columns)
+
+    def frame(self, rows=None):
+        # Copy of the given rows (all rows if None) as a DataFrame with a 0..n index
+        data = {}
+        for col, key, kind, categories in self.columns:
+            values = self.arrays[key] if rows is None else self.arrays[key][rows]
+            if kind == 'category':
+                values = pd.Categorical.from_codes(values, categories=categories)
+            elif kind == 'bytes':
+                values = np.char.decode(values, 'utf-8').astype(object)
+            else:
+                values = values.copy() if rows is None else values
+            data[col] = values
+        return pd.DataFrame(data, columns=[col for col, key, kind, categories in self.columns])
+
+    def close(self):
+        self.arrays.close()
+
+
+class SharedRanges(object):
+    # Elements (chr, start, end, ...) in shared memory with an interval index: per chromosome, rows sorted by start and the
+    # longest element length, so the elements overlapping [start, end) lie between two binary searches
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        self.chromosome_bounds = {}
+        for chr, lo, hi, max_length in index['chromosomes']:
+            self.chromosome_bounds[chr] = (lo, hi, max_length)
+
+    @classmethod
+    def create(cls, ranges):
+        ranges = ranges.reset_index(drop=True)
+        order = np.lexsort((ranges['start'].values, pd.factorize(ranges['chr'])[0]))
+        chrs = ranges['chr'].values[order]
+        starts = ranges['start'].values[order]
+        ends = ranges['end'].values[order]
+        bounds = np.concatenate(([0], np.flatnonzero(chrs[1:] != chrs[:-1]) + 1, [len(order)]))
+        chromosomes = [(chrs[lo], int(lo), int(hi), int((ends[lo:hi] - starts[lo:hi]).max())) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+        index = SharedArrays.create({'order': order.astype(np.int64), 'starts': starts, 'ends': ends})
+        return cls(SharedTable.create(ranges), {'arrays': index, 'chromosomes': chromosomes})
+
+    @classmethod
+    def attach(cls, handle):
+        table_handle, index_handle, chromosomes = handle
+        return cls(SharedTable.attach(table_handle), {'arrays': SharedArrays.attach(index_handle), 'chromosomes': chromosomes})
+
+    @property
+    def handle(self):
+        return (self.table.handle, self.index['arrays'].handle, self.index['chromosomes'])
+
+    @property
+    def ranges(self):
+        return self.table.frame()
+
+    def chromosomes(self):
+        return list(self.chromosome_bounds)
+
+    def within_range(self, chr, start, end):
+        # Elements overlapping [start, end), in row order of the published table. Returns an empty data frame if none do
+        if start == end:
+            end = end + 1
+        if chr not in self.chromosome_bounds:
+            return self.table.frame(np.zeros(0, dtype=np.int64))
+        lo, hi, max_length = self.chromosome_bounds[chr]
+        arrays = self.index['arrays']
+        starts = arrays['starts'][lo:hi]
+        first = lo + np.searchsorted(starts, start - max_length, side='right')
+        last = lo + np.searchsorted(starts, end, side='left')
+        candidates = np.arange(first, last)
+        rows = arrays['order'][candidates[arrays['ends'][candidates] > start]]
+        return self.table.frame(np.sort(rows))
+
+    def close(self):
+        self.table.close()
+        self.index['arrays'].close()
+
+
+def share_csr_matrix(matrix, extra=None):
+    # Arrays of a scipy CSR matrix (and any extra named arrays) in shared memory. Returns (SharedArrays, shape)
+    arrays = {'data': matrix.data, 'indices': matrix.indices, 'indptr': matrix.indptr}
+    arrays.update(extra or {})
+    return SharedArrays.create(arrays), matrix.shape
+
+def attach_csr_matrix(shared, shape):
+    return ssp.csr_matrix((shared['data'], shared['indices'], shared['indptr']), shape=shape, copy=False)
@@ -1,6 +1,9 @@
 import os
 import pandas
 import pickle
+import json
+import hashlib
+import shutil
 from intervaltree import IntervalTree, Interval
 import pysam
 import numpy as np
@@ -8,6 +11,8 @@ import pandas as pd
 import re
 from subprocess import check_call
 import sys
+import threading
+from contextlib import contextmanager
 
 #TO DO:
 # Get rid of reuse
@@ -17,17 +22,88 @@ import sys
 pandas.set_option('mode.chained_assignment', 'raise')
 
 
-def read_genes(filename):
-    genes = pandas.read_table(filename)
+def read_genes(filename, chromosomes=None):
+    gene_cols = ['chr','tss','name','Expression','PromoterActivityQuantile']
+    genes = load_table(filename, columns=gene_cols, chromosomes=chromosomes)
 
     #Deduplicate genes.
-    gene_cols = ['chr','tss','name','Expression','PromoterActivityQuantile']
     genes = genes[gene_cols]
     genes.drop_duplicates(inplace=True)
 
     return genes
 
 
+def is_parquet(filename):
+    return isinstance(filename, str) and filename.rstrip(os.sep).endswith(".parquet")
+
+
+PARQUET_ROW = '_row'
+PARQUET_COLUMNS = '_columns.json'
+
+def load_table(filename, columns=None, chromosomes=None):
+    # Read a tab delimited table, or a parquet dataset written by write_table_by_chromosome.
+    # columns restricts which columns are parsed. chromosomes restricts the rows; for parquet
+    # datasets only the partitions of those chromosomes are read
+    if is_parquet(filename):
+        filters = None if chromosomes is None else [('chr', 'in', list(chromosomes))]
+        with open(os.path.join(filename, PARQUET_COLUMNS)) as f:
+            order = [col for col in json.load(f) if columns is None or col in columns]
+        table = pandas.read_parquet(filename, columns=None if columns is None else list(set(order) | {'chr', PARQUET_ROW}), filters=filters)
+        # partition column is returned as a categorical
+        table['chr'] = table['chr'].astype(str)
+        # Rows and columns in the order of the tab delimited table
+        table = table.sort_values(PARQUET_ROW, kind='stable')[order].reset_index(drop=True)
+    else:
+        table = pandas.read_table(filename, usecols=columns)
+        if chromosomes is not None:
+            table = table.loc[table['chr'].isin(chromosomes)].reset_index(drop=True)
+    return table
+
+
+def write_table_by_chromosome(table, path):
+    # Write table as a parquet dataset partitioned by chromosome (path/chr=chr1/...), replacing any existing dataset.
+    # The row number and column order are stored so that load_table returns the table as it was. Requires pyarrow
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    columns = list(table.columns)
+    table = table.assign(chr=table['chr'].astype(str), **{PARQUET_ROW: np.arange(len(table))})
+    table.to_parquet(tmp, partition_cols=['chr'], index=False)
+    # Files starting with _ are not read as data
+    with open(os.path.join(tmp, PARQUET_COLUMNS), 'w') as f:
+        json.dump(columns, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+def compact_dtypes(table, categorical=(), floats=True):
+    # Smaller dtypes for the --compact_dtypes mode: integer columns whose values fit become int32, float columns float32
+    # (unless floats is False, for tables that are still computed from), and string columns that are mostly repeated
+    # values (or listed in categorical) become categoricals
+    table = table.copy()
+    for col in table.columns:
+        values = table[col]
+        if pd.api.types.is_integer_dtype(values.dtype) and values.dtype.itemsize > 4:
+            if len(values) == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+                table[col] = values.astype(np.int32)
+        elif floats and pd.api.types.is_float_dtype(values.dtype) and values.dtype.itemsize > 4:
+            table[col] = values.astype(np.float32)
+        elif values.dtype == object or pd.api.types.is_string_dtype(values.dtype):
+            if col in categorical or values.nunique() <= len(values) / 2:
+                table[col] = values.astype('category')
+    return table
+
+def concat_compact(tables):
+    # pandas.concat, keeping categorical columns categorical when the tables have different categories
+    tables = [table for table in tables if table is not None]
+    for col in tables[0].columns if tables else []:
+        dtypes = [table[col].dtype for table in tables]
+        if any(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes) and any(dtype != dtypes[0] for dtype in dtypes):
+            categories = pd.api.types.union_categoricals([table[col].astype('category') for table in tables]).categories
+            tables = [table.assign(**{col: pd.Categorical(table[col], categories=categories)}) for table in tables]
+    return pd.concat(tables)
+
 def get_gene_name(gene):
     try:
         out_name = gene['name'] #if ('symbol' not in gene.keys() or gene.isnull().symbol) else gene['symbol']
@@ -49,11 +125,11 @@ def write_scores(outdir, gene, enhancers):
 
 
 class GenomicRangesIntervalTree(object):
-    def __init__(self, filename, slop=0, isBed=False):
+    def __init__(self, filename, slop=0, isBed=False, columns=None, chromosomes=None):
         if isBed:
             self.ranges = pandas.read_table(filename, header=None, names=['chr', 'start', 'end', 'Score'])
         else:
-            self.ranges = pandas.read_table(filename)
+            self.ranges = load_table(filename, columns=columns, chromosomes=chromosomes)
 
         self.ranges['start'] = self.ranges['start'] - slop
         self.ranges['end'] = self.ranges['end'] + slop
@@ -73,7 +149,8 @@ class GenomicRangesIntervalTree(object):
         result = self.ranges.iloc[[], :].copy()
         if chr in self.intervals:
             overlaps = self.intervals[chr][start:end]
-            indices = [idx for l, h, idx in overlaps]
+            #Row order, so that results do not depend on the tree's iteration order
+            indices = sorted(idx for l, h, idx in overlaps)
             result = self.ranges.iloc[indices, :].copy()
         return result
 
@@ -84,8 +161,19 @@ class GenomicRangesIntervalTree(object):
         return self.ranges[idx]
 
 
-def read_enhancers(filename):
-    return GenomicRangesIntervalTree(filename)
+def overlaps_any(starts, ends, interval_starts, interval_ends):
+    # For each [start, end) on one chromosome, whether it overlaps any of the intervals by at least 1bp.
+    # With intervals sorted by start, the ones starting before end are a prefix; one of them overlaps iff the largest end in that prefix is > start
+    if len(interval_starts) == 0:
+        return np.zeros(len(starts), dtype=bool)
+    order = np.argsort(interval_starts, kind='mergesort')
+    sorted_starts = np.asarray(interval_starts)[order]
+    max_ends = np.maximum.accumulate(np.asarray(interval_ends)[order])
+    n_before = np.searchsorted(sorted_starts, ends, side='left')
+    return (n_before > 0) & (max_ends[np.maximum(n_before - 1, 0)] > starts)
+
+def read_enhancers(filename, columns=None, chromosomes=None):
+    return GenomicRangesIntervalTree(filename, columns=columns, chromosomes=chromosomes)
 
 def get_genome_sizes_from_bam(filename):
     bamfile = pysam.Samfile(filename, "r")
@@ -123,6 +211,138 @@ class DataCache(object):
         with open(cache_name, "wb") as f:
             pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
 
+@contextmanager
+def atomic_write(filename):
+    # Yields a temporary filename next to filename. It is renamed over filename only if the block completes,
+    # so a killed or failed job never leaves a partially written output behind
+    tmp = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+    try:
+        yield tmp
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def write_table_if_changed(df, filename, **kwargs):
+    # df.to_csv(filename, **kwargs), unless filename already holds exactly that text. Its modification time then only
+    # changes with its contents, so outputs computed from it (see is_up_to_date) stay up to date across reruns
+    text = df.to_csv(None, **kwargs)
+    if os.path.exists(filename):
+        with open(filename) as f:
+            if f.read() == text:
+                return False
+    with atomic_write(filename) as tmp:
+        with open(tmp, 'w') as f:
+            f.write(text)
+    return True
+
+def is_up_to_date(output, inputs):
+    # Whether output exists, is not empty and is at least as new as each of inputs
+    if not os.path.exists(output) or os.path.getsize(output) == 0:
+        return False
+    mtime = os.path.getmtime(output)
+    return all(os.path.getmtime(f) <= mtime for f in inputs)
+
+def get_cache_dir(cache_dir=None):
+    # Directory for results shared between runs and output directories: cache_dir, else $ABC_CACHE_DIR.
+    # Returns None when neither is set, in which case nothing is cached
+    if cache_dir is None:
+        cache_dir = os.environ.get("ABC_CACHE_DIR") or None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def file_identity(filename):
+    # Identifies a version of a file without reading it: absolute path, size and modification time
+    st = os.stat(filename)
+    return "{}:{}:{}".format(os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+
+def file_digest(filename, block_size=1 << 20):
+    # sha1 of the contents of filename
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class CountReadsCache(object):
+    # Content addressed store of CountReads files, shared between output directories.
+    # The key combines the signal file identity (path, size, mtime), a hash of the region file contents and the counting mode.
+    # Disabled (nothing is read or written) unless a cache directory is given, see get_cache_dir
+    def __init__(self, directory=None):
+        directory = get_cache_dir(directory)
+        self.directory = None if directory is None else os.path.join(directory, "count_reads")
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, signal_file, bed_file, mode):
+        if self.directory is None:
+            return None
+        return hashlib.sha1("\n".join([file_identity(signal_file), file_digest(bed_file), mode]).encode()).hexdigest()
+
+    def get(self, key, output):
+        # Copy the cached counts to output. Returns False if key is not cached
+        if self.directory is None:
+            return False
+        cached = os.path.join(self.directory, key + ".CountReads.bed")
+        if not os.path.exists(cached):
+            return False
+        with atomic_write(output) as tmp:
+            shutil.copyfile(cached, tmp)
+        return True
+
+    def put(self, key, output):
+        if self.directory is None:
+            return
+        with atomic_write(os.path.join(self.directory, key + ".CountReads.bed")) as tmp:
+            shutil.copyfile(output, tmp)
+
+class TotalsCache(object):
+    # Library sizes of signal files, one small json file per file_identity in the cache directory. Each is written with
+    # atomic_write, so concurrent runs (threads or processes) never lose or corrupt each other's totals.
+    # A file that is replaced or modified gets a new key, so stale totals are never returned.
+    # The json files are only used when a cache directory is given (see get_cache_dir); totals are always remembered
+    # for the rest of the process in memo, so a file is read once per run however many region sets and features use it
+    memo = {}
+
+    def __init__(self, directory=None):
+        directory = get_cache_dir(directory)
+        self.directory = None if directory is None else os.path.join(directory, "library_totals")
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _filename(self, filename):
+        return os.path.join(self.directory, hashlib.sha1(file_identity(filename).encode()).hexdigest() + ".json")
+
+    def __contains__(self, filename):
+        try:
+            self[filename]
+            return True
+        except KeyError:
+            return False
+
+    def __getitem__(self, filename):
+        identity = file_identity(filename)
+        if identity in self.memo:
+            return self.memo[identity]
+        if self.directory is None:
+            raise KeyError(filename)
+        try:
+            with open(self._filename(filename)) as f:
+                total = json.load(f)['total']
+        except (IOError, ValueError, KeyError):
+            raise KeyError(filename)
+        self.memo[identity] = total
+        return total
+
+    def __setitem__(self, filename, value):
+        self.memo[file_identity(filename)] = value
+        if self.directory is None:
+            return
+        with atomic_write(self._filename(filename)) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump({'file': file_identity(filename), 'total': value}, f)
+
 def run_command(command, **args):
     print("Running command: " + command)
     return check_call(command, shell=True, **args)
@@ -139,7 +359,7 @@ def write_connections_bedpe_format(pred, outfile, score_column):
     towrite["chr2"] = pred["chr"]
     towrite["y1"] = pred["TargetGeneTSS"]
     towrite["y2"] = pred["TargetGeneTSS"]
-    towrite["name"] = pred["TargetGene"] + "_" + pred["name"]
+    towrite["name"] = pred["TargetGene"].astype(str) + "_" + pred["name"].astype(str)  # may be categorical with --compact_dtypes
     towrite["score"] = pred[score_column]
     towrite["strand1"] = "."
     towrite["strand2"] = "."
@@ -0,0 +1,52 @@
+import glob
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Runs predict.py on the chr22 example with and without --compact_dtypes and compares the scores.
+# Run from the repository root: python -m pytest tests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from tools import compact_dtypes
+
+
+def run_predict(outdir, genes, *extra):
+    subprocess.check_call([sys.executable, os.path.join(ROOT, "src", "predict.py"),
+                           "--cellType", "K562",
+                           "--params_file", "example/config/cellTypeParameters.txt",
+                           "--HiC_directory_listing", "example/config/HiC.listing.txt",
+                           "--nbhd_directory", "example/ABC_output/Neighborhoods",
+                           "--genes", genes,
+                           "--threshold", ".022",
+                           "--outdir", outdir] + list(extra),
+                          cwd=ROOT, stdout=subprocess.DEVNULL)
+    #Every scored element of every gene, from the gene files
+    gene_files = sorted(glob.glob(os.path.join(outdir, "genes", "*.prediction.txt.gz")))
+    return pd.concat([pd.read_table(f) for f in gene_files], ignore_index=True)
+
+
+def test_compact_keeps_float64_inputs():
+    table = pd.DataFrame({'start': np.arange(3, dtype=np.int64), 'value': np.linspace(0, 1, 3), 'name': ['a', 'b', 'c']})
+    compact = compact_dtypes(table, categorical=['name'], floats=False)
+    assert compact['start'].dtype == np.int32
+    assert compact['value'].dtype == np.float64
+    assert compact_dtypes(table)['value'].dtype == np.float32
+
+
+def test_compact_scores_match_float64(tmp_path):
+    genes = pd.read_table(os.path.join(ROOT, "example/ABC_output/Neighborhoods/GeneList.txt"))
+    genes_file = str(tmp_path / "genes.txt")
+    genes.head(40).to_csv(genes_file, sep='\t', index=False)
+
+    full = run_predict(str(tmp_path / "float64"), genes_file)
+    compact = run_predict(str(tmp_path / "compact"), genes_file, "--compact_dtypes")
+
+    assert len(full) > 0
+    assert full[['name', 'TargetGene']].equals(compact[['name', 'TargetGene']])
+    #Gene files are written with 6 decimals, so float32 values may differ in the last one
+    assert np.allclose(full['ABC.Score'], compact['ABC.Score'], rtol=1e-5, atol=1.5e-6, equal_nan=True)